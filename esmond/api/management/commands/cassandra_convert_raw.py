@@ -0,0 +1,73 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from pycassa.columnfamily import ColumnFamily
+from pycassa.system_manager import SystemManager, BYTES_TYPE
+
+from esmond.cassandra import CASSANDRA_DB, RAW_ENCODING_MARKER, decode_raw_value, encode_raw_value
+from esmond.config import get_config, get_config_path
+
+class Command(BaseCommand):
+    help = 'Convert the raw_data column family from JSON text to the binary value encoding.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Report how many columns would be converted and the space saved without writing anything.')
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=500,
+            help='Number of columns to read and write at a time (default 500).')
+
+    def handle(self, *args, **options):
+        config = get_config(get_config_path())
+        if not config.raw_data_binary and not options['dry_run']:
+            print('raw_data_binary is not turned on in the config, not converting.')
+            return
+
+        db = CASSANDRA_DB(config)
+        try:
+            self.convert(config, db, options)
+        finally:
+            db.close()
+
+    def convert(self, config, db, options):
+        # Values can only be written as bytes once the column family no
+        # longer validates them as UTF8.
+        if not db.raw_cf_bytes and not options['dry_run']:
+            print('Changing {0} value validation to {1}'.format(db.raw_cf, BYTES_TYPE))
+            sysman = SystemManager(config.cassandra_servers[0])
+            sysman.alter_column_family(db.keyspace, db.raw_cf,
+                default_validation_class=BYTES_TYPE)
+            sysman.close()
+            print('Waiting for schema to propagate...')
+            time.sleep(10)
+
+        # New ColumnFamily so it picks up the new validation class
+        cf = ColumnFamily(db.pool, db.raw_cf)
+        batch = cf.batch(options['batch_size'])
+
+        rows = columns = converted = old_bytes = new_bytes = 0
+        for key, _ in cf.get_range(column_count=0, filter_empty=False):
+            rows += 1
+            for ts, (val, ttl) in cf.xget(key, buffer_size=options['batch_size'], include_ttl=True):
+                columns += 1
+                if isinstance(val, str):
+                    val = val.encode('utf-8')
+                if val[:1] == RAW_ENCODING_MARKER:
+                    continue
+                encoded = encode_raw_value(decode_raw_value(val))
+                if encoded == val:
+                    continue
+                converted += 1
+                old_bytes += len(val)
+                new_bytes += len(encoded)
+                if not options['dry_run']:
+                    _kw = {}
+                    if ttl:
+                        _kw['ttl'] = ttl
+                    batch.insert(key, {ts: encoded}, **_kw)
+        batch.send()
+
+        print('Rows: {0} Columns: {1} Converted: {2}'.format(rows, columns, converted))
+        print('Converted columns went from {0} to {1} bytes'.format(old_bytes, new_bytes))
+        if options['dry_run']:
+            print('Dry run, nothing was written')
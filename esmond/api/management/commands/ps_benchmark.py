@@ -0,0 +1,304 @@
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from esmond.api.perfsonar import api_v2
+from esmond.api.perfsonar.types import *
+from esmond.config import get_config, get_config_path
+from esmond.sqlite import SQLITE_DB
+
+PS_ROOT = 'perfsonar'
+
+# metrics compared against the baseline and whether higher is better
+BASELINE_METRICS = (
+    ('points_per_sec', True),
+    ('p50_ms', False),
+    ('p99_ms', False),
+    ('peak_rss_mb', False),
+)
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[int(round(q / 100.0 * (len(values) - 1)))]
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class Command(BaseCommand):
+    help = ('Benchmark the perfSONAR REST api: bulk histogram writes, throughput '
+            'writes, metadata searches and long range time series reads are run '
+            'through the django test client against a local sqlite storage backend '
+            'and a throwaway relational database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--metadata', type=int, dest='metadata', default=20,
+            help='Number of measurements (metadata objects) to create (default 20).')
+        parser.add_argument('--histograms', type=int, dest='histograms', default=20000,
+            help='Total number of owdelay histograms to write (default 20000).')
+        parser.add_argument('--throughput', type=int, dest='throughput', default=2000,
+            help='Total number of throughput points to write (default 2000).')
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=100,
+            help='Histograms per bulk PUT (default 100).')
+        parser.add_argument('--searches', type=int, dest='searches', default=200,
+            help='Number of metadata searches (default 200).')
+        parser.add_argument('--queries', type=int, dest='queries', default=100,
+            help='Number of long range time series reads (default 100).')
+        parser.add_argument('--storage-file', dest='storage_file', default=None,
+            help='sqlite file to store the time series in (default a temporary file).')
+        parser.add_argument('--result-cache', action='store_true', dest='result_cache', default=False,
+            help='Leave the time series result cache on, by default reads go to storage.')
+        parser.add_argument('--seed', type=int, dest='seed', default=0,
+            help='Random seed for the generated data (default 0).')
+        parser.add_argument('--save-baseline', dest='save_baseline', default=None,
+            help='Write the results to this file to compare later runs against.')
+        parser.add_argument('--baseline', dest='baseline', default=None,
+            help='Compare the results against a file written with --save-baseline.')
+        parser.add_argument('--tolerance', type=float, dest='tolerance', default=20.0,
+            help='Percent a metric may get worse than the baseline before the run fails (default 20).')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.rand = random.Random(options['seed'])
+
+        storage_file = options['storage_file']
+        if storage_file is None:
+            fd, storage_file = tempfile.mkstemp(prefix='esmond_benchmark_', suffix='.sqlite')
+            os.close(fd)
+        config = get_config(get_config_path())
+        config.storage_backend = 'sqlite'
+        config.sqlite_storage_file = storage_file
+
+        setup_test_environment(debug=False)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        old_db = api_v2.db
+        old_cache = api_v2.timeseries_cache.enabled
+        api_v2.set_db(SQLITE_DB(config))
+        api_v2.timeseries_cache.enabled = options['result_cache']
+        try:
+            results = self.run_workloads()
+        finally:
+            api_v2.db.close()
+            api_v2.db = old_db
+            api_v2.timeseries_cache.enabled = old_cache
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            if options['storage_file'] is None:
+                os.remove(storage_file)
+
+        self.report(results)
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump({'options': self.workload_options(), 'results': results}, f, indent=2, sort_keys=True)
+            self.stdout.write('Saved baseline to {0}'.format(options['save_baseline']))
+
+        if options['baseline']:
+            self.compare(results, options['baseline'])
+
+    def workload_options(self):
+        return dict((k, self.options[k]) for k in ('metadata', 'histograms', 'throughput',
+            'batch_size', 'searches', 'queries', 'result_cache', 'seed'))
+
+    #
+    # Workloads
+    #
+
+    def run_workloads(self):
+        user = User.objects.create_superuser('benchmark', 'benchmark@localhost', None)
+        token = Token.objects.create(user=user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token {0}'.format(token.key))
+
+        # whole hours so the summary bins line up with the range
+        self.start = int(time.time()) // 3600 * 3600 - 90 * 86400
+        self.histogram_interval = 60
+        self.throughput_interval = 3600
+
+        results = {}
+        results['metadata_create'] = self.run_workload(self.metadata_create_requests())
+        results['histogram_put'] = self.run_workload(self.histogram_put_requests())
+        results['throughput_post'] = self.run_workload(self.throughput_post_requests())
+        results['metadata_search'] = self.run_workload(self.metadata_search_requests())
+        results['timeseries_get'] = self.run_workload(self.timeseries_get_requests())
+        return results
+
+    def run_workload(self, requests):
+        """
+        requests yields (method, url, data, expected status, points written)
+        tuples. Points read are the number of results in the response.
+        """
+        latencies = []
+        points = 0
+        total = 0.0
+        for method, url, data, status, written in requests:
+            t = time.time()
+            if method == 'get':
+                response = self.client.get(url, data)
+            else:
+                response = getattr(self.client, method)(url, data, format='json')
+            elapsed = time.time() - t
+            if response.status_code != status:
+                raise CommandError('{0} {1} returned {2}: {3}'.format(method.upper(), url,
+                    response.status_code, response.content[:500]))
+            if method == 'get':
+                written = len(json.loads(response.content))
+            points += written
+            total += elapsed
+            latencies.append(elapsed * 1000)
+
+        return {
+            'requests': len(latencies),
+            'points': points,
+            'seconds': total,
+            'points_per_sec': points / total if total else 0,
+            'p50_ms': percentile(latencies, 50),
+            'p99_ms': percentile(latencies, 99),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+    def metadata_create_requests(self):
+        self.metadata_keys = []
+        self.hosts = ['10.{0}.{1}.{2}'.format(i // 65536, i // 256 % 256, i % 256 + 1)
+            for i in range(self.options['metadata'] + 1)]
+        for i in range(self.options['metadata']):
+            data = {
+                'subject-type': 'point-to-point',
+                'source': self.hosts[i],
+                'destination': self.hosts[i + 1],
+                'measurement-agent': self.hosts[i],
+                'input-source': self.hosts[i],
+                'input-destination': self.hosts[i + 1],
+                'tool-name': 'powstream' if i % 2 else 'bwctl/iperf3',
+                'time-interval': 60,
+                'event-types': [
+                    {
+                        'event-type': 'histogram-owdelay',
+                        'summaries': [
+                            {'summary-type': 'aggregation', 'summary-window': '3600'},
+                            {'summary-type': 'aggregation', 'summary-window': '86400'},
+                            {'summary-type': 'statistics', 'summary-window': '0'},
+                        ],
+                    },
+                    {
+                        'event-type': 'throughput',
+                        'summaries': [
+                            {'summary-type': 'average', 'summary-window': '86400'},
+                        ],
+                    },
+                ],
+            }
+            yield 'post', '/{0}/archive/'.format(PS_ROOT), data, 201, 1
+        self.metadata_keys = [md['metadata-key'] for md in
+            json.loads(self.client.get('/{0}/archive/'.format(PS_ROOT), {'limit': len(self.hosts)}).content)]
+
+    def histogram(self):
+        """
+        A one minute owdelay histogram of 600 packets in 0.01ms buckets
+        """
+        base = self.rand.uniform(5, 50)
+        hist = {}
+        for i in range(600):
+            k = '{0:.2f}'.format(self.rand.gauss(base, 0.05))
+            hist[k] = hist.get(k, 0) + 1
+        return hist
+
+    def histogram_put_requests(self):
+        per_key = self.options['histograms'] // len(self.metadata_keys)
+        batch_size = self.options['batch_size']
+        for md_key in self.metadata_keys:
+            for first in range(0, per_key, batch_size):
+                data = {'data': []}
+                for i in range(first, min(first + batch_size, per_key)):
+                    data['data'].append({
+                        'ts': self.start + i * self.histogram_interval,
+                        'val': [{'event-type': 'histogram-owdelay', 'val': self.histogram()}]
+                    })
+                yield 'put', '/{0}/archive/{1}/'.format(PS_ROOT, md_key), data, 201, len(data['data'])
+        self.histogram_end = self.start + per_key * self.histogram_interval
+
+    def throughput_post_requests(self):
+        per_key = self.options['throughput'] // len(self.metadata_keys)
+        for md_key in self.metadata_keys:
+            url = '/{0}/archive/{1}/throughput/base'.format(PS_ROOT, md_key)
+            for i in range(per_key):
+                data = {'ts': self.start + i * self.throughput_interval,
+                        'val': self.rand.randint(900000000, 9900000000)}
+                yield 'post', url, data, 201, 1
+        self.throughput_end = self.start + per_key * self.throughput_interval
+
+    def metadata_search_requests(self):
+        searches = [
+            lambda h: {EVENT_TYPE_FILTER: 'histogram-owdelay'},
+            lambda h: {'source': h, EVENT_TYPE_FILTER: 'throughput'},
+            lambda h: {'destination': h},
+            lambda h: {'tool-name': 'powstream', SUMMARY_TYPE_FILTER: 'aggregation', SUMMARY_WINDOW_FILTER: '3600'},
+            lambda h: {'source': h, 'destination': h, TIME_RANGE_FILTER: 86400},
+        ]
+        url = '/{0}/archive/'.format(PS_ROOT)
+        for i in range(self.options['searches']):
+            host = self.rand.choice(self.hosts)
+            yield 'get', url, searches[i % len(searches)](host), 200, 0
+
+    def timeseries_get_requests(self):
+        reads = [
+            ('histogram-owdelay/base', self.histogram_end),
+            ('histogram-owdelay/aggregations/3600', self.histogram_end),
+            ('histogram-owdelay/statistics/0', self.histogram_end),
+            ('throughput/base', self.throughput_end),
+            ('throughput/averages/86400', self.throughput_end),
+        ]
+        for i in range(self.options['queries']):
+            path, end = reads[i % len(reads)]
+            md_key = self.rand.choice(self.metadata_keys)
+            params = {TIME_START_FILTER: self.start, TIME_END_FILTER: end, LIMIT_FILTER: 100000}
+            yield 'get', '/{0}/archive/{1}/{2}'.format(PS_ROOT, md_key, path), params, 200, 0
+
+    #
+    # Reporting
+    #
+
+    def report(self, results):
+        self.stdout.write('{0:<18}{1:>9}{2:>10}{3:>12}{4:>10}{5:>10}{6:>12}'.format(
+            'workload', 'requests', 'points', 'points/sec', 'p50 ms', 'p99 ms', 'peak RSS MB'))
+        for name, r in results.items():
+            self.stdout.write('{0:<18}{1:>9}{2:>10}{3:>12.1f}{4:>10.2f}{5:>10.2f}{6:>12.1f}'.format(
+                name, r['requests'], r['points'], r['points_per_sec'], r['p50_ms'], r['p99_ms'], r['peak_rss_mb']))
+
+    def compare(self, results, baseline_file):
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        if baseline['options'] != self.workload_options():
+            self.stdout.write('Warning: baseline was run with different options {0}'.format(baseline['options']))
+
+        regressions = []
+        self.stdout.write('Change from baseline {0}:'.format(baseline_file))
+        for name, r in results.items():
+            base = baseline['results'].get(name)
+            if base is None:
+                continue
+            changes = []
+            for metric, higher_is_better in BASELINE_METRICS:
+                if not base[metric]:
+                    continue
+                change = (r[metric] - base[metric]) * 100.0 / base[metric]
+                changes.append('{0} {1:+.1f}%'.format(metric, change))
+                worse = -change if higher_is_better else change
+                if worse > self.options['tolerance']:
+                    regressions.append('{0} {1} {2:.2f} -> {3:.2f}'.format(name, metric, base[metric], r[metric]))
+            self.stdout.write('  {0:<18}{1}'.format(name, '  '.join(changes)))
+
+        if regressions:
+            raise CommandError('Worse than the baseline by more than {0}%: {1}'.format(
+                self.options['tolerance'], ', '.join(regressions)))
@@ -1,13 +1,16 @@
 import ast
+import atexit
 import calendar
 import collections
 import copy
 import datetime
 import hashlib
 import inspect
+import itertools
 import json
 import math
 import os
+import threading
 import time
 import urllib.parse
 import uuid
@@ -16,19 +19,23 @@ import pprint
 
 pp = pprint.PrettyPrinter(indent=4)
 
+from django.conf import settings
+from django.core.cache import caches, InvalidCacheBackendError
 from django.db import connection, transaction
 from django.db.models import Q
 from django.utils.text import slugify
 from django.utils.timezone import utc
 from django.db.utils import DatabaseError
+from django.http import StreamingHttpResponse
 
 from socket import getaddrinfo, AF_INET, AF_INET6, SOL_TCP, SOCK_STREAM
 
 from rest_framework import (viewsets, serializers, status, 
-        fields, relations, pagination, mixins, throttling)
+        fields, relations, pagination, mixins, throttling, renderers)
 from rest_framework.exceptions import (ParseError, NotFound, MethodNotAllowed, APIException)
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from rest_framework.permissions import (DjangoModelPermissions, IsAuthenticatedOrReadOnly)
 from rest_framework.authentication import BaseAuthentication, TokenAuthentication
 
@@ -38,12 +45,16 @@ from esmond.api.models import (PSMetadata, PSPointToPointSubject, PSEventTypes,
     PSMetadataParameters, PSNetworkElementSubject, UserIpAddress)
 
 from esmond.api.perfsonar.types import *
+from esmond.api.perfsonar.validators import DDSketch, HistogramValidator
+from esmond.api.perfsonar import downsample
 
-from esmond.cassandra import KEY_DELIMITER, CASSANDRA_DB, AGG_TYPES, ConnectionException, RawRateData, BaseRateBin, RawData, AggregationBin
+from esmond.cassandra import KEY_DELIMITER, AGG_TYPES, ConnectionException, RawRateData, BaseRateBin, RawData, AggregationBin
 
 from esmond.config import get_config_path, get_config
+from esmond.metrics import registry
+from esmond.storage import get_storage_backend
 
-from esmond.util import get_logger
+from esmond.util import get_logger, LRUCache, SingleFlight
 
 #
 # Logger
@@ -51,39 +62,39 @@ from esmond.util import get_logger
 log = get_logger(__name__)
 
 #
-# Cassandra db connection
+# Storage backend connection
 #
-try:
-    db = CASSANDRA_DB(get_config(get_config_path()))
+def set_db(backend):
+    """
+    Use backend for all time series reads and writes. Called when the
+    connection is made, tools like the benchmarks use it to swap in a 
+    local backend.
+    """
+    global db
+    global EVENT_TYPE_CF_MAP;
+    db = backend
+    #
+    # Column families
+    #
     EVENT_TYPE_CF_MAP = {
-            'histogram': db.raw_cf,
-            'integer': db.rate_cf,
-            'json': db.raw_cf,
-            'percentage': db.agg_cf,
-            'subinterval': db.raw_cf,
-            'float': db.agg_cf
-        }
+        'histogram': db.raw_cf,
+        'integer': db.rate_cf,
+        'json': db.raw_cf,
+        'percentage': db.agg_cf,
+        'subinterval': db.raw_cf,
+        'float': db.agg_cf
+    }
+
+try:
+    set_db(get_storage_backend(get_config(get_config_path())))
 except ConnectionException as e:
     #try to get a cassandra connection but don't sweat if cant get one now
     #corrects race condition with cassandra boot and esmond boot
     db = None
 
 def check_connection():
-    global db
-    global EVENT_TYPE_CF_MAP;
     if not db:
-        db = CASSANDRA_DB(get_config(get_config_path()))
-        #
-        # Column families
-        #
-        EVENT_TYPE_CF_MAP = {
-            'histogram': db.raw_cf,
-            'integer': db.rate_cf,
-            'json': db.raw_cf,
-            'percentage': db.agg_cf,
-            'subinterval': db.raw_cf,
-            'float': db.agg_cf
-        }
+        set_db(get_storage_backend(get_config(get_config_path())))
     
 #
 # Bases, etc
@@ -336,6 +347,66 @@ class PSPaginator(pagination.LimitOffsetPagination):
         #return response with unmodified data and links in headers
         return Response(data, headers=headers)
 
+class PSTimeSeriesPaginator(PSPaginator):
+    """
+    Keyset pagination for time series. Instead of skipping offset results
+    the next page is a time slice starting just after the timestamp of the
+    last result returned, given in the cursor parameter of the next link.
+    Requests with an explicit offset keep the limit/offset behavior, as do
+    views that set offset_only. link_params are added to the next and 
+    previous links so later pages are read with the same parameters.
+    """
+    cursor_query_param = CURSOR_FILTER
+    cursor_mode = False
+    next_cursor = None
+    offset_only = False
+    link_params = None
+
+    def get_cursor(self, request):
+        if self.cursor_query_param not in request.query_params:
+            return None
+        try:
+            return int(request.query_params[self.cursor_query_param])
+        except ValueError:
+            raise ParseError(detail="Cursor parameter must be an integer")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.offset_only or (self.get_cursor(request) is None and self.offset_query_param in request.query_params):
+            self.cursor_mode = False
+            return super(PSTimeSeriesPaginator, self).paginate_queryset(queryset, request, view=view)
+
+        self.cursor_mode = True
+        self.request = request
+        self.limit = self.get_limit(request)
+        page = list(queryset[:self.limit])
+        self.next_cursor = None
+        if len(queryset) > self.limit and page:
+            self.next_cursor = page[-1]['ts']
+
+        return page
+
+    def add_link_params(self, url):
+        if url is None:
+            return None
+        for key, val in (self.link_params or {}).items():
+            url = replace_query_param(url, key, val)
+        return url
+
+    def get_next_link(self):
+        if not self.cursor_mode:
+            return self.add_link_params(super(PSTimeSeriesPaginator, self).get_next_link())
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.cursor_query_param, self.next_cursor)
+        return self.add_link_params(remove_query_param(url, self.offset_query_param))
+
+    def get_previous_link(self):
+        if not self.cursor_mode:
+            return self.add_link_params(super(PSTimeSeriesPaginator, self).get_previous_link())
+        # no way to page backwards from a cursor
+        return None
+
 class PSMetadataPaginator(PSPaginator):
     """
     Metadata API spec requires us to put pagination details in the first
@@ -434,47 +505,24 @@ class PSTimeSeriesObject(object):
         return datetime.datetime.utcfromtimestamp(float(self.time))
     
     def save(self):
-        # make sure we have a DB connection, throw exception otherwise
-        check_connection()
-        #verify object does not already exist
-        if EVENT_TYPE_CF_MAP[EVENT_TYPE_CONFIG[self.event_type]["type"]] != db.raw_cf:
-            existing = PSTimeSeriesObject.query_database(self.metadata_key, self.event_type, 'base', None, int(self.time), int(self.time), 1)
-            if(len(existing) > 0):
-                raise ConflictException(detail="Time series value already exists with event type %s at time %d" % (self.event_type, int(self.time)))
-
-        #Insert into cassandra
-        local_cache = {}
-        #NOTE: Ordering in model allows statistics to go last. If this ever changes may need to update code here.
-        #check that this event_type is defined
-        rawsql_cursor = connection.cursor()
-        with transaction.atomic():
-            rawsql_cursor.execute("SELECT summary_type, summary_window FROM ps_event_types WHERE event_type=%s AND metadata_id=(SELECT id FROM ps_metadata WHERE metadata_key=%s) ORDER BY summary_type", [self.event_type, self.metadata_key])
-            for et in rawsql_cursor.fetchall():
-                ts_obj = PSTimeSeriesObject(self.time,
-                                                self.value,
-                                                self.metadata_key,
-                                                event_type=self.event_type,
-                                                summary_type=et[0],
-                                                summary_window=et[1]
-                                                )
-                self.database_write(ts_obj, local_cache)
-            #make sqlite happy (mainly for unit tests not configured to use postgres)
-            if connection.vendor.startswith('sqlite'):
-                rawsql_cursor.execute("UPDATE ps_event_types SET time_updated='now' WHERE event_type=%s AND metadata_id=(SELECT id FROM ps_metadata WHERE metadata_key=%s)", [self.event_type, self.metadata_key])
-            else:
-                #update time. clear out microseconds since timestamp filters are only seconds and we want to allow exact matches
-                rawsql_cursor.execute("UPDATE ps_event_types SET time_updated=now() WHERE event_type=%s AND metadata_id=(SELECT id FROM ps_metadata WHERE metadata_key=%s)", [self.event_type, self.metadata_key])
+        batch = PSTimeSeriesBatch(self.metadata_key)
+        batch.add(self)
+        batch.save()
     
     @staticmethod
     def row_prefix(event_type):
         return ['ps', event_type.replace('-', '_') ]
     
     @staticmethod
-    def query_database(metadata_key, event_type, summary_type, freq, begin_time, end_time, max_results):
+    def iter_database(metadata_key, event_type, summary_type, freq, begin_time, end_time, max_results):
+        """
+        Returns a generator over the requested time series that reads from
+        cassandra as it is consumed. Validation happens up front so errors
+        are raised before any data is streamed.
+        """
         # make sure we have a DB connection, throw exception otherwise
         check_connection()
         
-        results = []
         datapath = PSTimeSeriesObject.row_prefix(event_type)
         datapath.append(metadata_key)
         if(summary_type != 'base'):
@@ -503,13 +551,13 @@ class PSTimeSeriesObject(object):
                   (metadata_key, event_type, summary_type, freq, begin_time, end_time, begin_millis, end_millis, col_fam, datapath))
 
         if col_fam == db.agg_cf:
-            results = db.query_aggregation_timerange(path=datapath, freq=freq,
+            results = db.iter_aggregation_timerange(path=datapath, freq=freq,
                    cf='average', ts_min=begin_millis, ts_max=end_millis, column_count=max_results)
         elif col_fam == db.rate_cf:
-            results = db.query_baserate_timerange(path=datapath, freq=freq,
+            results = db.iter_baserate_timerange(path=datapath, freq=freq,
                     cf='delta', ts_min=begin_millis, ts_max=end_millis, column_count=max_results)
         elif col_fam == db.raw_cf:
-            results = db.query_raw_data(path=datapath, freq=freq,
+            results = db.iter_raw_data(path=datapath, freq=freq,
                    ts_min=begin_millis, ts_max=end_millis, column_count=max_results)
         else:
             log.debug("action=query_timeseries.end status=-1")
@@ -517,6 +565,26 @@ class PSTimeSeriesObject(object):
 
         return results
 
+    @staticmethod
+    def query_database(metadata_key, event_type, summary_type, freq, begin_time, end_time, max_results):
+        key = (metadata_key, event_type, summary_type, freq, begin_time, end_time, max_results)
+        #the generation is taken before reading so results read while a
+        #write is flushed are cached under the old generation
+        cache_key = timeseries_cache.key(key)
+        results = timeseries_cache.get(cache_key)
+        if results is None:
+            #identical concurrent queries share one read. the shared
+            #list is copied since the serializer modifies results in place
+            results = query_flight.do(cache_key, PSTimeSeriesObject._read_database, key, cache_key)
+            results = [dict(r) for r in results]
+        return results
+
+    @staticmethod
+    def _read_database(key, cache_key):
+        results = list(PSTimeSeriesObject.iter_database(*key))
+        timeseries_cache.set(cache_key, results)
+        return results
+
     def database_write(self, ts_obj, local_cache):
         # make sure we have a DB connection, throw exception otherwise
         check_connection()
@@ -537,6 +605,11 @@ class PSTimeSeriesObject(object):
         if col_family is None:
             col_family = EVENT_TYPE_CF_MAP[data_type]
         
+        #histogram aggregations may be summed in histogram_cache and 
+        #written later
+        if histogram_cache.add(db, validator, ts_obj):
+            return
+        
         #perform initial summarization
         if  ts_obj.summary_type== "aggregation":
             validator.aggregation(db, ts_obj, local_cache)
@@ -544,6 +617,8 @@ class PSTimeSeriesObject(object):
             validator.average(db, ts_obj)
         elif ts_obj.summary_type == "statistics":
             validator.statistics(db, ts_obj, local_cache)
+        elif ts_obj.summary_type == "sketch":
+            validator.sketch(db, ts_obj, local_cache)
         
         #insert the data in the target column-family
         log.debug("action=create_timeseries.start md_key=%s event_type=%s summ_type=%s summ_win=%s ts=%s val=%s cf=%s datapath=%s freq=%s base_freq=%s" %
@@ -555,12 +630,410 @@ class PSTimeSeriesObject(object):
             agg = AggregationBin(path=ts_obj.datapath,
                     ts=ts_obj.get_datetime(), val=ts_obj.value["numerator"],
                     freq=ts_obj.freq, base_freq=ts_obj.base_freq, count=ts_obj.value["denominator"])
-            db.aggs.insert(agg.get_key(), {agg.ts_to_jstime(): {'val': agg.val, str(agg.base_freq): agg.count}})
+            db.update_aggregation_bin(agg)
         elif col_family == db.raw_cf:
             rawdata = RawRateData(path=ts_obj.datapath, ts=ts_obj.get_datetime(), val=ts_obj.value, freq=ts_obj.freq)
             db.set_raw_data(rawdata)
         log.debug("action=create_timeseries.end status=0")
 
+class EventTypeRegistry(object):
+    """
+    Bounded process-local cache of metadata_key => event type => list of
+    (summary_type, summary_window) tuples. The event types of a metadata
+    object almost never change after it is created so this keeps the 
+    relational database off of the write path and lets reads skip 
+    cassandra for summaries that do not exist. Entries are loaded lazily,
+    expire after ttl seconds so other processes eventually see changes,
+    and are evicted least recently used first once max_entries is hit.
+    Unknown metadata keys are not cached so new metadata is picked up
+    right away.
+    """
+    max_entries = 10000
+    ttl = 300
+
+    def __init__(self):
+        self._cache = LRUCache(max_entries=self.max_entries, max_age=self.ttl)
+
+    def _load(self, metadata_key):
+        #NOTE: Ordering allows statistics to go last. If this ever changes may need to update code in PSTimeSeriesBatch.
+        summaries = collections.OrderedDict()
+        rawsql_cursor = connection.cursor()
+        rawsql_cursor.execute("SELECT event_type, summary_type, summary_window FROM ps_event_types WHERE metadata_id=(SELECT id FROM ps_metadata WHERE metadata_key=%s) ORDER BY event_type, summary_type", [metadata_key])
+        for et in rawsql_cursor.fetchall():
+            summaries.setdefault(et[0], []).append((et[1], int(et[2])))
+        return summaries
+
+    def get(self, metadata_key):
+        """
+        Returns a dict of event type => list of (summary_type, summary_window)
+        for the given metadata key. The dict is empty if the key is unknown.
+        """
+        summaries = self._cache.get(metadata_key)
+        if summaries is None:
+            summaries = self._load(metadata_key)
+            if summaries:
+                self._cache[metadata_key] = summaries
+        return summaries
+
+    def has_summary(self, metadata_key, event_type, summary_type, summary_window):
+        """
+        Returns None if the metadata key is unknown, otherwise whether the
+        given summary is defined for the event type.
+        """
+        summaries = self.get(metadata_key)
+        if not summaries:
+            return None
+        return (summary_type, int(summary_window)) in summaries.get(event_type, [])
+
+    def invalidate(self, metadata_key=None):
+        if metadata_key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(metadata_key)
+
+event_type_registry = EventTypeRegistry()
+registry.add_cache('event_types', event_type_registry._cache)
+
+class HistogramAggregationCache(object):
+    """
+    Write-behind cache of histogram aggregation bins keyed on 
+    (metadata_key, event_type, freq, bin ts). Instead of reading the bin
+    back from cassandra for every histogram, the histograms posted for a 
+    bin are summed here and only that sum is kept. Every 
+    histogram_flush_interval seconds the pending bins are written: each 
+    bin is read once, the sum is added to it and it is written back along
+    with the statistics summary of the same window. Since only the sums 
+    are cached, never a copy of the whole bin, a process can't overwrite 
+    what other processes merged in the meantime.
+
+    Bins are flushed at the end of a batch once the interval has passed,
+    when the process exits and, least recently used first, once more than
+    histogram_cache_max_entries bins are pending. With an interval of 0
+    (the default) nothing is cached and bins are merged as they are 
+    written.
+    """
+
+    def __init__(self, config):
+        self.flush_interval = config.histogram_flush_interval
+        self.max_entries = config.histogram_cache_max_entries
+        self._pending = collections.OrderedDict()
+        self._oldest = None
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self):
+        return self.flush_interval > 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, db, validator, obj):
+        """
+        Takes the aggregation summary of a histogram, or the statistics 
+        summary of a window that is aggregated too, and returns True. 
+        Returns False for anything that should be written right away.
+        """
+        if not self.enabled or not isinstance(validator, HistogramValidator) or obj.summary_window == 0:
+            return False
+        if obj.summary_type == 'statistics':
+            #the statistics of a window are worked out from its aggregation
+            if not event_type_registry.has_summary(obj.metadata_key, obj.event_type, 'aggregation', obj.summary_window):
+                return False
+        elif obj.summary_type != 'aggregation':
+            return False
+
+        key = (obj.metadata_key, obj.event_type, obj.freq, obj.time)
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                if self.max_entries and len(self._pending) >= self.max_entries:
+                    self._flush(db, [self._pending.popitem(last=False)])
+                if not self._pending:
+                    self._oldest = time.time()
+                entry = self._pending[key] = {'hist': {}, 'statistics': False}
+            else:
+                self._pending.move_to_end(key)
+            if obj.summary_type == 'aggregation':
+                validator._aggregation(obj.value, entry['hist'])
+            else:
+                entry['statistics'] = True
+        return True
+
+    def flush(self, db, force=False):
+        """
+        Write the pending bins once the first of them has waited the flush
+        interval, or right away if force is set.
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            if not force and time.time() - self._oldest < self.flush_interval:
+                return
+            entries = list(self._pending.items())
+            self._pending.clear()
+            self._flush(db, entries)
+
+    def _flush(self, db, entries):
+        # called with the lock held, so a bin isn't read by another thread
+        # before this one's write of it has been sent
+        metadata_keys = set()
+        for (metadata_key, event_type, freq, ts), entry in entries:
+            agg_obj = PSTimeSeriesObject(ts, None, metadata_key, event_type=event_type,
+                summary_type='aggregation', summary_window=freq)
+            validator = TYPE_VALIDATOR_MAP[EVENT_TYPE_CONFIG[event_type]["type"]]
+            agg_hist = validator._get_histogram(db, agg_obj) or {}
+            agg_hist = validator._aggregation(entry['hist'], agg_hist)
+            db.set_raw_data(RawRateData(path=agg_obj.datapath, ts=agg_obj.get_datetime(),
+                val=agg_hist, freq=freq))
+            if entry['statistics']:
+                stat_obj = PSTimeSeriesObject(ts, None, metadata_key, event_type=event_type,
+                    summary_type='statistics', summary_window=freq)
+                db.set_raw_data(RawRateData(path=stat_obj.datapath, ts=stat_obj.get_datetime(),
+                    val=validator._statistics(agg_hist), freq=freq))
+            metadata_keys.add(metadata_key)
+        db.flush()
+        for metadata_key in metadata_keys:
+            timeseries_cache.invalidate(metadata_key)
+        log.debug("action=histogram_cache.flush bins=%d" % len(entries))
+
+histogram_cache = HistogramAggregationCache(settings.ESMOND_SETTINGS)
+
+class TimeSeriesResultCache(object):
+    """
+    Read-through cache of query_database results keyed on (metadata_key,
+    event_type, summary_type, summary_window, begin, end, max_results).
+    Ranges that ended more than result_cache_immutable_after seconds ago 
+    are treated as immutable and kept for result_cache_immutable_ttl 
+    seconds, anything more recent (including open ended ranges) only for
+    result_cache_recent_ttl seconds. Results are kept in a bounded
+    process-local LRU and, if result_cache_shared_location is set, in the
+    'esmond_results' django cache so all processes share them.
+    Unless result_cache is set, caching is only on with the shared tier
+    since a process-local cache never sees the writes of other processes.
+
+    Writes bump a generation number per metadata key once they are 
+    flushed. The generation is part of the cache key, so a process never
+    reads back results older than its own writes. With the shared tier
+    the generation is shared too. Keys from key() are passed to get() and
+    set().
+
+    Local generations come from one counter for all metadata keys and only
+    the max_generations most recently written keys are tracked. Keys that
+    are not tracked get the generation of the last write that pushed a key
+    out, which is newer than anything the evicted keys had, so old results
+    stay unreachable.
+    """
+    shared_alias = 'esmond_results'
+    max_generations = 100000
+
+    def __init__(self, config):
+        self.recent_ttl = config.result_cache_recent_ttl
+        self.immutable_ttl = config.result_cache_immutable_ttl
+        self.immutable_after = config.result_cache_immutable_after
+        self._cache = LRUCache(max_entries=config.result_cache_max_entries,
+                               max_bytes=config.result_cache_max_bytes)
+        self._generations = LRUCache(max_entries=self.max_generations)
+        self._generation_counter = itertools.count(1)
+        self._generation_floor = 0
+        self._generation_lock = threading.Lock()
+        self._shared = None
+        if config.result_cache_shared_location:
+            try:
+                self._shared = caches[self.shared_alias]
+            except InvalidCacheBackendError as e:
+                log.error("action=result_cache.shared status=-1 error=%s" % e)
+        self.enabled = config.result_cache
+        if self.enabled is None:
+            self.enabled = self._shared is not None
+
+    def _generation(self, metadata_key):
+        if self._shared is not None:
+            return self._shared.get('esmond:gen:%s' % metadata_key, 0)
+        return self._generations.get(metadata_key, self._generation_floor)
+
+    def _shared_key(self, key):
+        return 'esmond:ts:%s' % hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def key(self, key):
+        """
+        Returns the cache key for a query key, which includes the current
+        generation of its metadata key
+        """
+        return key + (self._generation(key[0]),)
+
+    def ttl(self, key):
+        """
+        Returns how many seconds results for key can be cached
+        """
+        freq, end_time = key[3], key[5]
+        if end_time is None:
+            return self.recent_ttl
+        if end_time + int(freq or 0) < time.time() - self.immutable_after:
+            return self.immutable_ttl
+        return self.recent_ttl
+
+    def get(self, key):
+        """
+        Returns a copy of the cached results for key or None
+        """
+        if not self.enabled:
+            return None
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] <= time.time():
+            self._cache.pop(key)
+            entry = None
+        if entry is None and self._shared is not None:
+            entry = self._shared.get(self._shared_key(key))
+            if entry is not None:
+                self._cache[key] = entry
+        if entry is None:
+            return None
+        #the serializer modifies results in place
+        return [dict(r) for r in entry[1]]
+
+    def set(self, key, results):
+        if not self.enabled:
+            return
+        ttl = self.ttl(key)
+        if ttl <= 0:
+            return
+        entry = (time.time() + ttl, [dict(r) for r in results])
+        self._cache[key] = entry
+        if self._shared is not None:
+            self._shared.set(self._shared_key(key), entry, ttl)
+
+    def invalidate(self, metadata_key):
+        """
+        Makes all cached results for metadata_key unreachable. They age
+        out of the caches on their own. Call after the writes are flushed.
+        """
+        if self._shared is not None:
+            gen_key = 'esmond:gen:%s' % metadata_key
+            if not self._shared.add(gen_key, 1, None):
+                try:
+                    self._shared.incr(gen_key)
+                except ValueError:
+                    self._shared.set(gen_key, 1, None)
+        with self._generation_lock:
+            generation = next(self._generation_counter)
+            evictions = self._generations.evictions
+            self._generations[metadata_key] = generation
+            if self._generations.evictions != evictions:
+                self._generation_floor = generation
+
+timeseries_cache = TimeSeriesResultCache(settings.ESMOND_SETTINGS)
+registry.add_cache('timeseries_results', timeseries_cache._cache)
+
+def _flush_histogram_cache():
+    if db is not None:
+        histogram_cache.flush(db, force=True)
+atexit.register(_flush_histogram_cache)
+
+#Coalesces identical timeseries queries running at the same time in this
+#process. query_flight.stats() has the counters.
+query_flight = SingleFlight()
+
+def _query_flight_metrics():
+    stats = query_flight.stats()
+    return [
+        ('esmond_query_calls_total', 'counter', 'Timeseries queries read from the database.', [((), stats['calls'])]),
+        ('esmond_query_coalesced_total', 'counter', 'Timeseries queries that waited on an identical query instead.', [((), stats['coalesced'])]),
+        ('esmond_query_in_flight', 'gauge', 'Timeseries queries being read from the database.', [((), stats['in_flight'])]),
+    ]
+registry.add_collector('query_flight', _query_flight_metrics)
+
+class PSTimeSeriesBatch(object):
+    """
+    Writes a group of PSTimeSeriesObjects that share a metadata key. The
+    event types and summaries are looked up once for the whole batch, 
+    conflicts are checked with one range query per event type and 
+    time_updated is set with one UPDATE per event type, so the number of
+    round trips does not grow with the number of values written. Nothing
+    is written unless every value passes the conflict check.
+    """
+    def __init__(self, metadata_key):
+        self.metadata_key = metadata_key
+        self.objs = []
+
+    def add(self, obj):
+        if obj.event_type not in EVENT_TYPE_CONFIG:
+            raise ParseError(detail="Invalid event type %s" % obj.event_type)
+        self.objs.append(obj)
+
+    @property
+    def event_types(self):
+        event_types = []
+        for obj in self.objs:
+            if obj.event_type not in event_types:
+                event_types.append(obj.event_type)
+        return event_types
+
+    def check_conflicts(self):
+        """
+        Verify none of the values already exist, either in the database
+        or more than once in the batch. Only types stored as counters can
+        conflict, raw values are just overwritten. The existing values of
+        each event type are read concurrently.
+        """
+        checks = []
+        for event_type in self.event_types:
+            if EVENT_TYPE_CF_MAP[EVENT_TYPE_CONFIG[event_type]["type"]] == db.raw_cf:
+                continue
+            times = [int(obj.time) for obj in self.objs if obj.event_type == event_type]
+            seen = set()
+            for t in times:
+                if t in seen:
+                    raise ConflictException(detail="Time series value provided more than once with event type %s at time %d" % (event_type, t))
+                seen.add(t)
+            checks.append((event_type, seen))
+        
+        def existing_times(check):
+            event_type, seen = check
+            existing = PSTimeSeriesObject.iter_database(self.metadata_key, event_type, 'base', None, min(seen), max(seen), None)
+            return [int(e['ts'] // 1000) for e in existing]
+        
+        for (event_type, seen), existing in zip(checks, db.fan_out(existing_times, checks)):
+            for t in existing:
+                if t in seen:
+                    raise ConflictException(detail="Time series value already exists with event type %s at time %d" % (event_type, t))
+
+    def save(self):
+        # make sure we have a DB connection, throw exception otherwise
+        check_connection()
+        if not self.objs:
+            return
+        
+        self.check_conflicts()
+        
+        #check that the event types are defined
+        summaries = event_type_registry.get(self.metadata_key)
+        
+        #Insert into cassandra. The summaries of all objects in the batch 
+        #share local_cache since nothing is flushed until the batch ends.
+        rawsql_cursor = connection.cursor()
+        local_cache = {}
+        with transaction.atomic():
+            for obj in self.objs:
+                for summary_type, summary_window in summaries.get(obj.event_type, []):
+                    ts_obj = PSTimeSeriesObject(obj.time,
+                                                    obj.value,
+                                                    self.metadata_key,
+                                                    event_type=obj.event_type,
+                                                    summary_type=summary_type,
+                                                    summary_window=summary_window
+                                                    )
+                    obj.database_write(ts_obj, local_cache)
+            for event_type in self.event_types:
+                #make sqlite happy (mainly for unit tests not configured to use postgres)
+                if connection.vendor.startswith('sqlite'):
+                    rawsql_cursor.execute("UPDATE ps_event_types SET time_updated='now' WHERE event_type=%s AND metadata_id=(SELECT id FROM ps_metadata WHERE metadata_key=%s)", [event_type, self.metadata_key])
+                else:
+                    #update time. clear out microseconds since timestamp filters are only seconds and we want to allow exact matches
+                    rawsql_cursor.execute("UPDATE ps_event_types SET time_updated=now() WHERE event_type=%s AND metadata_id=(SELECT id FROM ps_metadata WHERE metadata_key=%s)", [event_type, self.metadata_key])
+        
+        #write the histogram bins that are due
+        histogram_cache.flush(db)
+
 #
 # Base endpoint(s) 
 # (GET and POST) /archive/
@@ -715,6 +1188,9 @@ class ArchiveSerializer(UtilMixin, serializers.ModelSerializer):
         for md_param in md_params:
             PSMetadataParameters.objects.create(metadata=metadata, **md_param)
         
+        #make sure writes and reads see the new event types
+        event_type_registry.invalidate(metadata.metadata_key)
+        
         return metadata
     
     def deserialize_event_types(self, event_types):
@@ -943,6 +1419,7 @@ class ArchiveViewset(mixins.CreateModelMixin,
             raise ParseError(detail="The 'data' element must be an array")
         
         #validate 
+        batch = PSTimeSeriesBatch(kwargs["metadata_key"])
         i = 0
         for ts_item in request_data["data"]:
             i += 1
@@ -960,13 +1437,16 @@ class ArchiveViewset(mixins.CreateModelMixin,
                     raise ParseError(detail="Missing event-type field at data item %d in value %d " % (i, j))
                 if DATA_KEY_VALUE not in val_item:
                     raise ParseError(detail="Missing %s field at data item %d in value %d " % (DATA_KEY_VALUE, i, j))
-                tmp_obj = { DATA_KEY_TIME: ts, DATA_KEY_VALUE: val_item[DATA_KEY_VALUE] }
                 obj = PSTimeSeriesObject(ts, val_item[DATA_KEY_VALUE], kwargs["metadata_key"])
                 obj.event_type =  val_item['event-type']
-                obj.save()
-                
+                batch.add(obj)
+        
+        #everything validated so write the whole batch
+        batch.save()
+        
         #everything succeeded so save to database
         db.flush()
+        timeseries_cache.invalidate(kwargs["metadata_key"])
 
         return Response('', status.HTTP_201_CREATED)
 
@@ -1076,6 +1556,65 @@ class TimeSeriesSerializer(serializers.Serializer):
             
         return obj
 
+class NDJSONRenderer(renderers.BaseRenderer):
+    """
+    Newline delimited JSON - one time series object per line. Only
+    used by the streaming timeseries responses, but renders regular
+    payloads (like errors) too so content negotiation works.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if not isinstance(data, list):
+            data = [data]
+        return ''.join([json.dumps(d, separators=(',', ':')) + '\n' for d in data]).encode('utf-8')
+
+class TimeSeriesStream(object):
+    """
+    Encodes time series objects as they come off of the storage iterator
+    so a response never has the full result set in memory. Objects are
+    written out in chunks of chunk_size to keep the number of writes to
+    the WSGI server down.
+    """
+    chunk_size = 500
+
+    def __init__(self, results, fmt='json'):
+        self.results = results
+        self.fmt = fmt
+        self.serializer = TimeSeriesSerializer()
+
+    @property
+    def content_type(self):
+        if self.fmt == NDJSONRenderer.format:
+            return NDJSONRenderer.media_type
+        return 'application/json'
+
+    def _encode(self, obj):
+        return json.dumps(self.serializer.to_representation(obj), separators=(',', ':'))
+
+    def __iter__(self):
+        if self.fmt == NDJSONRenderer.format:
+            prefix, sep, suffix, trailer = '', '', '\n', ''
+        else:
+            prefix, sep, suffix, trailer = '[', ',', '', ']'
+
+        chunk = [prefix]
+        first = True
+        for obj in self.results:
+            if not first:
+                chunk.append(sep)
+            chunk.append(self._encode(obj) + suffix)
+            first = False
+            if len(chunk) >= self.chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+        chunk.append(trailer)
+        yield ''.join(chunk)
+
 class TimeSeriesViewset(UtilMixin, FilterUtilMixin, ViewsetBase):
     """
     The queryset attribute on this non-model resource is fake.
@@ -1085,7 +1624,8 @@ class TimeSeriesViewset(UtilMixin, FilterUtilMixin, ViewsetBase):
     """
     queryset = _get_ersatz_esmond_api_queryset('timeseries')
     serializer_class = TimeSeriesSerializer # mollify viewset
-    pagination_class = PSPaginator
+    pagination_class = PSTimeSeriesPaginator
+    renderer_classes = (renderers.JSONRenderer, renderers.BrowsableAPIRenderer, NDJSONRenderer)
 
     def retrieve(self, request, **kwargs):
         """
@@ -1120,9 +1660,12 @@ class TimeSeriesViewset(UtilMixin, FilterUtilMixin, ViewsetBase):
             if summary_type not in SUMMARY_TYPES:
                 raise ParseError(detail="Invalid summary type '%s'" % summary_type)
         freq = None
+        plan = request.query_params.get(PLAN_FILTER)
+        if plan is not None and plan != 'auto':
+            raise ParseError(detail="Invalid plan '%s'. Only 'auto' is supported" % plan)
         if 'summary_window' in kwargs:
             freq = self.valid_summary_window(kwargs['summary_window'])
-        elif summary_type != 'base':
+        elif summary_type != 'base' and plan is None:
            return self.summary_details(request, metadata_key, event_type, summary_type)
             
         #Handle time filters
@@ -1130,17 +1673,64 @@ class TimeSeriesViewset(UtilMixin, FilterUtilMixin, ViewsetBase):
         begin_time = time_result['begin']
         end_time = time_result['end']
         
-        #Handle pagination
-        ##set high limit by default. This is a performance gain so pycassa doesn't have to count
-        max_results = 1000000 
-        #if specified, make sure we grab enough results so can handle offset
-        if LIMIT_FILTER in request.query_params:
-            max_results = int(request.query_params[LIMIT_FILTER])
-            if OFFSET_FILTER in request.query_params:
-                max_results += int(request.query_params[OFFSET_FILTER])
-                
+        #let the planner pick the summary to read if asked to
+        if plan is not None:
+            summary_type, freq = self.plan_summary(request, metadata_key, event_type, summary_type, begin_time, end_time)
+            self.planned_summary = (SUMMARY_TYPES[summary_type], freq or '0')
+        
+        #no need to go to cassandra for a summary that is not defined
+        if event_type_registry.has_summary(metadata_key, event_type, SUMMARY_TYPES[summary_type], freq or 0) is False:
+            return self.paginator.get_paginated_response(self.paginator.paginate_queryset([], request, view=self))
+        
+        #sketches in the range can be merged into a single result
+        if SUMMARY_TYPES[summary_type] == 'sketch' and request.query_params.get(MERGE_FILTER, '').lower() in ('1', 'true', 'yes'):
+            return self.merged_sketch_response(request, metadata_key, event_type, summary_type, freq, begin_time, end_time)
+        
+        #Handle pagination. Only read as many points as are needed to fill
+        #the requested page plus one more so we know if there is a next page.
+        limit = self.paginator.get_limit(request)
+        offset = self.paginator.get_offset(request)
+        
+        #downsampled pages use offsets since a cursor would start the next
+        #page part way through a bucket. The resolution and start time are
+        #put in the page links so every page uses the same buckets as the
+        #first, even for a time-range relative to now.
+        cursor = self.paginator.get_cursor(request)
+        downsampler, resolution = self.get_downsampler(request, event_type, summary_type, begin_time, end_time)
+        if downsampler is not None:
+            if cursor is not None:
+                raise ParseError(detail="The %s parameter can not be used when downsampling, use %s instead" % (CURSOR_FILTER, OFFSET_FILTER))
+            self.paginator.offset_only = True
+            self.paginator.link_params = {RESOLUTION_FILTER: resolution}
+            if begin_time:
+                self.paginator.link_params[TIME_START_FILTER] = begin_time
+        
+        #a cursor is the timestamp of the last result of the previous page, 
+        #so the query is a slice starting right after it.
+        if cursor is not None:
+            offset = 0
+            begin_time = max(begin_time, cursor + 1)
+            if end_time is not None and begin_time > end_time:
+                return self.paginator.get_paginated_response(self.paginator.paginate_queryset([], request, view=self))
+        
+        #downsample the whole range as it is read if asked to
+        fmt = getattr(request.accepted_renderer, 'format', None)
+        if downsampler is not None:
+            results = downsampler(PSTimeSeriesObject.iter_database(metadata_key, event_type, summary_type, freq, begin_time, end_time, None))
+            if fmt == NDJSONRenderer.format or self.stream_requested(request):
+                return self.streaming_response(results, fmt, offset, limit)
+            results = list(itertools.islice(results, offset + limit + 1))
+            data = self.serializer_class(results, many=True).data
+            data = self.paginator.paginate_queryset(data, self.request, view=self)
+            return self.paginator.get_paginated_response(data)
+        
+        #stream the response if asked to
+        if fmt == NDJSONRenderer.format or self.stream_requested(request):
+            results = PSTimeSeriesObject.iter_database(metadata_key, event_type, summary_type, freq, begin_time, end_time, offset + limit)
+            return self.streaming_response(results, fmt, offset, limit)
+        
         #send query
-        results = PSTimeSeriesObject.query_database(metadata_key, event_type, summary_type, freq, begin_time, end_time, max_results)
+        results = PSTimeSeriesObject.query_database(metadata_key, event_type, summary_type, freq, begin_time, end_time, offset + limit + 1)
         #serialize result
         data = self.serializer_class(results, many=True).data
         #paginate result
@@ -1149,6 +1739,156 @@ class TimeSeriesViewset(UtilMixin, FilterUtilMixin, ViewsetBase):
         #return response with pagination headers set
         return self.paginator.get_paginated_response(data)
 
+    def plan_summary(self, request, metadata_key, event_type, summary_type, begin_time, end_time):
+        """
+        Query planner. Returns the (summary_type, summary_window) to read
+        for the time range: the coarsest window registered for the event
+        type that still gives at least the requested number of points 
+        (the plan-points parameter, or the page limit). Base requests 
+        are answered from the summary in PLAN_SUMMARY_TYPES and only read
+        base data if no window is fine grained enough. Other summary types
+        keep their type and only the window is chosen. The points 
+        parameter is left to downsampling.
+        """
+        if begin_time == 0:
+            raise ParseError(detail="A start time or time range is required when using the %s parameter" % PLAN_FILTER)
+        if end_time is None:
+            end_time = int(time.time())
+        if PLAN_POINTS_FILTER in request.query_params:
+            points = self.valid_downsample_param(request.query_params, PLAN_POINTS_FILTER)
+        else:
+            points = self.paginator.get_limit(request)
+        resolution = (end_time - begin_time)/float(points)
+        
+        if summary_type == 'base':
+            target = PLAN_SUMMARY_TYPES.get(EVENT_TYPE_CONFIG[event_type]["type"])
+        else:
+            target = SUMMARY_TYPES[summary_type]
+        summaries = event_type_registry.get(metadata_key).get(event_type, [])
+        windows = [w for t, w in summaries if t == target]
+        fine_enough = [w for w in windows if w <= resolution]
+        if fine_enough:
+            window = max(fine_enough)
+        elif summary_type != 'base' and windows:
+            window = min(windows)
+        else:
+            return 'base', None
+        if window == 0 and target != 'base' and summary_type == 'base':
+            return 'base', None
+        
+        return INVERSE_SUMMARY_TYPES[target], str(window)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(TimeSeriesViewset, self).finalize_response(request, response, *args, **kwargs)
+        planned = getattr(self, 'planned_summary', None)
+        if planned is not None:
+            response[SUMMARY_TYPE_HEADER] = planned[0]
+            response[SUMMARY_WINDOW_HEADER] = planned[1]
+        return response
+
+    def get_downsampler(self, request, event_type, summary_type, begin_time, end_time):
+        """
+        Returns a function that downsamples a result iterator as given by
+        the resolution (bucket width in seconds) or points (maximum number
+        of points for the time range) parameters and the resolution used,
+        or (None, None) if neither was given. The downsample parameter 
+        selects the method for numeric types and defaults to average. 
+        Buckets start at the beginning of the time range, so a range split
+        into as many buckets as fit the points never gets an extra one.
+        """
+        params = request.query_params
+        if RESOLUTION_FILTER not in params and POINTS_FILTER not in params:
+            return None, None
+        
+        data_type = EVENT_TYPE_CONFIG[event_type]["type"]
+        if SUMMARY_TYPES[summary_type] not in DOWNSAMPLE_TYPES.get(data_type, []):
+            raise ParseError(detail="Downsampling is not supported for %s with summary type %s" % (event_type, summary_type))
+        method = params.get(DOWNSAMPLE_FILTER, 'average')
+        if method not in downsample.DOWNSAMPLE_METHODS:
+            raise ParseError(detail="Invalid downsample method '%s'. Must be one of %s" % (method, ', '.join(sorted(downsample.DOWNSAMPLE_METHODS))))
+        
+        if RESOLUTION_FILTER in params:
+            resolution = self.valid_downsample_param(params, RESOLUTION_FILTER)
+        else:
+            points = self.valid_downsample_param(params, POINTS_FILTER)
+            if begin_time == 0:
+                raise ParseError(detail="A start time or time range is required when using the %s parameter" % POINTS_FILTER)
+            if end_time is None:
+                end_time = int(time.time())
+            if data_type == 'histogram':
+                buckets = points
+            else:
+                buckets = downsample.max_buckets(method, points)
+            if buckets < 1:
+                raise ParseError(detail="The %s parameter must be at least 2 for the %s method" % (POINTS_FILTER, method))
+            resolution = int(math.ceil((end_time - begin_time + 1)/float(buckets)))
+        
+        if data_type == 'histogram':
+            downsampler = downsample.histogram
+        else:
+            downsampler = downsample.DOWNSAMPLE_METHODS[method]
+        origin = begin_time*1000
+        return (lambda results: downsampler(results, resolution*1000, origin)), resolution
+
+    def valid_downsample_param(self, params, name):
+        try:
+            val = int(params[name])
+        except ValueError:
+            raise ParseError(detail="The %s parameter must be an integer" % name)
+        if val <= 0:
+            raise ParseError(detail="The %s parameter must be greater than 0" % name)
+        return val
+
+    def merged_sketch_response(self, request, metadata_key, event_type, summary_type, freq, begin_time, end_time):
+        """
+        Merges every sketch in the time range and returns the statistics 
+        of the merged sketch as a single result with the time of the 
+        first sketch. The percentiles returned can be set with the 
+        quantiles parameter as a comma separated list.
+        """
+        quantiles = HistogramValidator.quantiles
+        if QUANTILES_FILTER in request.query_params:
+            try:
+                quantiles = sorted(int(q) for q in request.query_params[QUANTILES_FILTER].split(','))
+            except ValueError:
+                raise ParseError(detail="Quantiles must be a comma separated list of integers")
+            if quantiles[0] < 0 or quantiles[-1] > 100:
+                raise ParseError(detail="Quantiles must be between 0 and 100")
+        
+        merged = None
+        ts = None
+        for result in PSTimeSeriesObject.iter_database(metadata_key, event_type, summary_type, freq, begin_time, end_time, None):
+            if not result['val']:
+                continue
+            sketch = DDSketch.from_dict(result['val'])
+            if merged is None:
+                merged = sketch
+                ts = result['ts']
+            else:
+                try:
+                    merged.merge(sketch)
+                except ValueError as e:
+                    raise ParseError(detail=str(e))
+        
+        results = []
+        if merged is not None:
+            results.append({'ts': ts, 'val': merged.statistics(quantiles)})
+        data = self.serializer_class(results, many=True).data
+        data = self.paginator.paginate_queryset(data, self.request, view=self)
+        return self.paginator.get_paginated_response(data)
+
+    def stream_requested(self, request):
+        return request.query_params.get(STREAM_FILTER, '').lower() in ('1', 'true', 'yes')
+
+    def streaming_response(self, results, fmt, offset, limit):
+        """
+        Applies offset and limit to the storage iterator and streams the
+        encoded objects back. Pagination link headers are not set since 
+        the length of the result is not known until it has been sent.
+        """
+        results = itertools.islice(results, offset, offset + limit)
+        stream = TimeSeriesStream(results, fmt)
+        return StreamingHttpResponse(stream, content_type=stream.content_type)
 
     def create(self, request, **kwargs):
         """
@@ -1210,6 +1950,7 @@ class TimeSeriesViewset(UtilMixin, FilterUtilMixin, ViewsetBase):
         #everything succeeded so save to database. 
         #do this here as opposed to in obj.save() for performance reasons.
         db.flush()
+        timeseries_cache.invalidate(kwargs["metadata_key"])
         
         return Response('', status.HTTP_201_CREATED)
 
@@ -0,0 +1,123 @@
+'''
+Server side downsampling of time series results. Each downsampler takes an
+iterator over time series results in time order (dicts with 'ts' in
+milliseconds and 'val'), the bucket width in milliseconds and the time
+the first bucket starts at (the start of the requested range), and yields
+the downsampled results.
+At most two buckets of points are held at a time so results can be
+streamed straight from the storage iterator.
+'''
+
+'''
+_buckets: Groups consecutive results by bucket and yields (bucket start, points)
+'''
+def _buckets(results, resolution, origin):
+    start = None
+    points = []
+    for result in results:
+        if result['val'] is None:
+            continue
+        ts = result['ts'] - (result['ts'] - origin) % resolution
+        if ts != start:
+            if points:
+                yield start, points
+            start = ts
+            points = []
+        points.append(result)
+    if points:
+        yield start, points
+
+'''
+average: One point per bucket with the average value
+'''
+def average(results, resolution, origin=0):
+    for start, points in _buckets(results, resolution, origin):
+        yield {'ts': start, 'val': sum(float(p['val']) for p in points)/len(points)}
+
+'''
+minmax: The minimum and maximum points of each bucket in time order so the
+envelope of the series is kept. Buckets with a single point only yield it once.
+'''
+def minmax(results, resolution, origin=0):
+    for start, points in _buckets(results, resolution, origin):
+        low = min(points, key=lambda p: float(p['val']))
+        high = max(points, key=lambda p: float(p['val']))
+        if low is high:
+            yield low
+        elif low['ts'] <= high['ts']:
+            yield low
+            yield high
+        else:
+            yield high
+            yield low
+
+'''
+lttb: Largest-Triangle-Three-Buckets (Steinarsson 2013). Keeps the first and
+last points and from each bucket the point that forms the largest triangle
+with the point kept from the previous bucket and the average of the next
+bucket, which preserves the visual shape of the series. The last point is
+yielded on top of one point per bucket.
+'''
+def lttb(results, resolution, origin=0):
+    selected = None
+    current = []
+    for start, points in _buckets(results, resolution, origin):
+        if selected is None:
+            selected = points[0]
+            yield selected
+            current = points[1:]
+            continue
+        if current:
+            avg_ts = sum(p['ts'] for p in points)/float(len(points))
+            avg_val = sum(float(p['val']) for p in points)/len(points)
+            selected = _largest_triangle(selected, current, avg_ts, avg_val)
+            yield selected
+        current = points
+    if current:
+        yield current[-1]
+
+def _largest_triangle(a, points, c_ts, c_val):
+    a_ts = a['ts']
+    a_val = float(a['val'])
+    best = None
+    best_area = -1
+    for p in points:
+        area = abs((a_ts - c_ts)*(float(p['val']) - a_val) - (a_ts - p['ts'])*(c_val - a_val))
+        if area > best_area:
+            best = p
+            best_area = area
+    return best
+
+'''
+histogram: Merges the histograms of each bucket by adding the bucket counts
+'''
+def histogram(results, resolution, origin=0):
+    for start, points in _buckets(results, resolution, origin):
+        merged = {}
+        for p in points:
+            for k, v in p['val'].items():
+                merged[k] = merged.get(k, 0) + v
+        yield {'ts': start, 'val': merged}
+
+'''
+DOWNSAMPLE_METHODS: Maps the downsample parameter to the downsampler for
+numeric types. Histograms are always merged.
+'''
+DOWNSAMPLE_METHODS = {
+    "average": average,
+    "minmax": minmax,
+    "lttb": lttb
+}
+
+'''
+max_buckets: The most buckets a method can split a range into without
+yielding more than the given number of points, used to turn a requested
+number of points into a bucket width. minmax yields two points per bucket
+and lttb one per bucket plus the last point, so both need at least two.
+'''
+def max_buckets(method, points):
+    if method == 'minmax':
+        return points // 2
+    if method == 'lttb':
+        return points - 1
+    return points
@@ -177,7 +177,8 @@ SUMMARY_TYPES = {
     "base": "base",
     "aggregations": "aggregation",
     "statistics": "statistics",
-    "averages": "average"
+    "averages": "average",
+    "sketches": "sketch"
 }
 
 '''
@@ -240,7 +241,7 @@ ALLOWED_SUMMARIES: Indicates the types of summaries allowed by each type
 '''
 ALLOWED_SUMMARIES = {
     "float": ['aggregation', 'average'],
-    "histogram": ['aggregation', 'statistics'],
+    "histogram": ['aggregation', 'statistics', 'sketch'],
     "integer": ['aggregation', 'average'],
     "json": [],
     "percentage": ['aggregation'],
@@ -254,6 +255,30 @@ Example: 10000 means 4 decimal places
 '''
 DEFAULT_FLOAT_PRECISION=10000
 
+'''
+PLAN_SUMMARY_TYPES: The summary the query planner reads in place of base data
+for each type when the range is long enough that a summary window is fine
+grained enough. Types not listed are always read from base data.
+'''
+PLAN_SUMMARY_TYPES = {
+    "float": "average",
+    "histogram": "aggregation",
+    "integer": "average",
+    "percentage": "aggregation",
+}
+
+'''
+DOWNSAMPLE_TYPES: The types that can be downsampled and the summaries of each
+that can be. Numeric types use the requested downsample method and histograms
+are merged.
+'''
+DOWNSAMPLE_TYPES = {
+    "float": ['base', 'aggregation', 'average'],
+    "histogram": ['base', 'aggregation'],
+    "integer": ['base', 'aggregation', 'average'],
+    "percentage": ['base', 'aggregation'],
+}
+
 '''
 Constants that map to common filters
 '''
@@ -276,6 +301,19 @@ DATA_KEY_TIME = "ts"
 DATA_KEY_VALUE = "val"
 LIMIT_FILTER = "limit"
 OFFSET_FILTER = "offset"
+STREAM_FILTER = "stream"
+CURSOR_FILTER = "cursor"
+MERGE_FILTER = "merge"
+QUANTILES_FILTER = "quantiles"
+PLAN_FILTER = "plan"
+PLAN_POINTS_FILTER = "plan-points"
+DOWNSAMPLE_FILTER = "downsample"
+POINTS_FILTER = "points"
+RESOLUTION_FILTER = "resolution"
 RESERVED_GET_PARAMS = ["format", LIMIT_FILTER, OFFSET_FILTER, DNS_MATCH_RULE_FILTER, TIME_FILTER,
-                       TIME_START_FILTER, TIME_END_FILTER, TIME_RANGE_FILTER]
+                       TIME_START_FILTER, TIME_END_FILTER, TIME_RANGE_FILTER, STREAM_FILTER,
+                       CURSOR_FILTER, MERGE_FILTER, QUANTILES_FILTER, DOWNSAMPLE_FILTER,
+                       POINTS_FILTER, RESOLUTION_FILTER, PLAN_FILTER, PLAN_POINTS_FILTER]
+SUMMARY_TYPE_HEADER = "X-Esmond-Summary-Type"
+SUMMARY_WINDOW_HEADER = "X-Esmond-Summary-Window"
 
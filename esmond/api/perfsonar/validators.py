@@ -1,5 +1,7 @@
 import json
 import math
+
+import numpy as np
 from rest_framework.exceptions import ParseError
 
 '''
@@ -24,6 +26,9 @@ class DataValidator(object):
     def statistics(self, db, obj, cache):
         raise NotImplementedError()
 
+    def sketch(self, db, obj, cache):
+        raise NotImplementedError()
+
 '''
 FloatValidator: Simple validator for floating point numbers
 '''
@@ -50,45 +55,242 @@ class FloatValidator(DataValidator):
             obj.value["denominator"] = 0 #don't increase the count
         return
 '''
-Percentile: Used by histogram class to calculate percentiles using the NIST
-algorithm (http://www.itl.nist.gov/div898/handbook/prc/section2/prc252.htm)
+HistogramStats: Calculates statistics for a histogram using numpy. The 
+histogram is converted once to arrays of bucket values and counts sorted 
+by value. Percentiles are calculated from the cumulative counts using the 
+NIST algorithm (http://www.itl.nist.gov/div898/handbook/prc/section2/prc252.htm)
+and give the same results as the original pure python implementation, 
+including summing in the same order so floating point results match.
+Raises ValueError if a bucket is not a number.
 '''
-class Percentile(object):
+class HistogramStats(object):
+    
+    def __init__(self, hist):
+        self.keys = list(hist.keys())
+        self.values = np.fromiter(map(float, self.keys), dtype=np.float64, count=len(self.keys))
+        self.counts = np.fromiter(hist.values(), dtype=np.int64, count=len(self.keys))
+        self.sample_size = int(self.counts.sum())
+        order = np.argsort(self.values, kind='stable')
+        self.sorted_values = self.values[order]
+        self.sorted_counts = self.counts[order]
+        self.cumulative = np.cumsum(self.sorted_counts)
+    
+    @staticmethod
+    def _sum(arr):
+        #sum in order rather than pairwise so results match a python loop
+        if len(arr) == 0:
+            return 0.0
+        return float(np.cumsum(arr)[-1])
+    
+    def mean(self):
+        return self._sum(self.values * self.counts)/(1.0*self.sample_size)
+    
+    def mode(self):
+        return [float(self.keys[i]) for i in np.flatnonzero(self.counts == self.counts.max())]
     
-    def __init__(self, percentile, sample_size):
-        self.value = None
-        self.is_calculated = False
-        self.percentile = percentile
-        self.sample_size = sample_size
-        self.n = (self.percentile/100.0)*(sample_size + 1)
-        self.k = math.floor(self.n)
-        self.d = self.n - self.k
+    def minimum(self):
+        return float(self.sorted_values[0])
+    
+    def maximum(self):
+        return float(self.sorted_values[-1])
+    
+    def variance(self, mean=None):
+        if mean is None:
+            mean = self.mean()
+        #square with math.pow since its rounding can differ from x*x by 
+        #the last bit and we want to match the original results exactly
+        dev = self.sorted_values - mean
+        squares = np.fromiter((math.pow(x, 2) for x in dev.tolist()), dtype=np.float64, count=len(dev))
+        return self._sum(squares * self.sorted_counts)/self.sample_size
+    
+    def percentiles(self, quantiles):
+        """
+        Returns a list of (quantile, value) for the given quantiles, which 
+        must be in ascending order. When a percentile falls between two 
+        buckets the search for the next one starts at the later bucket,
+        same as the original implementation. Quantiles that can't be 
+        calculated from the sample are left out.
+        """
+        results = []
+        start = 0
+        num_buckets = len(self.cumulative)
+        for q in quantiles:
+            n = (q/100.0)*(self.sample_size + 1)
+            k = math.floor(n)
+            d = n - k
+            i = max(start, int(np.searchsorted(self.cumulative, k, side='left')))
+            if i >= num_buckets:
+                break
+            count = int(self.cumulative[i])
+            value = float(self.sorted_values[i])
+            if k == 0 or (count >= self.sample_size and k >= self.sample_size) or (k + d) < count:
+                start = i
+            elif i + 1 < num_buckets:
+                value += (d * (float(self.sorted_values[i+1]) - value))
+                start = i + 1
+            else:
+                break
+            results.append((q, value))
         
-        if percentile == 50:
-            self.key = "median"
-        else:
-            self.key = "percentile-%d" % percentile
+        return results
     
-    def findvalue(self, count, hist_value):
-        if self.value is not None:
-            self.value += (self.d * (hist_value - self.value))
-            self.is_calculated = True
-        elif self.k == 0:
-            self.value = hist_value
-            self.is_calculated = True
-        elif count >= self.sample_size and self.k >= self.sample_size:
-            self.value = hist_value
-            self.is_calculated = True
-        elif (self.k + self.d) < count:
-            self.value = hist_value
-            self.is_calculated = True
+    @staticmethod
+    def percentile_key(q):
+        if q == 50:
+            return "median"
+        return "percentile-%d" % q
+
+'''
+DDSketch: Mergeable quantile sketch (https://arxiv.org/abs/1908.10693).
+Values are counted in logarithmic buckets so any quantile is returned
+within relative_accuracy of the true value no matter how many values are
+added. Two sketches with the same accuracy merge by adding bucket counts,
+so percentiles over any time range can be answered from the sketches of
+the windows it covers. Values with an absolute value below min_value are
+counted as zero.
+'''
+class DDSketch(object):
+    min_value = 1e-9
+
+    def __init__(self, relative_accuracy=0.01):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("Sketch relative accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy)/(1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def _key(self, value):
+        return int(math.ceil(math.log(value)/self.log_gamma))
+
+    def _value(self, key):
+        #midpoint of the bucket that is within relative_accuracy of both ends
+        return 2.0*math.pow(self.gamma, key)/(self.gamma + 1)
+
+    def add(self, value, count=1):
+        if count <= 0:
+            return
+        if value > self.min_value:
+            key = self._key(value)
+            self.positive[key] = self.positive.get(key, 0) + count
+        elif value < -self.min_value:
+            key = self._key(-value)
+            self.negative[key] = self.negative.get(key, 0) + count
         else:
-            self.value = hist_value
-            
+            self.zero_count += count
+        self.count += count
+        self.sum += value*count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def add_histogram(self, hist):
+        """
+        Adds each bucket of a histogram. Raises ValueError if a bucket is
+        not a number.
+        """
+        for k, v in hist.items():
+            self.add(float(k), int(v))
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        if other.count == 0:
+            return
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for k, v in other_store.items():
+                store[k] = store.get(k, 0) + v
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    def mean(self):
+        return self.sum/self.count
+
+    def quantiles(self, quantiles):
+        """
+        Returns a list of (quantile, value) for the given quantiles in
+        percent (e.g. 95). Empty if nothing has been added.
+        """
+        if self.count == 0:
+            return []
+        #buckets from lowest to highest value
+        buckets = [(-self._value(k), self.negative[k]) for k in sorted(self.negative, reverse=True)]
+        if self.zero_count:
+            buckets.append((0.0, self.zero_count))
+        buckets.extend((self._value(k), self.positive[k]) for k in sorted(self.positive))
+
+        results = []
+        for q in quantiles:
+            rank = (q/100.0)*(self.count - 1)
+            seen = 0
+            for value, count in buckets:
+                seen += count
+                if seen > rank:
+                    break
+            results.append((q, min(max(value, self.min), self.max)))
+
+        return results
+
+    def to_dict(self):
+        return {
+            'relative-accuracy': self.relative_accuracy,
+            'count': self.count,
+            'sum': self.sum,
+            'minimum': self.min,
+            'maximum': self.max,
+            'zero': self.zero_count,
+            'positive': {str(k): v for k, v in self.positive.items()},
+            'negative': {str(k): v for k, v in self.negative.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d['relative-accuracy'])
+        sketch.count = d['count']
+        sketch.sum = d['sum']
+        sketch.min = d['minimum']
+        sketch.max = d['maximum']
+        sketch.zero_count = d['zero']
+        sketch.positive = {int(k): v for k, v in d['positive'].items()}
+        sketch.negative = {int(k): v for k, v in d['negative'].items()}
+        return sketch
+
+    def statistics(self, quantiles):
+        """
+        Returns the statistics the sketch can estimate in the same form
+        as the statistics summary.
+        """
+        if self.count == 0:
+            return {}
+        stats = {
+            'count': self.count,
+            'mean': self.mean(),
+            'minimum': self.min,
+            'maximum': self.max
+        }
+        for q, value in self.quantiles(quantiles):
+            stats[HistogramStats.percentile_key(q)] = value
+        return stats
+
 '''
 HistogramValidator: Validator for histogram type
 '''
 class HistogramValidator(DataValidator):
+    quantiles = [25, 50, 75, 95]
+    sketch_accuracy = 0.01
+
     def validate(self, obj):
         try:
             json.dumps(obj.value)
@@ -124,84 +326,76 @@ class HistogramValidator(DataValidator):
         return agg_hist
     
     def aggregation(self, db, obj, cache):
-        #combine and set as value
-        agg_hist = self._get_histogram(db, obj)
+        #cache is shared by the objects of one batch. Its writes are not 
+        #flushed until the batch ends, so a bin already merged in this batch
+        #is taken from the cache. Otherwise the current bin is read from the
+        #database so merges made by other processes are kept.
+        cache_key = (obj.event_type, obj.freq, obj.time)
+        agg_hist = cache.get(cache_key)
         if agg_hist is None:
-            return None
-        obj.value = self._aggregation(obj.value, agg_hist)
-        cache[obj.freq] = obj.value
-        
+            agg_hist = self._get_histogram(db, obj)
+        else:
+            #copy since the merge modifies it
+            agg_hist = dict(agg_hist)
+        #combine and set as value
+        if agg_hist is not None:
+            obj.value = self._aggregation(obj.value, agg_hist)
+        cache[cache_key] = obj.value
+
+    def sketch(self, db, obj, cache):
+        #only can sketch histograms with numeric buckets
+        try:
+            buckets = [(float(k), int(v)) for k, v in obj.value.items()]
+        except ValueError:
+            #store empty object and return but don't fail whole operation
+            obj.value = {}
+            return
+
+        #add to the window's sketch. Like aggregation(), sketches merged 
+        #earlier in the batch come from the cache and anything else is read
+        #from the database so merges made by other processes are kept.
+        cache_key = (tuple(obj.datapath), obj.freq, obj.time)
+        stored = cache.get(cache_key)
+        if stored is None:
+            stored = self._get_histogram(db, obj)
+        if stored:
+            sketch = DDSketch.from_dict(stored)
+        else:
+            sketch = DDSketch(self.sketch_accuracy)
+        for value, count in buckets:
+            sketch.add(value, count)
+        obj.value = sketch.to_dict()
+        cache[cache_key] = obj.value
+
     def statistics(self, db, obj, cache):
         #get aggregated histogram
         agg_hist = obj.value
         if obj.summary_window != 0:
-            if obj.freq in cache:
-                agg_hist = cache[obj.freq]
-        
-        #pass one: mode, mean and sample size
-        stats = {}
-        mean_num = 0
-        sample_size = 0
-        for k in agg_hist:
-            #only can do statistics for histograms with numeric buckets
-            try:
-                float(k)
-            except ValueError:
-                #store empty object and return but don't fail whole operation
-                obj.value = {}
-                return
-            
-            # update calculation values
-            if 'mode' not in stats or agg_hist[k] > agg_hist[stats['mode'][0]]:
-               stats['mode'] = [ k ]
-            elif agg_hist[k] == agg_hist[stats['mode'][0]]:
-                stats['mode'].append(k)
-            mean_num += (float(k) * agg_hist[k])
-            sample_size += agg_hist[k]
-        stats['mean'] = (mean_num/(1.0*sample_size))
-        
-        #sort items. make sure sort as numbers not strings
-        sorted_hist = sorted(iter(agg_hist.items()), key=lambda k: float(k[0]))
+            cache_key = (obj.event_type, obj.freq, obj.time)
+            if cache_key in cache:
+                agg_hist = cache[cache_key]
         
-        #make mode floats.
-        stats['mode'] = [float(x) for x in stats['mode']]
-        #get min and max
-        stats['minimum'] = float(sorted_hist[0][0])
-        stats['maximum'] = float(sorted_hist[len(sorted_hist)-1][0])
+        obj.value = self._statistics(agg_hist)
+
+    def _statistics(self, hist):
+        #only can do statistics for histograms with numeric buckets
+        try:
+            hist_stats = HistogramStats(hist)
+        except ValueError:
+            #store empty object but don't fail whole operation
+            return {}
         
-        #pass two: get quantiles, variance, and std deviation
-        stddev = 0
-        quantiles = [25, 50, 75, 95]
-        percentiles = [Percentile(q, sample_size) for q in quantiles]
-        percentile = percentiles.pop(0)
-        curr_count = 0
-        for hist_item in sorted_hist:
-            #stddev/variance
-            stddev += (math.pow(float(hist_item[0]) - stats['mean'], 2)*hist_item[1])
-            #quantiles
-            curr_count += hist_item[1]
-            while percentile is not None and curr_count >= percentile.k:
-                percentile.findvalue(curr_count, float(hist_item[0]))
-                #some percentiles require next item in list, so may have to wait until next iteration
-                if percentile.is_calculated:
-                    #calculated so add to dict
-                    stats[percentile.key] = percentile.value
-                else:
-                    #unable to calculate this pass, so break loop
-                    break
-                
-                #get next percentile
-                if len(percentiles) > 0:
-                    percentile = percentiles.pop(0)
-                else:
-                    percentile = None
-                    
-        #set standard deviation
-        stats['variance'] = stddev/sample_size
+        stats = {}
+        stats['mode'] = hist_stats.mode()
+        stats['mean'] = hist_stats.mean()
+        stats['minimum'] = hist_stats.minimum()
+        stats['maximum'] = hist_stats.maximum()
+        for q, value in hist_stats.percentiles(self.quantiles):
+            stats[HistogramStats.percentile_key(q)] = value
+        stats['variance'] = hist_stats.variance(stats['mean'])
         stats['standard-deviation'] = math.sqrt(stats['variance'])
         
-        #set value
-        obj.value = stats
+        return stats
   
 
 '''
@@ -1,19 +1,26 @@
 import json
 import os
+import threading
 import time
+import uuid
+from unittest import mock
 
 # This MUST be here in any testing modules that use cassandra!
 os.environ['ESMOND_UNIT_TESTS'] = 'True'
 
+from django.conf import settings
 from django.contrib.auth.models import User, Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
 from django.utils.timezone import now
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
-from esmond.api.models import PSEventTypes, UserIpAddress
+from esmond.api.models import PSEventTypes, PSMetadata, UserIpAddress
+from esmond.api.perfsonar import api_v2
 from esmond.api.perfsonar.types import *
 from esmond.cassandra import CASSANDRA_DB
 from esmond.config import get_config, get_config_path
+from esmond.util import SingleFlight
 from esmond.api.perfsonar.validators import *
 
 from rest_framework.exceptions import ParseError
@@ -463,6 +470,53 @@ class PSArchiveResourceTest(PSAPIBaseTest):
         self.assertEquals(new_data['uri'], existing_uri )
         self.assertEquals(new_data['metadata-key'], existing_mdkey )
         
+    def test_post_metadata_event_type_registry(self):
+        '''
+        Creating metadata drops anything cached for its key in the event type
+        registry
+        '''
+        url = '/{0}/archive/'.format(PS_ROOT)
+        metadata_key = uuid.UUID('0123456789abcdef0123456789abcdef')
+        #stale entry, like one another request cached for the same key
+        api_v2.event_type_registry._cache[metadata_key.hex] = {'failures': [('base', 0)]}
+        try:
+            with mock.patch.object(api_v2.uuid, 'uuid4', return_value=metadata_key):
+                response = self.get_api_client(admin_auth=True).post(url, format='json', data=self.post_data)
+            self.assertHttpCreated(response)
+            self.assertEquals(json.loads(response.content)['metadata-key'], metadata_key.hex)
+            summaries = api_v2.event_type_registry.get(metadata_key.hex)
+            self.assertEquals(sorted(summaries.keys()), ['packet-retransmits', 'throughput'])
+            self.assertIn(('average', 86400), summaries['throughput'])
+        finally:
+            api_v2.event_type_registry.invalidate(metadata_key.hex)
+        
+    def test_event_type_registry_ttl(self):
+        '''
+        Event types are cached until the registry ttl is up, then reloaded
+        '''
+        metadata_key = 'e99bbc44b7b041c7ad9e51dc6a053b8c'
+        registry = api_v2.EventTypeRegistry()
+        start = time.time()
+        with mock.patch('esmond.util.time') as mock_time:
+            mock_time.time.return_value = start
+            summaries = registry.get(metadata_key)
+            self.assertIn('throughput', summaries)
+            self.assertNotIn('histogram-rtt', summaries)
+            
+            PSEventTypes.objects.create(metadata=PSMetadata.objects.get(metadata_key=metadata_key),
+                event_type='histogram-rtt', summary_type='base', summary_window=0)
+            mock_time.time.return_value = start + registry.ttl - 1
+            self.assertNotIn('histogram-rtt', registry.get(metadata_key))
+            self.assertFalse(registry.has_summary(metadata_key, 'histogram-rtt', 'base', 0))
+            
+            mock_time.time.return_value = start + registry.ttl
+            self.assertEquals(registry.get(metadata_key)['histogram-rtt'], [('base', 0)])
+            self.assertTrue(registry.has_summary(metadata_key, 'histogram-rtt', 'base', 0))
+        
+        #unknown keys are not cached so new metadata shows up right away
+        self.assertEquals(registry.get('0123456789abcdef0123456789abcdef'), {})
+        self.assertEquals(len(registry._cache), 1)
+        
 class PSArchiveResourceDataTest(PSAPIBaseTest):
     '''
     Test querying data from API. Since we want to test that the server calculates
@@ -626,6 +680,36 @@ class PSArchiveResourceDataTest(PSAPIBaseTest):
         response_data = json.loads(response.content)
         self.assertEquals(len(response_data), len(data))
     
+    def assertBulkPutSuccess(self, metadata_key, event_type, data):
+        bulk_url = '/{0}/archive/{1}/'.format(PS_ROOT, metadata_key)
+        bulk_data = {'data': [{'ts': ts, 'val': [{'event-type': event_type, 'val': val}]} for ts, val in data]}
+        response = self.get_api_client(admin_auth=True).put(bulk_url, format='json', data=bulk_data)
+        self.assertHttpCreated(response)
+    
+    def assertBulkPutConflict(self, metadata_key, data):
+        bulk_url = '/{0}/archive/{1}/'.format(PS_ROOT, metadata_key)
+        bulk_data = {'data': [{'ts': ts, 'val': [{'event-type': event_type, 'val': val} for event_type, val in vals]} for ts, vals in data]}
+        response = self.get_api_client(admin_auth=True).put(bulk_url, format='json', data=bulk_data)
+        self.assertHttpConflict(response)
+    
+    def get_all_pages(self, url, get_params={}):
+        '''
+        Follows the next links starting at url. Returns every result and the
+        next links that were followed.
+        '''
+        results = []
+        links = []
+        response = self.client.get(url, get_params)
+        for i in range(100):
+            self.assertHttpOK(response)
+            results.extend(json.loads(response.content))
+            link = response.get('Link', '')
+            if 'rel="next"' not in link:
+                return results, links
+            links.append(link.split(';')[0].strip('<>'))
+            response = self.client.get(links[-1])
+        self.fail('Too many pages returned for %s' % url)
+    
     def assertAuthFailure(self, url, ts, val, cred):
         post_data = {'ts': ts, 'val': val}
         response = self.get_api_client(noperm_auth=cred).post(url, format='json', data=post_data)
@@ -670,6 +754,41 @@ class PSArchiveResourceDataTest(PSAPIBaseTest):
         agg_url = '/{0}/archive/f6b732e9f351487a96126f0c25e5e546/throughput/aggregations/86400/'.format(PS_ROOT)
         self.assertExpectedResponse(expected, agg_url)
     
+    def test_bulk_conflicts(self):
+        '''
+        A bulk put is written all or nothing. A value given twice or one that
+        already exists is a conflict.
+        '''
+        metadata_key = 'f6b732e9f351487a96126f0c25e5e546'
+        base_url = '/{0}/archive/{1}/packet-retransmits/base/'.format(PS_ROOT, metadata_key)
+        tput_url = '/{0}/archive/{1}/throughput/base/'.format(PS_ROOT, metadata_key)
+        tput_agg_url = '/{0}/archive/{1}/throughput/aggregations/86400/'.format(PS_ROOT, metadata_key)
+        start = 1420502400
+        params = {'time-start': start, 'time-end': start + 600}
+        
+        #same time twice in one batch
+        self.assertBulkPutConflict(metadata_key, [(start, [('packet-retransmits', 1)]),
+            (start + 60, [('packet-retransmits', 2)]), (start, [('packet-retransmits', 3)])])
+        self.assertExpectedResponse([], base_url, params)
+        
+        #time that already exists
+        self.assertBulkPutSuccess(metadata_key, 'packet-retransmits', [(start, 1)])
+        self.assertBulkPutConflict(metadata_key, [(start + 60, [('packet-retransmits', 2)]),
+            (start + 120, [('packet-retransmits', 3)]), (start, [('packet-retransmits', 4)])])
+        self.assertExpectedResponse([{'ts': start, 'val': 1}], base_url, params)
+        
+        #a conflict in one event type means nothing is written for the others
+        self.assertBulkPutConflict(metadata_key, [(start + 60, [('throughput', 1000), ('packet-retransmits', 2)]),
+            (start, [('packet-retransmits', 5)])])
+        self.assertExpectedResponse([{'ts': start, 'val': 1}], base_url, params)
+        self.assertExpectedResponse([], tput_url, params)
+        self.assertExpectedResponse([], tput_agg_url, {'time-start': start, 'time-end': start + 86400})
+        
+        #the same values without the conflict are written
+        self.assertBulkPutSuccess(metadata_key, 'packet-retransmits', [(start + 60, 2), (start + 120, 3)])
+        expected = [{'ts': start, 'val': 1}, {'ts': start + 60, 'val': 2}, {'ts': start + 120, 'val': 3}]
+        self.assertExpectedResponse(expected, base_url, params)
+        
     def test_float_data(self):
         base_url = '/{0}/archive/67a3c298de0b4237abee56b879e03587/time-error-estimates/base/'.format(PS_ROOT)
         start = 1398965989
@@ -779,12 +898,12 @@ class PSArchiveResourceDataTest(PSAPIBaseTest):
         self.assertBulkTSPutSuccess(bulk_url, base_url, start, interval, self.hist_data, 'histogram-rtt')
         
         #query aggregation summary
-        expected = [{u'ts': 1398902400, u'val': {u'41.10': 98, u'41.00': 98, u'50.0': 1, u'41.20': 3}}]
+        expected = [{u'ts': 1398902400, u'val': {u'41.10': 100, u'41.00': 196, u'50.0': 1, u'41.20': 3}}]
         agg_url = '/{0}/archive/67a3c298de0b4237abee56b879e03587/histogram-rtt/aggregations/86400/'.format(PS_ROOT)
         self.assertExpectedResponse(expected, agg_url)
         
         #query stats summary
-        expected =[{u'ts': 1398902400, u'val': {u'standard-deviation': 0.6333174559413313, u'median': 41.1, u'maximum': 50.0, u'minimum': 41.0, u'mode': [41.1, 41.0], u'percentile-75': 41.1, u'percentile-25': 41.0, u'percentile-95': 41.1, u'variance': 0.40109100000000003, u'mean': 41.097}}]
+        expected =[{u'ts': 1398902400, u'val': {u'standard-deviation': 0.5191000759862099, u'median': 41.0, u'maximum': 50.0, u'minimum': 41.0, u'mode': [41.0], u'percentile-75': 41.1, u'percentile-25': 41.0, u'percentile-95': 41.1, u'variance': 0.2694648888888889, u'mean': 41.065333333333335}}]
         stat_url = '/{0}/archive/67a3c298de0b4237abee56b879e03587/histogram-rtt/statistics/86400/'.format(PS_ROOT)
         self.assertExpectedResponse(expected, stat_url)
         
@@ -792,6 +911,43 @@ class PSArchiveResourceDataTest(PSAPIBaseTest):
         self.assertSinglePostSuccess(base_url, start+1000, {'test': 100})
         self.assertExpectedResponse([{u'ts': 1398902400, u'val': {}}], stat_url)
         
+    def test_histogram_cache(self):
+        '''
+        With histogram_flush_interval set, histograms are summed in memory and
+        the aggregation and statistics are written when the cache is flushed
+        '''
+        metadata_key = '67a3c298de0b4237abee56b879e03587'
+        start = 1420070400
+        params = {'time-start': start, 'time-end': start + 86400}
+        agg_url = '/{0}/archive/{1}/histogram-rtt/aggregations/86400/'.format(PS_ROOT, metadata_key)
+        stat_url = '/{0}/archive/{1}/histogram-rtt/statistics/86400/'.format(PS_ROOT, metadata_key)
+        old_interval = api_v2.histogram_cache.flush_interval
+        api_v2.histogram_cache.flush_interval = 3600
+        try:
+            self.assertBulkPutSuccess(metadata_key, 'histogram-rtt', [(start + i*600, val) for i, val in enumerate(self.hist_data)])
+            self.assertEquals(len(api_v2.histogram_cache), 1)
+            #nothing is aggregated until the cache is flushed
+            self.assertExpectedResponse([], agg_url, params)
+            self.assertExpectedResponse([], stat_url, params)
+            
+            api_v2.histogram_cache.flush(api_v2.db, force=True)
+            self.assertEquals(len(api_v2.histogram_cache), 0)
+            agg = {u'41.00': 196, u'41.10': 100, u'41.20': 3, u'50.0': 1}
+            self.assertExpectedResponse([{u'ts': start, u'val': agg}], agg_url, params)
+            stats = HistogramValidator()._statistics(dict(agg))
+            self.assertExpectedResponse([{u'ts': start, u'val': stats}], stat_url, params)
+            
+            #later histograms are added to the bin written by the flush
+            self.assertBulkPutSuccess(metadata_key, 'histogram-rtt', [(start + 3600, {'41.00': 4})])
+            api_v2.histogram_cache.flush(api_v2.db, force=True)
+            agg[u'41.00'] += 4
+            self.assertExpectedResponse([{u'ts': start, u'val': agg}], agg_url, params)
+            stats = HistogramValidator()._statistics(dict(agg))
+            self.assertExpectedResponse([{u'ts': start, u'val': stats}], stat_url, params)
+        finally:
+            api_v2.histogram_cache.flush(api_v2.db, force=True)
+            api_v2.histogram_cache.flush_interval = old_interval
+    
     def test_authentication_failures(self):
         base_url = '/{0}/archive/f6b732e9f351487a96126f0c25e5e546/throughput/base/'.format(PS_ROOT)
         self.assertAuthFailure(base_url, 1398965990, self.int_data[0], False)
@@ -821,17 +977,469 @@ class PSArchiveResourceDataTest(PSAPIBaseTest):
         self.assertRaises(ParseError, HistogramValidator().validate, ({'value': '{invalidjson'}))
         
         #test percentile calculations when only one element
-        p = Percentile(40, 1)
-        p.findvalue(1, 100)
-        self.assertEquals(p.value, 100)
+        p = HistogramStats({'100': 1}).percentiles([40])
+        self.assertEquals(p, [(40, 100)])
         
         #test where count equals sample size but > 1
-        p = Percentile(95, 9)
-        p.findvalue(9, 101)
-        self.assertEquals(p.value, 101)
+        p = HistogramStats({'101': 9}).percentiles([95])
+        self.assertEquals(p, [(95, 101)])
         
         #test percentile that as sample spread across multiple values
-        p = Percentile(95, 10)
-        p.findvalue(4, 100)
-        p.findvalue(6, 101)
-        self.assertEquals(p.value, 100.45)
+        p = HistogramStats({'100': 29, '101': 1}).percentiles([95])
+        self.assertAlmostEquals(p[0][1], 100.45)
+
+    def test_sketch(self):
+        '''
+        Sketch quantiles should be within the relative accuracy of the exact value
+        and merging sketches should give the same result as one sketch of all values
+        '''
+        hist = {'%.2f' % (i/10.0): (i % 7) + 1 for i in range(-50, 2000)}
+        values = sorted(float(k) for k in hist for i in range(hist[k]))
+        sketch = DDSketch(0.01)
+        sketch.add_histogram(hist)
+        for q, value in sketch.quantiles([0, 5, 25, 50, 75, 95, 100]):
+            exact = values[int(round((q/100.0)*(len(values) - 1)))]
+            self.assertTrue(abs(value - exact) <= 0.01*abs(exact))
+
+        keys = list(hist.keys())
+        first = DDSketch(0.01)
+        first.add_histogram({k: hist[k] for k in keys[:1000]})
+        second = DDSketch.from_dict(DDSketch(0.01).to_dict())
+        second.add_histogram({k: hist[k] for k in keys[1000:]})
+        first.merge(second)
+        self.assertEquals(first.count, sketch.count)
+        self.assertEquals(first.quantiles([25, 50, 95]), sketch.quantiles([25, 50, 95]))
+        self.assertRaises(ValueError, first.merge, DDSketch(0.05))
+
+    def test_cursor_pagination(self):
+        '''
+        Following the cursors in the next links returns the same results as a
+        single page without repeating or skipping results at the page boundaries
+        '''
+        base_url = '/{0}/archive/f6b732e9f351487a96126f0c25e5e546/packet-retransmits/base/'.format(PS_ROOT)
+        start = 1420243200
+        #one second apart so the result after a page's last timestamp is at cursor + 1
+        data = [(start + i, i + 1) for i in range(10)]
+        self.assertBulkPutSuccess('f6b732e9f351487a96126f0c25e5e546', 'packet-retransmits', data)
+        expected = [{'ts': ts, 'val': val} for ts, val in data]
+        params = {'time-start': start, 'time-end': start + 9}
+        
+        for limit in (1, 3, 5, 10, 100):
+            results, links = self.get_all_pages(base_url, dict(params, limit=limit))
+            self.assertEquals(results, expected)
+            #no next link when a page ends on the last result
+            self.assertEquals(len(links), (len(data) - 1)//limit)
+            for i, link in enumerate(links):
+                self.assertTrue('cursor={0}'.format(start + (i + 1)*limit - 1) in link)
+                self.assertTrue('time-end={0}'.format(start + 9) in link)
+                self.assertFalse('offset=' in link)
+        
+        #the cursor is combined with time-end
+        results, links = self.get_all_pages(base_url, {'time-start': start, 'time-end': start + 5, 'cursor': start + 2, 'limit': 2})
+        self.assertEquals(results, expected[3:6])
+        self.assertEquals(len(links), 1)
+        self.assertExpectedResponse([], base_url, {'time-start': start, 'time-end': start + 5, 'cursor': start + 5})
+        self.assertExpectedResponse([], base_url, {'time-start': start, 'time-end': start + 5, 'cursor': start + 9})
+        
+        #a cursor before time-start does not widen the range
+        self.assertExpectedResponse(expected[4:], base_url, {'time-start': start + 4, 'time-end': start + 9, 'cursor': start})
+        
+        #an explicit offset without a cursor still pages by offset
+        response = self.client.get(base_url, dict(params, offset=2, limit=2))
+        self.assertHttpOK(response)
+        self.assertEquals(json.loads(response.content), expected[2:4])
+        self.assertTrue('offset=4' in response['Link'])
+        self.assertFalse('cursor=' in response['Link'])
+        
+        #cursors must be timestamps
+        response = self.client.get(base_url, dict(params, cursor='bad'))
+        self.assertHttpBadRequest(response)
+
+    def test_downsample_pagination(self):
+        '''
+        Downsampled pages are read with offsets using the resolution of the first
+        page, so following the links returns the same buckets as a single page
+        '''
+        base_url = '/{0}/archive/f6b732e9f351487a96126f0c25e5e546/packet-retransmits/base/'.format(PS_ROOT)
+        start = 1420070400
+        data = [(start + i*60, i + 1) for i in range(12)]
+        self.assertBulkPutSuccess('f6b732e9f351487a96126f0c25e5e546', 'packet-retransmits', data)
+        
+        for params in ({'time-start': start, 'time-end': start + 719, 'resolution': 120},
+                       {'time-start': start, 'time-end': start + 719, 'points': 6},
+                       {'time-start': start, 'time-end': start + 719, 'points': 12, 'downsample': 'minmax'}):
+            expected, links = self.get_all_pages(base_url, dict(params, limit=100))
+            self.assertEquals(links, [])
+            results, links = self.get_all_pages(base_url, dict(params, limit=5))
+            self.assertEquals(results, expected)
+            self.assertTrue(len(links) > 0)
+            for link in links:
+                self.assertTrue('offset=' in link)
+                self.assertTrue('resolution=' in link)
+                self.assertFalse('cursor=' in link)
+        self.assertEquals(len(expected), 12)
+        
+        #cursors are not allowed with downsampling
+        response = self.client.get(base_url, {'time-start': start, 'resolution': 120, 'cursor': start + 120})
+        self.assertHttpBadRequest(response)
+
+    def assertPlannedSummary(self, summary_type, summary_window, url, get_params):
+        response = self.client.get(url, dict(get_params, plan='auto'))
+        self.assertHttpOK(response)
+        self.assertEquals(response['X-Esmond-Summary-Type'], summary_type)
+        self.assertEquals(response['X-Esmond-Summary-Window'], summary_window)
+        return response
+
+    def test_downsample_points(self):
+        '''
+        Buckets start at time-start, so an unaligned start time never gives more
+        than the requested number of points
+        '''
+        base_url = '/{0}/archive/f6b732e9f351487a96126f0c25e5e546/packet-retransmits/base/'.format(PS_ROOT)
+        start = 1420416000
+        data = [(start + i*60, (i*7) % 11) for i in range(60)]
+        self.assertBulkPutSuccess('f6b732e9f351487a96126f0c25e5e546', 'packet-retransmits', data)
+        
+        for points in (2, 5, 7, 13):
+            for method in ('average', 'minmax', 'lttb'):
+                params = {'time-start': start + 17, 'time-end': start + 3599, 'points': points, 'downsample': method}
+                response = self.client.get(base_url, params)
+                self.assertHttpOK(response)
+                results = json.loads(response.content)
+                self.assertTrue(0 < len(results) <= points)
+                for result in results:
+                    self.assertTrue(start + 17 <= result['ts'] <= start + 3599)
+        
+        #average buckets are reported at their start
+        response = self.client.get(base_url, {'time-start': start + 17, 'time-end': start + 3599, 'points': 7})
+        results = json.loads(response.content)
+        resolution = 512
+        self.assertEquals([r['ts'] for r in results], [start + 17 + i*resolution for i in range(7)])
+        
+        #a single point can't hold a minmax or lttb bucket
+        for method in ('minmax', 'lttb'):
+            response = self.client.get(base_url, {'time-start': start + 17, 'time-end': start + 3599, 'points': 1, 'downsample': method})
+            self.assertHttpBadRequest(response)
+
+    def test_plan_summary(self):
+        '''
+        The planner picks the coarsest summary window that still gives the requested
+        number of points and reports it in the response headers
+        '''
+        base_url = '/{0}/archive/2355e337a7214611ab1bc5db51e40424/packet-loss-rate/base/'.format(PS_ROOT)
+        year = {'time-start': 1388534400, 'time-end': 1388534400 + 31536000}
+        
+        #packet-loss-rate has aggregations every 3600 and 86400 seconds
+        self.assertPlannedSummary('aggregation', '86400', base_url, dict(year, **{'plan-points': 100}))
+        self.assertPlannedSummary('aggregation', '3600', base_url, dict(year, **{'plan-points': 1000}))
+        self.assertPlannedSummary('base', '0', base_url, dict(year, **{'plan-points': 100000}))
+        #the page limit is used without plan-points
+        self.assertPlannedSummary('aggregation', '86400', base_url, dict(year, limit=10))
+        
+        #plan-points does not downsample the planned summary
+        response = self.assertPlannedSummary('aggregation', '3600', base_url, dict(year, **{'plan-points': 1000}))
+        self.assertFalse('resolution=' in response.get('Link', ''))
+        
+        #summary types keep their type and json types read base data
+        stat_url = '/{0}/archive/2355e337a7214611ab1bc5db51e40424/histogram-rtt/statistics/'.format(PS_ROOT)
+        self.assertPlannedSummary('statistics', '86400', stat_url, dict(year, **{'plan-points': 10}))
+        self.assertPlannedSummary('statistics', '0', stat_url, dict(year, **{'plan-points': 100000}))
+        failures_url = '/{0}/archive/2355e337a7214611ab1bc5db51e40424/failures/base/'.format(PS_ROOT)
+        self.assertPlannedSummary('base', '0', failures_url, dict(year, **{'plan-points': 10}))
+        
+        #no headers without the planner
+        response = self.client.get(base_url, year)
+        self.assertHttpOK(response)
+        self.assertFalse(response.has_header('X-Esmond-Summary-Type'))
+        self.assertFalse(response.has_header('X-Esmond-Summary-Window'))
+        
+        #bad plans, a missing start time and bad plan-points
+        self.assertHttpBadRequest(self.client.get(base_url, dict(year, plan='bad')))
+        self.assertHttpBadRequest(self.client.get(base_url, {'plan': 'auto'}))
+        self.assertHttpBadRequest(self.client.get(base_url, dict(year, plan='auto', **{'plan-points': 0})))
+
+    def test_streamed_data(self):
+        '''
+        Streamed JSON and NDJSON responses contain the same results as the regular
+        JSON response for the same query
+        '''
+        start = 1420329600
+        self.assertBulkPutSuccess('f6b732e9f351487a96126f0c25e5e546', 'packet-retransmits', [(start + i*60, i*i) for i in range(20)])
+        self.assertBulkPutSuccess('f6b732e9f351487a96126f0c25e5e546', 'failures', [(start + i*60, {'error': 'error%d' % i}) for i in range(5)])
+        
+        for event_type, params in (('packet-retransmits', {'time-start': start}),
+                                   ('packet-retransmits', {'time-start': start, 'limit': 7, 'offset': 5}),
+                                   ('packet-retransmits', {'time-start': start, 'time-end': start + 1199, 'resolution': 300}),
+                                   ('failures', {'time-start': start})):
+            url = '/{0}/archive/f6b732e9f351487a96126f0c25e5e546/{1}/base/'.format(PS_ROOT, event_type)
+            response = self.client.get(url, params)
+            self.assertHttpOK(response)
+            expected = json.loads(response.content)
+            self.assertTrue(len(expected) > 0)
+            
+            #streamed json array
+            response = self.client.get(url, dict(params, stream='true'))
+            self.assertHttpOK(response)
+            self.assertTrue(response.streaming)
+            self.assertEquals(json.loads(b''.join(response.streaming_content)), expected)
+            
+            #ndjson asked for with the format parameter or the accept header
+            for response in (self.client.get(url, dict(params, format='ndjson')),
+                             self.client.get(url, params, HTTP_ACCEPT='application/x-ndjson')):
+                self.assertHttpOK(response)
+                self.assertTrue(response.streaming)
+                self.assertEquals(response['Content-Type'], 'application/x-ndjson')
+                lines = b''.join(response.streaming_content).splitlines()
+                self.assertEquals([json.loads(line) for line in lines], expected)
+
+    def test_result_cache_invalidation(self):
+        '''
+        Writes through the API make cached results for the metadata unreachable
+        '''
+        base_url = '/{0}/archive/f6b732e9f351487a96126f0c25e5e546/packet-retransmits/base/'.format(PS_ROOT)
+        start = 1420156800
+        params = {'time-start': start, 'time-end': start + 300}
+        old_enabled = api_v2.timeseries_cache.enabled
+        api_v2.timeseries_cache.enabled = True
+        try:
+            self.assertBulkPutSuccess('f6b732e9f351487a96126f0c25e5e546', 'packet-retransmits', [(start, 1), (start + 60, 2)])
+            expected = [{'ts': start, 'val': 1}, {'ts': start + 60, 'val': 2}]
+            self.assertExpectedResponse(expected, base_url, params)
+            
+            #bulk put
+            self.assertBulkPutSuccess('f6b732e9f351487a96126f0c25e5e546', 'packet-retransmits', [(start + 120, 3)])
+            expected.append({'ts': start + 120, 'val': 3})
+            self.assertExpectedResponse(expected, base_url, params)
+            
+            #single post
+            response = self.get_api_client(admin_auth=True).post(base_url, format='json', data={'ts': start + 180, 'val': 4})
+            self.assertHttpCreated(response)
+            expected.append({'ts': start + 180, 'val': 4})
+            self.assertExpectedResponse(expected, base_url, params)
+        finally:
+            api_v2.timeseries_cache.enabled = old_enabled
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'esmond_results': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'esmond-test-results',
+    },
+})
+class TimeSeriesResultCacheTest(TestCase):
+    '''
+    Test the result cache directly. Two caches using the same shared tier stand
+    in for two processes.
+    '''
+    
+    def setUp(self):
+        super(TimeSeriesResultCacheTest, self).setUp()
+        self.config = get_config(get_config_path())
+        self.config.result_cache = None
+        self.config.result_cache_shared_location = 'esmond-test-results'
+        self.key = ('f6b732e9f351487a96126f0c25e5e546', 'throughput', 'base', 0, 1398965989, 1398966989, None)
+        self.results = [{'ts': 1398965989, 'val': 5978580000}]
+    
+    def tearDown(self):
+        caches['esmond_results'].clear()
+        super(TimeSeriesResultCacheTest, self).tearDown()
+    
+    def test_enabled(self):
+        self.assertTrue(api_v2.TimeSeriesResultCache(self.config).enabled)
+        self.config.result_cache = False
+        self.assertFalse(api_v2.TimeSeriesResultCache(self.config).enabled)
+        
+        #without the shared tier only on when asked for
+        self.config.result_cache_shared_location = None
+        self.config.result_cache = None
+        self.assertFalse(api_v2.TimeSeriesResultCache(self.config).enabled)
+        self.config.result_cache = True
+        self.assertTrue(api_v2.TimeSeriesResultCache(self.config).enabled)
+    
+    def test_invalidate_shared(self):
+        first = api_v2.TimeSeriesResultCache(self.config)
+        second = api_v2.TimeSeriesResultCache(self.config)
+        cache_key = first.key(self.key)
+        first.set(cache_key, self.results)
+        self.assertEquals(first.get(first.key(self.key)), self.results)
+        self.assertEquals(second.get(second.key(self.key)), self.results)
+        
+        #a write in the second process hides the results from both
+        second.invalidate(self.key[0])
+        self.assertEquals(first.get(first.key(self.key)), None)
+        self.assertEquals(second.get(second.key(self.key)), None)
+        
+        #results read before the write are stored under the old generation
+        first.set(cache_key, self.results)
+        self.assertEquals(first.get(first.key(self.key)), None)
+        self.assertEquals(second.get(second.key(self.key)), None)
+        
+        #other metadata is not affected
+        other = ('67a3c298de0b4237abee56b879e03587',) + self.key[1:]
+        first.set(first.key(other), self.results)
+        second.invalidate(self.key[0])
+        self.assertEquals(second.get(second.key(other)), self.results)
+    
+    def test_invalidate_local(self):
+        self.config.result_cache = True
+        self.config.result_cache_shared_location = None
+        cache = api_v2.TimeSeriesResultCache(self.config)
+        cache.set(cache.key(self.key), self.results)
+        self.assertEquals(cache.get(cache.key(self.key)), self.results)
+        cache.invalidate(self.key[0])
+        self.assertEquals(cache.get(cache.key(self.key)), None)
+    
+    def test_generations_bounded(self):
+        self.config.result_cache = True
+        self.config.result_cache_shared_location = None
+        with mock.patch.object(api_v2.TimeSeriesResultCache, 'max_generations', 2):
+            cache = api_v2.TimeSeriesResultCache(self.config)
+        cache.invalidate(self.key[0])
+        cache.set(cache.key(self.key), self.results)
+        
+        #pushing the key out of the generations must not bring back results
+        #cached before its last write
+        cache.invalidate(self.key[0])
+        for i in range(3):
+            cache.invalidate('%032x' % i)
+        self.assertEquals(len(cache._generations), 2)
+        self.assertEquals(cache.get(cache.key(self.key)), None)
+        
+        #results cached after eviction are found until the next write
+        cache.set(cache.key(self.key), self.results)
+        self.assertEquals(cache.get(cache.key(self.key)), self.results)
+        cache.invalidate(self.key[0])
+        self.assertEquals(cache.get(cache.key(self.key)), None)
+    
+    def test_ttl(self):
+        cache = api_v2.TimeSeriesResultCache(self.config)
+        now = int(time.time())
+        immutable_end = now - self.config.result_cache_immutable_after - 60
+        
+        #ranges that ended long enough ago are immutable
+        key = self.key[:5] + (immutable_end, None)
+        self.assertEquals(cache.ttl(key), self.config.result_cache_immutable_ttl)
+        
+        #recent and open ended ranges
+        self.assertEquals(cache.ttl(self.key[:5] + (now, None)), self.config.result_cache_recent_ttl)
+        self.assertEquals(cache.ttl(self.key[:5] + (None, None)), self.config.result_cache_recent_ttl)
+        
+        #the last summary bin of the range may still be filling
+        agg_key = self.key[:2] + ('aggregations', 86400, self.key[4], immutable_end, None)
+        self.assertEquals(cache.ttl(agg_key), self.config.result_cache_recent_ttl)
+        
+        #the ttl is applied when results are stored
+        cache_key = cache.key(key)
+        cache.set(cache_key, self.results)
+        expires = cache._cache.get(cache_key)[0]
+        self.assertTrue(abs(expires - (now + self.config.result_cache_immutable_ttl)) <= 5)
+        cache_key = cache.key(self.key[:5] + (now, None))
+        cache.set(cache_key, self.results)
+        expires = cache._cache.get(cache_key)[0]
+        self.assertTrue(abs(expires - (now + self.config.result_cache_recent_ttl)) <= 5)
+
+class SingleFlightTest(TestCase):
+    '''
+    Test that identical queries running at the same time share one load.
+    '''
+    threads = 8
+
+    def run_callers(self, flight, loader):
+        '''
+        Calls flight.do from several threads at once while loader blocks.
+        Returns the results and errors of each thread.
+        '''
+        results = [None] * self.threads
+        errors = [None] * self.threads
+        def call(i):
+            try:
+                results[i] = flight.do(('key',), loader)
+            except Exception as e:
+                errors[i] = e
+        callers = [threading.Thread(target=call, args=(i,)) for i in range(self.threads)]
+        for t in callers:
+            t.start()
+        for t in callers:
+            t.join(10)
+            self.assertFalse(t.is_alive())
+        return results, errors
+
+    def blocking_loader(self, flight, result):
+        '''
+        Returns a loader that waits until every other thread is waiting on
+        it, then returns or raises result.
+        '''
+        loads = []
+        def loader():
+            loads.append(1)
+            deadline = time.time() + 10
+            while flight.stats()['coalesced'] < self.threads - 1 and time.time() < deadline:
+                time.sleep(0.01)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return loader, loads
+
+    def test_shared_result(self):
+        flight = SingleFlight()
+        shared = [{'ts': 1, 'val': 2}]
+        loader, loads = self.blocking_loader(flight, shared)
+        results, errors = self.run_callers(flight, loader)
+        self.assertEquals(len(loads), 1)
+        self.assertEquals(errors, [None] * self.threads)
+        for result in results:
+            self.assertTrue(result is shared)
+        stats = flight.stats()
+        self.assertEquals(stats['calls'], 1)
+        self.assertEquals(stats['coalesced'], self.threads - 1)
+        self.assertEquals(stats['in_flight'], 0)
+
+    def test_shared_error(self):
+        flight = SingleFlight()
+        error = ParseError(detail='load failed')
+        loader, loads = self.blocking_loader(flight, error)
+        results, errors = self.run_callers(flight, loader)
+        self.assertEquals(len(loads), 1)
+        for e in errors:
+            self.assertTrue(e is error)
+        self.assertEquals(flight.stats()['in_flight'], 0)
+        #the failed call is not remembered
+        self.assertEquals(flight.do(('key',), lambda: 3), 3)
+        self.assertEquals(flight.stats()['calls'], 2)
+
+class MetricsViewTest(TestCase):
+    '''
+    Test who can fetch the Prometheus metrics.
+    '''
+
+    def setUp(self):
+        super(MetricsViewTest, self).setUp()
+        self.allowed_ips = settings.ESMOND_SETTINGS.metrics_allowed_ips
+
+    def tearDown(self):
+        settings.ESMOND_SETTINGS.metrics_allowed_ips = self.allowed_ips
+        super(MetricsViewTest, self).tearDown()
+
+    def test_localhost(self):
+        settings.ESMOND_SETTINGS.metrics_allowed_ips = ['127.0.0.1', '::1']
+        response = self.client.get('/metrics', REMOTE_ADDR='127.0.0.1')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        response = self.client.get('/metrics', REMOTE_ADDR='::1')
+        self.assertEquals(response.status_code, 200)
+
+    def test_forbidden(self):
+        settings.ESMOND_SETTINGS.metrics_allowed_ips = ['127.0.0.1', '10.1.0.0/16']
+        self.assertEquals(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 200)
+        self.assertEquals(self.client.get('/metrics', REMOTE_ADDR='10.2.2.3').status_code, 403)
+        # a forwarded header does not get around the check
+        response = self.client.get('/metrics', REMOTE_ADDR='10.2.2.3',
+            HTTP_X_FORWARDED_FOR='127.0.0.1')
+        self.assertEquals(response.status_code, 403)
+
+    def test_disabled(self):
+        settings.ESMOND_SETTINGS.metrics_allowed_ips = []
+        self.assertEquals(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
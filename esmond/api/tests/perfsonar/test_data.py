@@ -3,9 +3,18 @@ Tests for PS cassandra/data handling.
 
 """
 
+import datetime
 import json
+import logging
 import os
+import random
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
+from unittest import mock
 
 # This MUST be here in any testing modules that use cassandra!
 os.environ['ESMOND_UNIT_TESTS'] = 'True'
@@ -14,7 +23,11 @@ from django.test import TestCase
 from django.conf import settings
 
 from esmond.config import get_config, get_config_path
-from esmond.cassandra import CASSANDRA_DB, RawRateData, BaseRateBin
+from esmond.cassandra import CASSANDRA_DB, RawRateData, BaseRateBin, \
+    AsyncBatchWriter, ConnectionException, CounterCoalescer, \
+    RAW_ENCODING_MARKER, RAW_ENCODING_VERSION, RAW_HISTOGRAM, RAW_ZLIB_JSON, \
+    decode_raw_value, encode_raw_value
+from esmond.sqlite import SQLITE_DB
 
 from esmond.api.tests.example_data import load_test_data
 
@@ -136,11 +149,14 @@ class DataTest(TestCase):
     def setUp(self):
         self.tr = TestResults()
 
+    def get_db(self, config):
+        return CASSANDRA_DB(config)
+
     def test_a_load_data(self):
         config = get_config(get_config_path())
         config.db_clear_on_testing = True
 
-        db = CASSANDRA_DB(config)
+        db = self.get_db(config)
 
         for dat in hist_data:
             for row in load_test_data(dat):
@@ -154,7 +170,7 @@ class DataTest(TestCase):
 
     def test_histograms(self):
         config = get_config(get_config_path())
-        db = CASSANDRA_DB(config)
+        db = self.get_db(config)
 
         ret = db.query_raw_data( path=self.tr.h_ttl_path,
             ts_min=self.tr.q_start, ts_max=self.tr.q_end
@@ -189,7 +205,7 @@ class DataTest(TestCase):
 
     def test_values(self):
         config = get_config(get_config_path())
-        db = CASSANDRA_DB(config)
+        db = self.get_db(config)
         
         ret = db.query_baserate_timerange( path=self.tr.throughput_path,
             ts_min=self.tr.q_start, ts_max=self.tr.q_end
@@ -231,4 +247,343 @@ class DataTest(TestCase):
         self.assertEqual(ret[-1]['ts'], self.tr.packet_lost_end_ts)
         self.assertEqual(ret[-1]['val'], self.tr.packet_lost_end_val)
 
+class SQLiteDataTest(DataTest):
+    """
+    Runs the same tests against the embedded sqlite storage backend.
+    """
+
+    def get_db(self, config):
+        config.storage_backend = 'sqlite'
+        config.sqlite_storage_file = os.path.join(tempfile.gettempdir(), 'esmond.sqlite')
+        return SQLITE_DB(config)
+
+class PrefetchMetadataTest(TestCase):
+    """
+    Seeding the metadata cache for a batch of raw data.
+    """
 
+    def test_prefetch_metadata(self):
+        config = get_config(get_config_path())
+        db = CASSANDRA_DB(config)
+        
+        t0 = datetime.datetime(2015, 3, 1, 12, 0)
+        paths = [['ps', 'prefetch_test', str(i)] for i in range(6)]
+        #only the first half have an earlier value
+        for i, path in enumerate(paths[:3]):
+            db.set_raw_data(RawRateData(path=path, ts=t0 - datetime.timedelta(seconds=30), val=100 + i, freq=30))
+        db.flush()
+        db.metadata_cache.clear()
+        
+        incoming = [RawRateData(path=path, ts=t0, val=1000 + i, freq=30) for i, path in enumerate(paths)]
+        cf = db.raw_data._column_family
+        with mock.patch.object(cf, 'multiget', wraps=cf.multiget) as multiget:
+            self.assertEqual(db.prefetch_metadata(incoming), len(incoming))
+        self.assertEqual(multiget.call_count, 1)
+        
+        for i, raw_data in enumerate(incoming):
+            meta = db.metadata_cache.get(raw_data.get_meta_key())
+            self.assertIsNotNone(meta)
+            if i < 3:
+                self.assertEqual(meta['last_val'], 100 + i)
+            else:
+                #no earlier value so it is seeded with the incoming one
+                self.assertEqual(meta['last_val'], 1000 + i)
+        
+        #everything is cached now
+        with mock.patch.object(cf, 'multiget', wraps=cf.multiget) as multiget:
+            self.assertEqual(db.prefetch_metadata(incoming), 0)
+        self.assertEqual(multiget.call_count, 0)
+        
+        db.close()
+
+class FakeMutator(object):
+    """
+    Records the batches a pycassa batch mutator would send. Like pycassa
+    it sends on its own once queue_size mutations are pending. If gate is
+    set, mutations wait for it.
+    """
+
+    def __init__(self, column_family, queue_size):
+        self._column_family = column_family
+        self.queue_size = queue_size
+        self.pending = []
+        self.batches = []
+        self.gate = None
+        self.fail = False
+
+    def _add(self, mutation):
+        if self.gate is not None:
+            self.gate.wait()
+        self.pending.append(mutation)
+        if len(self.pending) >= self.queue_size:
+            self.send()
+
+    def insert(self, key, columns, **kwargs):
+        self._add(('insert', key, columns))
+
+    def remove(self, key, columns=None, **kwargs):
+        self._add(('remove', key, columns))
+
+    def send(self):
+        if self.fail:
+            raise Exception('send failed')
+        if self.pending:
+            self.batches.append(self.pending)
+            self.pending = []
+
+class FakeColumnFamily(object):
+    def __init__(self, name):
+        self.column_family = name
+        self.mutator = None
+
+    def batch(self, queue_size):
+        self.mutator = FakeMutator(self, queue_size)
+        return self.mutator
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+class AsyncBatchWriterTest(TestCase):
+    """
+    The background writer with a fake mutator in place of pycassa.
+    """
+
+    def setUp(self):
+        self.cf = FakeColumnFamily('raw_data')
+        self.writer = None
+
+    def tearDown(self):
+        if self.writer is not None:
+            if self.cf.mutator.gate is not None:
+                self.cf.mutator.gate.set()
+            self.writer.close()
+
+    def get_mutator(self, batch_size=3, flush_interval=0, max_pending=100):
+        self.writer = AsyncBatchWriter(batch_size, flush_interval, max_pending,
+            logging.getLogger(__name__))
+        return self.writer.mutator(self.cf)
+
+    def batch_sizes(self):
+        return [len(b) for b in self.cf.mutator.batches]
+
+    def test_batch_size(self):
+        mutator = self.get_mutator(batch_size=3)
+        for i in range(7):
+            mutator.insert('key', {i: i})
+        self.assertTrue(wait_for(lambda: len(self.cf.mutator.batches) == 2))
+        self.assertEqual(self.batch_sizes(), [3, 3])
+        
+        #an explicit flush sends the rest
+        mutator.send()
+        self.assertEqual(self.batch_sizes(), [3, 3, 1])
+        self.assertEqual([m[2] for b in self.cf.mutator.batches for m in b],
+            [{i: i} for i in range(7)])
+
+    def test_flush_interval(self):
+        mutator = self.get_mutator(batch_size=100, flush_interval=0.1)
+        mutator.insert('key', {1: 1})
+        mutator.insert('key', {2: 2})
+        self.assertTrue(wait_for(lambda: len(self.cf.mutator.batches) == 1))
+        self.assertEqual(self.batch_sizes(), [2])
+
+    def test_close(self):
+        mutator = self.get_mutator(batch_size=100)
+        for i in range(5):
+            mutator.insert('key', {i: i})
+        mutator.remove('key', [0])
+        self.writer.close()
+        self.assertFalse(self.writer._thread.is_alive())
+        self.assertEqual(self.batch_sizes(), [6])
+        self.assertEqual(self.cf.mutator.batches[0][-1], ('remove', 'key', [0]))
+        self.assertRaises(ConnectionException, mutator.insert, 'key', {9: 9})
+        self.assertRaises(ConnectionException, mutator.send)
+
+    def test_backpressure(self):
+        mutator = self.get_mutator(batch_size=100, max_pending=2)
+        self.cf.mutator.gate = threading.Event()
+        #the writer takes the first and blocks on it, two more fill the queue
+        for i in range(3):
+            mutator.insert('key', {i: i})
+        blocked = threading.Thread(target=mutator.insert, args=('key', {3: 3}))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+        
+        self.cf.mutator.gate.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+        mutator.send()
+        self.assertEqual(self.batch_sizes(), [4])
+
+    def test_error(self):
+        mutator = self.get_mutator(batch_size=100)
+        self.cf.mutator.fail = True
+        mutator.insert('key', {1: 1})
+        self.assertRaises(Exception, mutator.send)
+        
+        #the failed mutations are sent with the next batch
+        self.cf.mutator.fail = False
+        mutator.insert('key', {2: 2})
+        mutator.send()
+        self.assertEqual(self.batch_sizes(), [2])
+
+class CounterCoalescerTest(TestCase):
+    """
+    Summing counter increments before they reach the mutator.
+    """
+
+    def setUp(self):
+        self.cf = FakeColumnFamily('rate_aggregations')
+        self.stats = mock.Mock()
+
+    def get_coalescer(self, max_cells=1000, queue_size=1000):
+        mutator = self.cf.batch(queue_size)
+        return CounterCoalescer(mutator, max_cells, logging.getLogger(__name__),
+            self.stats, 'aggregation_update')
+
+    def sent_cells(self):
+        """
+        Sum of the increments sent for each cell and the number of cells
+        that were sent.
+        """
+        sums = {}
+        count = 0
+        for batch in self.cf.mutator.batches:
+            for method, key, columns in batch:
+                self.assertEqual(method, 'insert')
+                for column, val in columns.items():
+                    for subcolumn, subval in val.items():
+                        cell = (key, column, subcolumn)
+                        sums[cell] = sums.get(cell, 0) + subval
+                        count += 1
+        return sums, count
+
+    def test_sums(self):
+        coalescer = self.get_coalescer()
+        rand = random.Random(42)
+        expected = {}
+        for i in range(500):
+            key = 'ps:throughput:%d:aggregation:86400:2015' % rand.randint(0, 3)
+            column = 1420070400000 + 86400000 * rand.randint(0, 4)
+            val, count = rand.randint(1, 10 ** 9), 1
+            coalescer.insert(key, {column: {'val': val, 'count': count}})
+            for subcolumn, subval in (('val', val), ('count', count)):
+                expected[(key, column, subcolumn)] = expected.get((key, column, subcolumn), 0) + subval
+        coalescer.send()
+        
+        sums, count = self.sent_cells()
+        self.assertEqual(sums, expected)
+        #one mutation per cell instead of one per increment
+        self.assertEqual(count, len(expected))
+        self.assertEqual(coalescer.increments, 1000)
+        self.assertEqual(coalescer.mutations, len(expected))
+
+    def test_max_cells(self):
+        coalescer = self.get_coalescer(max_cells=2)
+        coalescer.insert('key', {1: {'val': 1}})
+        coalescer.insert('key', {1: {'val': 2}})
+        self.assertEqual(self.cf.mutator.pending, [])
+        coalescer.insert('key', {2: {'val': 3}})
+        #pushed to the mutator but not sent
+        self.assertEqual(self.cf.mutator.pending, [('insert', 'key', {1: {'val': 3}, 2: {'val': 3}})])
+        self.assertEqual(self.cf.mutator.batches, [])
+
+    def test_order(self):
+        coalescer = self.get_coalescer()
+        coalescer.insert('key', {1: {'val': 1}})
+        coalescer.insert('key', {1: {'val': 2}})
+        coalescer.remove('key', [1])
+        coalescer.insert('key', {1: {'val': 5}})
+        coalescer.insert('key', {1: {'val': 1}}, ttl=60)
+        coalescer.send()
+        self.assertEqual(self.cf.mutator.batches, [[
+            ('insert', 'key', {1: {'val': 3}}),
+            ('remove', 'key', [1]),
+            ('insert', 'key', {1: {'val': 5}}),
+            ('insert', 'key', {1: {'val': 1}}),
+        ]])
+
+    def test_maximum_retry(self):
+        from pycassa.pool import MaximumRetryException
+        coalescer = self.get_coalescer()
+        coalescer.insert('key', {1: {'val': 1}})
+        with mock.patch.object(self.cf.mutator, 'insert', side_effect=MaximumRetryException()):
+            coalescer.push()
+        self.stats.error.assert_called_once_with('aggregation_update', 'rate_aggregations')
+
+    def test_async_interval(self):
+        writer = AsyncBatchWriter(100, 0.1, 100, logging.getLogger(__name__))
+        try:
+            coalescer = CounterCoalescer(writer.mutator(self.cf), 1000,
+                logging.getLogger(__name__), self.stats, 'aggregation_update')
+            writer.coalesce(coalescer)
+            for i in range(10):
+                coalescer.insert('key', {1: {'val': i}})
+            #pushed and sent on the interval without a flush
+            self.assertTrue(wait_for(lambda: len(self.cf.mutator.batches) == 1))
+            self.assertEqual(self.cf.mutator.batches, [[('insert', 'key', {1: {'val': 45}})]])
+        finally:
+            writer.close()
+
+class RawValueEncodingTest(TestCase):
+    """
+    Round trips through the binary raw value encoding.
+    """
+
+    def assertEncoded(self, val, kind):
+        encoded = encode_raw_value(val)
+        self.assertEqual(encoded[:1], RAW_ENCODING_MARKER)
+        self.assertEqual(encoded[1], RAW_ENCODING_VERSION)
+        self.assertEqual(encoded[2:3], kind)
+        self.assertEqual(decode_raw_value(encoded), val)
+        return encoded
+
+    def test_histogram(self):
+        hist = dict(('%d.%d' % (i, i % 10), i * 3) for i in range(100))
+        hist['41.10'] = 7
+        hist['50.0'] = 1
+        encoded = self.assertEncoded(hist, RAW_HISTOGRAM)
+        self.assertLess(len(encoded), len(json.dumps(hist)))
+        # labels that look like numbers keep their exact text
+        self.assertIn('41.10', decode_raw_value(encoded))
+
+        # counts pick the narrowest type that fits
+        self.assertEqual(self.assertEncoded({'1': 200, '2': 3}, RAW_HISTOGRAM)[3:4], b'B')
+        self.assertEqual(self.assertEncoded({'1': 70000, '2': 3}, RAW_HISTOGRAM)[3:4], b'I')
+        self.assertEqual(self.assertEncoded({'1': 2 ** 40, '2': 3}, RAW_HISTOGRAM)[3:4], b'q')
+        negative = dict(('%d' % i, -1000000 * i) for i in range(20))
+        self.assertEqual(self.assertEncoded(negative, RAW_HISTOGRAM)[3:4], b'q')
+
+    def test_zlib_json(self):
+        trace = [{'ip': '10.0.0.%d' % i, 'ttl': i, 'rtt': 0.5 * i, 'success': 1,
+            'error_message': None, 'mtu': 9000} for i in range(1, 31)]
+        encoded = self.assertEncoded(trace, RAW_ZLIB_JSON)
+        self.assertEqual(json.loads(zlib.decompress(encoded[3:])), trace)
+
+    def test_small_values(self):
+        # small values and histograms that don't pack stay JSON text
+        for val in (1, 0.25, 'text', {'1': 1.5}, {'1': 1}, [], {}):
+            encoded = encode_raw_value(val)
+            self.assertEqual(encoded, json.dumps(val).encode('utf-8'))
+            self.assertEqual(decode_raw_value(encoded), val)
+
+    def test_legacy_json(self):
+        # columns written before the binary encoding are JSON text and
+        # come back from pycassa as str or bytes
+        hist = {'41.10': 3, '50.0': 12}
+        for val in (json.dumps(hist), json.dumps(hist).encode('utf-8')):
+            self.assertEqual(decode_raw_value(val), hist)
+        self.assertEqual(decode_raw_value('[{"ttl": 1, "ip": "10.0.0.1"}]'),
+            [{'ttl': 1, 'ip': '10.0.0.1'}])
+        self.assertEqual(decode_raw_value(b'12.5'), 12.5)
+
+    def test_unknown_version(self):
+        encoded = bytearray(encode_raw_value({'1': 1, '2': 2, '3': 3, '4': 4, '5': 5}))
+        self.assertEqual(encoded[:1], RAW_ENCODING_MARKER)
+        encoded[1] = RAW_ENCODING_VERSION + 1
+        self.assertRaises(ValueError, decode_raw_value, bytes(encoded))
+        self.assertRaises(ValueError, decode_raw_value,
+            RAW_ENCODING_MARKER + struct.pack('B', RAW_ENCODING_VERSION) + b'X')
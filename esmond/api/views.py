@@ -1 +1,38 @@
-# Create your views here.
+import ipaddress
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_GET
+
+from esmond.metrics import registry
+
+def metrics_allowed(remote_addr):
+    """
+    Whether remote_addr is in one of the addresses or networks in the
+    metrics_allowed_ips config option.
+    """
+    try:
+        addr = ipaddress.ip_address(str(remote_addr))
+    except ValueError:
+        return False
+    for allowed in settings.ESMOND_SETTINGS.metrics_allowed_ips:
+        try:
+            if addr in ipaddress.ip_network(str(allowed), strict=False):
+                return True
+        except ValueError:
+            continue
+    return False
+
+@require_GET
+def metrics(request):
+    """
+    Process metrics in the Prometheus text format.  Each server process
+    keeps its own, so scrape every process or expect per process values.
+    Only served to the addresses in metrics_allowed_ips, going by the
+    address of the connection since a proxy header can be forged.
+    """
+    if not metrics_allowed(request.META.get('REMOTE_ADDR')):
+        return HttpResponseForbidden('Metrics are not available from this address.\n',
+            content_type='text/plain')
+    return HttpResponse(registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
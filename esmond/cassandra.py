@@ -44,28 +44,46 @@ esmond schema in json-like notation:
 }
 """
 # Standard
+import array
 import ast
 import calendar
+import concurrent.futures
 import datetime
+import functools
+import gzip
+import heapq
+import itertools
 import json
 import logging
 import os
 import pprint
+import queue
+import struct
 import sys
+import tempfile
+import threading
 import time
-from collections import OrderedDict
+import zlib
+from collections import OrderedDict, deque
 
-from esmond.util import get_logger
+from esmond import metrics
+from esmond.storage import StorageBackend
+from esmond.util import get_logger, LRUCache
 
-# Third party
-from pycassa import PycassaLogger
-from pycassa.pool import ConnectionPool, AllServersUnavailable, MaximumRetryException
-from pycassa.columnfamily import ColumnFamily, NotFoundException
-from pycassa.system_manager import *
+# Third party. Only CASSANDRA_DB needs these, the data containers and row
+# key functions are shared with the other storage backends.
+try:
+    from pycassa import PycassaLogger
+    from pycassa.pool import ConnectionPool, AllServersUnavailable, MaximumRetryException
+    from pycassa.columnfamily import ColumnFamily, NotFoundException
+    from pycassa.system_manager import *
 
-from thrift.transport.TTransport import TTransportException
+    from thrift.transport.TTransport import TTransportException
+except ImportError:
+    PycassaLogger = None
 
 SEEK_BACK_THRESHOLD = 2592000000 # 30 days in ms
+CACHE_SNAPSHOT_VERSION = 1
 KEY_DELIMITER = ":"
 AGG_TYPES = ['average', 'min', 'max', 'raw']
 
@@ -79,14 +97,12 @@ class ConnectionException(CassandraException):
     def __str__(self):
         return repr(self.value)
         
-class CASSANDRA_DB(object):
-    
-    raw_cf = 'raw_data'
-    rate_cf = 'base_rates'
-    agg_cf = 'rate_aggregations'
-    stat_cf = 'stat_aggregations'
+class CASSANDRA_DB(StorageBackend):
     
     _queue_size = 200
+    _page_size = 1000
+    _pool_size = 10
+    _metadata_prefetch_size = 500
     
     def __init__(self, config, qname=None, timeout=30):
         """
@@ -113,6 +129,10 @@ class CASSANDRA_DB(object):
             handle.setFormatter(format)
             self.log.addHandler(handle)
         
+        if PycassaLogger is None:
+            raise ConnectionException("pycassa is not installed, set "
+                "storage_backend = sqlite to run without cassandra")
+        
         # Add pycassa driver logging to existing logger.
         plog = PycassaLogger()
         plog.set_logger_name('%s.pycassa' % self.log.name)
@@ -162,7 +182,7 @@ class CASSANDRA_DB(object):
             _schema_modified = True
             sysman.create_column_family(self.keyspace, self.raw_cf, super=False, 
                     comparator_type=LONG_TYPE, 
-                    default_validation_class=UTF8_TYPE,
+                    default_validation_class=BYTES_TYPE,
                     key_validation_class=UTF8_TYPE,
                     compaction_strategy='LeveledCompactionStrategy')
             self.log.info('Created CF: %s' % self.raw_cf)
@@ -193,6 +213,18 @@ class CASSANDRA_DB(object):
                     key_validation_class=UTF8_TYPE,
                     compaction_strategy='LeveledCompactionStrategy')
             self.log.info('Created CF: %s' % self.stat_cf)
+        
+        # New keyspaces create the raw data CF with bytes validation, 
+        # keyspaces from before the binary encoding validate values as 
+        # UTF8 until cassandra_convert_raw changes that.  Raw values are 
+        # only written in the binary encoding if raw_data_binary is 
+        # turned on and the CF accepts bytes, otherwise they stay JSON.
+        raw_cf_def = sysman.get_keyspace_column_families(self.keyspace)[self.raw_cf]
+        self.raw_cf_bytes = raw_cf_def.default_validation_class.endswith(BYTES_TYPE)
+        self.raw_binary = config.raw_data_binary and self.raw_cf_bytes
+        if config.raw_data_binary and not self.raw_cf_bytes:
+            self.log.warning('%s does not accept bytes, writing raw values as JSON. '
+                'Run the cassandra_convert_raw command to convert it.' % self.raw_cf)
                     
         sysman.close()
         
@@ -214,11 +246,21 @@ class CASSANDRA_DB(object):
             _creds['password'] = config.cassandra_pass
             self.log.debug('Connecting with username: %s' % (config.cassandra_user,))
         
+        # Timing - every database call is recorded in the esmond.metrics
+        # histograms.  Profiling also keeps per call totals that are not
+        # really meant to be used in production and generally just spits 
+        # out statistics at the end of a run of test data.  Mostly useful 
+        # for timing specific database calls to aid in development.
+        self.profiling = False
+        if config.db_profile_on_testing and os.environ.get("ESMOND_TESTING", False):
+            self.profiling = True
+        self.stats = DatabaseMetrics(profiling=self.profiling)
+        
         try:
             self.log.debug('Opening ConnectionPool')
             self.pool = ConnectionPool(self.keyspace, 
                 server_list=config.cassandra_servers, 
-                pool_size=10,
+                pool_size=self._pool_size,
                 max_overflow=5,
                 max_retries=10,
                 timeout=timeout,
@@ -227,13 +269,52 @@ class CASSANDRA_DB(object):
             raise ConnectionException("Couldn't connect to any Cassandra "
                     "at %s - %s" % (config.cassandra_servers, e))
                     
+        self.pool.add_listener(PoolMetricsListener(self.stats))
         self.log.info('Connected to %s' % config.cassandra_servers)
         
-        # Define column family connections for the code to use.
-        self.raw_data = ColumnFamily(self.pool, self.raw_cf).batch(self._queue_size)
-        self.rates    = ColumnFamily(self.pool, self.rate_cf).batch(self._queue_size)
-        self.aggs     = ColumnFamily(self.pool, self.agg_cf).batch(self._queue_size)
-        self.stat_agg = ColumnFamily(self.pool, self.stat_cf).batch(self._queue_size)
+        # Reads that span several rows fan out across the connection pool.
+        # fan_out calls run on executor and may wait for row pages, so 
+        # the pages are read on their own pool.  With a single pool the 
+        # calls could take every worker and wait on pages that never start.
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._pool_size)
+        self.page_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._pool_size)
+        
+        # Define column family connections for the code to use.  If async
+        # writes are enabled, mutations are queued and sent by a background
+        # thread rather than by the thread making the insert/flush calls.
+        self.writer = None
+        if config.cassandra_async_writes:
+            self.writer = AsyncBatchWriter(config.cassandra_write_batch_size,
+                config.cassandra_write_flush_interval,
+                config.cassandra_write_queue_size, self.log)
+            self.raw_data = self.writer.mutator(ColumnFamily(self.pool, self.raw_cf))
+            self.rates    = self.writer.mutator(ColumnFamily(self.pool, self.rate_cf))
+            self.aggs     = self.writer.mutator(ColumnFamily(self.pool, self.agg_cf))
+            self.stat_agg = self.writer.mutator(ColumnFamily(self.pool, self.stat_cf))
+        else:
+            self.raw_data = ColumnFamily(self.pool, self.raw_cf).batch(self._queue_size)
+            self.rates    = ColumnFamily(self.pool, self.rate_cf).batch(self._queue_size)
+            self.aggs     = ColumnFamily(self.pool, self.agg_cf).batch(self._queue_size)
+            self.stat_agg = ColumnFamily(self.pool, self.stat_cf).batch(self._queue_size)
+        
+        if self.writer:
+            batches = list(self.writer.mutators.values())
+        else:
+            batches = [self.raw_data, self.rates, self.aggs, self.stat_agg]
+        for batch in batches:
+            instrument_mutator(batch, self.stats)
+        
+        # The base rate and rate aggregation column families are counters,
+        # so increments to the same column are summed before they are sent.
+        self.rates = CounterCoalescer(self.rates, self._queue_size,
+            self.log, self.stats, 'baserate_update')
+        self.aggs  = CounterCoalescer(self.aggs, self._queue_size,
+            self.log, self.stats, 'aggregation_update')
+        if self.writer:
+            self.writer.coalesce(self.rates)
+            self.writer.coalesce(self.aggs)
 
         # Used when a cf needs to be selected on the fly.
         self.cf_map = {
@@ -243,27 +324,46 @@ class CASSANDRA_DB(object):
             'stat': self.stat_agg
         }
         
-        # Timing - this turns the database call profiling code on and off.
-        # This is not really meant to be used in production and generally 
-        # just spits out statistics at the end of a run of test data.  Mostly
-        # useful for timing specific database calls to aid in development.
-        self.profiling = False
-        if config.db_profile_on_testing and os.environ.get("ESMOND_TESTING", False):
-            self.profiling = True
-        self.stats = DatabaseMetrics(profiling=self.profiling)
-        
         # Class members
-        # Just the dict for the metadata cache.
-        self.metadata_cache = {}
-        self.aggregation_cache = {}
+        # Bounded caches of metadata and open stat aggregation bins.
+        # Entries that get evicted are read back from cassandra if
+        # they are seen again.
+        self.metadata_cache = LRUCache(
+            max_entries=config.metadata_cache_max_entries,
+            max_bytes=config.metadata_cache_max_bytes)
+        self.aggregation_cache = LRUCache(
+            max_entries=config.aggregation_cache_max_entries,
+            max_bytes=config.aggregation_cache_max_bytes)
+        self.stats.add_cache('metadata', self.metadata_cache)
+        self.stats.add_cache('aggregation', self.aggregation_cache)
+        
+        # Persister workers (the long running writers) keep a snapshot of 
+        # their caches in a file of their own and warm the caches from it
+        # on start.  Management commands, utilities and the REST api don't
+        # pass a qname and always start cold.
+        self.snapshot_file = None
+        if config.cache_snapshot_file and qname:
+            self.snapshot_file = '%s.%s' % (config.cache_snapshot_file, qname)
+        self.snapshot_interval = config.cache_snapshot_interval
+        self.snapshot_max_age = config.cache_snapshot_max_age
+        self._snapshot_time = time.time()
+        self._snapshot_dirty = False
+        self.load_cache_snapshot()
         
     def flush(self):
         """
         Calling this will explicity flush all the batches to the 
         server.  Generally only used in testing/dev scripts and not
-        in production when the batches will be self-flushing.
+        in production when the batches will be self-flushing.  With
+        async writes this waits until everything queued so far has 
+        been sent and raises any error the writer thread hit.
         """
         self.log.debug('Flush called')
+        self.rates.push()
+        self.aggs.push()
+        if self.writer:
+            self.writer.flush()
+            return
         self.raw_data.send()
         self.rates.send()
         self.aggs.send()
@@ -271,11 +371,152 @@ class CASSANDRA_DB(object):
         
     def close(self):
         """
-        Explicitly close the connection pool.
+        Explicitly close the connection pool.  If a cache snapshot file 
+        is configured, pending batches are flushed and the caches are 
+        saved first.
         """
         self.log.debug('Close/dispose called')
-        self.pool.dispose()
+        try:
+            if self.snapshot_file:
+                # only snapshot state that has been sent to the database
+                self.flush()
+                self.save_cache_snapshot()
+        finally:
+            if self.writer:
+                self.writer.close()
+            self.executor.shutdown(wait=False)
+            self.page_executor.shutdown(wait=False)
+            self.pool.dispose()
+        
+    def _snapshot_write(self):
+        """
+        Called before each write.  Flushes and saves a snapshot once 
+        snapshot_interval seconds have passed since the last one, then 
+        touches the dirty marker before the first write that follows a 
+        snapshot.  A process that dies before its next save leaves a marker
+        newer than its snapshot, so the snapshot is not loaded.
+        """
+        if not self.snapshot_file:
+            return
+        if self.snapshot_interval and \
+                time.time() - self._snapshot_time >= self.snapshot_interval:
+            self.flush()
+            self.save_cache_snapshot()
+        if not self._snapshot_dirty:
+            self._snapshot_dirty = True
+            try:
+                with open(self.snapshot_file + '.dirty', 'a'):
+                    os.utime(self.snapshot_file + '.dirty', None)
+            except (IOError, OSError) as e:
+                self.log.warn('Unable to mark cache snapshot %s stale: %s' % (self.snapshot_file, e))
         
+    def save_cache_snapshot(self):
+        """
+        Write the metadata and aggregation caches to the snapshot file as
+        gzipped json so the next process can start with warm caches rather
+        than reading every row back from cassandra.  The file is written to
+        a temp file and renamed so a partial snapshot is never loaded.
+        
+        Should only be called when the caches match what has been written
+        to the database (ie: right after a flush) - loading a snapshot
+        that lags behind the database would cause base rate deltas to be 
+        counted twice and min/max values to be overwritten.
+        """
+        if not self.snapshot_file:
+            return
+        
+        t = time.time()
+        self._snapshot_time = t
+        snapshot = {
+            'version': CACHE_SNAPSHOT_VERSION,
+            'keyspace': self.keyspace,
+            'created': t,
+            'metadata': [[k, self._encode_metadata(v)] for k, v in self.metadata_cache.items()],
+            'aggregation': self.aggregation_cache.items(),
+        }
+        
+        tmp_name = None
+        try:
+            fd, tmp_name = tempfile.mkstemp(prefix='.cache_snapshot',
+                dir=os.path.dirname(os.path.abspath(self.snapshot_file)))
+            with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt') as f:
+                json.dump(snapshot, f, separators=(',', ':'))
+            os.replace(tmp_name, self.snapshot_file)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            self.log.warn('Unable to write cache snapshot %s: %s' % (self.snapshot_file, e))
+            if tmp_name and os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            return
+        self._snapshot_dirty = False
+        
+        self.log.info('Wrote cache snapshot %s: %d metadata %d aggregation entries in %.3f sec' %
+            (self.snapshot_file, len(snapshot['metadata']), len(snapshot['aggregation']), time.time() - t))
+        
+    def load_cache_snapshot(self):
+        """
+        Seed the metadata and aggregation caches from the snapshot file if
+        it exists, belongs to this keyspace, is younger than the max age and
+        nothing was written after it was saved.  Metadata entries older than
+        SEEK_BACK_THRESHOLD are skipped just like they would not be found 
+        in the raw data.  The snapshot is left in place, the first write 
+        after loading it marks it stale.
+        """
+        if not self.snapshot_file or not os.path.exists(self.snapshot_file):
+            return
+        
+        t = time.time()
+        try:
+            with gzip.open(self.snapshot_file, 'rt') as f:
+                snapshot = json.load(f)
+        except (IOError, OSError, EOFError, ValueError) as e:
+            self.log.warn('Unable to read cache snapshot %s: %s' % (self.snapshot_file, e))
+            return
+        
+        if snapshot.get('version') != CACHE_SNAPSHOT_VERSION or \
+                snapshot.get('keyspace') != self.keyspace:
+            self.log.info('Ignoring cache snapshot %s from a different version or keyspace' % self.snapshot_file)
+            return
+        age = t - snapshot.get('created', 0)
+        if self.snapshot_max_age and age > self.snapshot_max_age:
+            self.log.info('Ignoring cache snapshot %s that is %d seconds old' % (self.snapshot_file, age))
+            return
+        dirty = self.snapshot_file + '.dirty'
+        if os.path.exists(dirty) and os.path.getmtime(dirty) >= snapshot.get('created', 0):
+            self.log.info('Ignoring cache snapshot %s, data was written after it was saved' % self.snapshot_file)
+            return
+        
+        cutoff = t*1000 - SEEK_BACK_THRESHOLD
+        for k, doc in snapshot['metadata']:
+            if doc['last_update'] is not None and doc['last_update'] < cutoff:
+                continue
+            self.metadata_cache[k] = Metadata(**doc).get_document()
+        for k, row in snapshot['aggregation']:
+            # json turns the bin timestamps into strings
+            self.aggregation_cache[k] = dict((int(ts), v) for ts, v in row.items())
+        
+        self.log.info('Loaded cache snapshot %s: %d metadata %d aggregation entries in %.3f sec' %
+            (self.snapshot_file, len(self.metadata_cache), len(self.aggregation_cache), time.time() - t))
+        
+    def _encode_metadata(self, doc):
+        """
+        Convert the datetimes in a metadata cache entry to JavaScript 
+        timestamps so it can be written as json.
+        """
+        doc = dict(doc)
+        for k in ('last_update', 'min_ts'):
+            if isinstance(doc.get(k), datetime.datetime):
+                doc[k] = calendar.timegm(doc[k].utctimetuple()) * 1000
+        return doc
+        
+    def encode_raw_value(self, val):
+        """
+        Encode a value for the raw data column family. Uses the binary
+        encoding if the column family supports it, otherwise JSON.
+        """
+        if self.raw_binary:
+            return encode_raw_value(val)
+        return json.dumps(val)
+
     def set_raw_data(self, raw_data, ttl=None):
         """
         Called by the persister.  Writes the raw incoming data to the appropriate
@@ -285,6 +526,7 @@ class CASSANDRA_DB(object):
         The raw_data arg passes in is an instance of the RawData class defined
         in this module.
         """
+        self._snapshot_write()
         _kw = {}
         if ttl: 
             _kw['ttl'] = ttl
@@ -292,13 +534,13 @@ class CASSANDRA_DB(object):
         t = time.time()
         # Standard column family update.
         self.raw_data.insert(raw_data.get_key(), 
-            {raw_data.ts_to_jstime(): json.dumps(raw_data.val)}, **_kw)
+            {raw_data.ts_to_jstime(): self.encode_raw_value(raw_data.val)}, **_kw)
         
-        if self.profiling: self.stats.raw_insert(time.time() - t)
+        self.stats.raw_insert(time.time() - t)
         
     def set_metadata(self, k, meta_d):
         """
-        Just does a simple write to the dict being used as metadata.
+        Just does a simple write to the cache being used as metadata.
         """
         self.metadata_cache[k] = meta_d.get_document()
         
@@ -319,13 +561,13 @@ class CASSANDRA_DB(object):
         t = time.time()
 
         meta_d = None
+        meta_doc = self.metadata_cache.get(raw_data.get_meta_key())
         
-        if raw_data.get_meta_key() not in self.metadata_cache:
+        if meta_doc is None:
             # Didn't find a value in the metadata cache.  First look
             # back through the raw data for SEEK_BACK_THRESHOLD seconds
             # to see if we can find the last processed value.
-            ts_max = raw_data.ts_to_jstime() - 1 # -1ms to look at older vals
-            ts_min = ts_max - SEEK_BACK_THRESHOLD
+            ts_min, ts_max = self._seek_back_range(raw_data)
             ret = self.raw_data._column_family.multiget(
                     self._get_row_keys(raw_data.path, raw_data.freq,
                         ts_min, ts_max),
@@ -334,29 +576,100 @@ class CASSANDRA_DB(object):
                     column_start=ts_max, column_finish=ts_min,
                     column_count=1, column_reversed=True)
                     
-            if self.profiling: self.stats.meta_fetch((time.time() - t))
-                    
-            if ret:
-                # A previous value was found in the raw data, so we can
-                # seed/return that.
-                key = list(ret.keys())[-1]
-                ts = list(ret[key].keys())[0]
-                val = json.loads(ret[key][ts])
-                meta_d = Metadata(last_update=ts, last_val=val, min_ts=ts, 
-                    freq=raw_data.freq, path=raw_data.path)
-                self.log.debug('Metadata lookup from raw_data for: %s' %
-                        (raw_data.get_meta_key()))
-            else:
-                # No previous value was found (or at least not one in the defined
-                # time range) so seed/return the current value.
-                meta_d = Metadata(last_update=raw_data.ts, last_val=raw_data.val,
-                    min_ts=raw_data.ts, freq=raw_data.freq, path=raw_data.path)
-                self.log.debug('Initializing metadata for: %s using %s' %
-                        (raw_data.get_meta_key(), raw_data))
-            self.set_metadata(raw_data.get_meta_key(), meta_d)
+            self.stats.meta_fetch((time.time() - t))
+            
+            meta_d = self._seed_metadata(raw_data, ret)
         else:
-            meta_d = Metadata(**self.metadata_cache[raw_data.get_meta_key()])
+            meta_d = Metadata(**meta_doc)
+        
+        return meta_d
+        
+    def prefetch_metadata(self, raw_data_list):
+        """
+        Seed the metadata cache for many measurements at once.  Works like 
+        get_metadata but the lookups for all of the meta keys that are not 
+        already cached are combined into a few large multigets instead of
+        one per key.  Meant to be called by a persister or bulk loader 
+        before processing a large batch of RawData objects, get_metadata
+        will then find them in the cache.
+        
+        Returns the number of meta keys that were seeded.
+        """
+        # earliest data point for each uncached meta key
+        missing = OrderedDict()
+        for raw_data in sorted(raw_data_list, key=lambda r: r.ts_to_jstime()):
+            k = raw_data.get_meta_key()
+            if k not in missing and k not in self.metadata_cache:
+                missing[k] = raw_data
+        
+        seeded = 0
+        pending = deque(missing.values())
+        while pending:
+            # raw data is sorted by time so the combined range of a chunk 
+            # stays close to the range of each entry.
+            chunk, row_keys = [], []
+            while pending and (not chunk or len(row_keys) < self._metadata_prefetch_size):
+                raw_data = pending.popleft()
+                ts_min, ts_max = self._seek_back_range(raw_data)
+                chunk.append((raw_data, ts_min, ts_max, self._get_row_keys(raw_data.path, raw_data.freq, ts_min, ts_max)))
+                row_keys.extend(chunk[-1][3])
+            
+            t = time.time()
+            ts_min = min(c[1] for c in chunk)
+            ts_max = max(c[2] for c in chunk)
+            ret = self.raw_data._column_family.multiget(row_keys,
+                    column_start=ts_max, column_finish=ts_min,
+                    column_count=1, column_reversed=True)
+            self.stats.meta_fetch((time.time() - t))
+            
+            for raw_data, ts_min, ts_max, keys in chunk:
+                rows = OrderedDict((rk, ret[rk]) for rk in keys if rk in ret)
+                if rows:
+                    ts = list(rows[list(rows.keys())[-1]].keys())[0]
+                    if ts > ts_max:
+                        # newer than this data point since the range was
+                        # shared, so leave this one for get_metadata.
+                        continue
+                    elif ts < ts_min:
+                        # outside of this data point's seek back range
+                        rows = None
+                self._seed_metadata(raw_data, rows)
+                seeded += 1
+        
+        return seeded
+        
+    def _seek_back_range(self, raw_data):
+        """
+        Return the (ts_min, ts_max) range of raw data searched for the 
+        previous value of a measurement.
+        """
+        ts_max = raw_data.ts_to_jstime() - 1 # -1ms to look at older vals
+        ts_min = ts_max - SEEK_BACK_THRESHOLD
+        return ts_min, ts_max
         
+    def _seed_metadata(self, raw_data, rows):
+        """
+        Seed the metadata cache for raw_data given the result of the 
+        reversed multiget of its raw data rows and return the Metadata.
+        """
+        if rows:
+            # A previous value was found in the raw data, so we can
+            # seed/return that.
+            key = list(rows.keys())[-1]
+            ts = list(rows[key].keys())[0]
+            val = decode_raw_value(rows[key][ts])
+            meta_d = Metadata(last_update=ts, last_val=val, min_ts=ts, 
+                freq=raw_data.freq, path=raw_data.path)
+            self.log.debug('Metadata lookup from raw_data for: %s' %
+                    (raw_data.get_meta_key()))
+        else:
+            # No previous value was found (or at least not one in the defined
+            # time range) so seed/return the current value.
+            meta_d = Metadata(last_update=raw_data.ts, last_val=raw_data.val,
+                min_ts=raw_data.ts, freq=raw_data.freq, path=raw_data.path)
+            self.log.debug('Initializing metadata for: %s using %s' %
+                    (raw_data.get_meta_key(), raw_data))
+        self.set_metadata(raw_data.get_meta_key(), meta_d)
         return meta_d
         
     def update_metadata(self, k, metadata):
@@ -366,9 +679,15 @@ class CASSANDRA_DB(object):
         
         The metadata arg is a Metadata object defined in this module.
         """
+        self._snapshot_write()
         t = time.time()
+        meta_doc = self.metadata_cache.get(k)
+        if meta_doc is None:
+            # evicted since it was looked up so just store it again.
+            self.set_metadata(k, metadata)
+            return
         for i in ['last_val', 'min_ts', 'last_update']:
-            self.metadata_cache[k][i] = getattr(metadata, i)
+            meta_doc[i] = getattr(metadata, i)
         #self.stats.meta_update((time.time() - t))
     
     def update_rate_bin(self, ratebin):
@@ -378,16 +697,26 @@ class CASSANDRA_DB(object):
         
         The ratebin arg is a BaseRateBin object defined in this module.
         """
-        
+        self._snapshot_write()
         t = time.time()
         # A super column insert.  Both val and is_valid are counter types.
-        try:
-            self.rates.insert(ratebin.get_key(),
-                {ratebin.ts_to_jstime(): {'val': ratebin.val, 'is_valid': ratebin.is_valid}})
-        except MaximumRetryException:
-            self.log.warn("update_rate_bin failed. MaximumRetryException")
+        # Failed writes are logged and counted when the coalescer pushes.
+        self.rates.insert(ratebin.get_key(),
+            {ratebin.ts_to_jstime(): {'val': ratebin.val, 'is_valid': ratebin.is_valid}})
 
-        if self.profiling: self.stats.baserate_update((time.time() - t))
+        self.stats.baserate_update((time.time() - t))
+        
+    def update_aggregation_bin(self, agg):
+        """
+        Add the val and count of an AggregationBin to the counters of its
+        bin.  Used when the caller has already summed the values, the 
+        persister uses update_rate_aggregation.
+        """
+        self._snapshot_write()
+        t = time.time()
+        self.aggs.insert(agg.get_key(),
+            {agg.ts_to_jstime(): {'val': agg.val, str(agg.base_freq): agg.count}})
+        self.stats.aggregation_update((time.time() - t))
         
     def update_rate_aggregation(self, raw_data, agg_ts, freq):
         """
@@ -396,7 +725,7 @@ class CASSANDRA_DB(object):
         The args are a RawData object, the "compressed" aggregation timestamp
         and the frequency of the rollups in seconds.
         """
-        
+        self._snapshot_write()
         t = time.time()
         
         agg = AggregationBin(
@@ -407,19 +736,16 @@ class CASSANDRA_DB(object):
         # Super column update.  The base rate frequency is stored as the column
         # name key that is not 'val' - this will be used by the query interface
         # to generate the averages.  Both values are counter types.
-        try:
-            self.aggs.insert(agg.get_key(),
-                {agg.ts_to_jstime(): {'val': agg.val, str(agg.base_freq): 1}})
-        except MaximumRetryException:
-            self.log.warn("update_rate_aggregation failed. MaximumRetryException")
+        self.aggs.insert(agg.get_key(),
+            {agg.ts_to_jstime(): {'val': agg.val, str(agg.base_freq): 1}})
 
-        if self.profiling: self.stats.aggregation_update((time.time() - t))
+        self.stats.aggregation_update((time.time() - t))
 
     def get_agg_from_cache(self, agg, raw_data):
         """
         Manage aggregations using in-memory state similar to tracking
         the previous value when calculating the base rates.  Cache is a 
-        multi-level dictionary that looks like:
+        bounded LRU cache of dictionaries that looks like:
 
         cache[row_key][timestamp_of_agg_bin] = {'min': 900 'max': .....}
 
@@ -427,7 +753,8 @@ class CASSANDRA_DB(object):
         the stat aggregation column family to see if this is a restart
         situation.  If an entry is found for the agg timestamp/bin 
         that is being processed, the cache is seeded with those values.  
-        This is the only time the database is read.
+        This is the only time the database is read, unless the row has 
+        since been evicted from the cache.
 
         If no entry is found, then the cache is seeded with the initial
         incoming values (new interface added, etc.)
@@ -443,34 +770,37 @@ class CASSANDRA_DB(object):
         """
 
         ret = None
+        row = self.aggregation_cache.get(agg.get_key())
+        cached = row is not None
 
-        if not self.aggregation_cache.get(agg.get_key(), None):
-            self.aggregation_cache[agg.get_key()] = dict()
+        if not cached:
+            row = dict()
             # there is no row key for this aggregation so to 
             # an initial lookup to see if this is a restart and seed 
             # the cache from the currently requested aggregation.
             # this read will only happen once per aggregation row
-            # after startup or when seeing a new interface, etc.
+            # after startup, when seeing a new interface or after
+            # the row has been evicted from the cache, etc.
             try:
                 lookup = self.stat_agg._column_family.get(agg.get_key(), 
                             super_column=agg.ts_to_jstime())
-                self.aggregation_cache[agg.get_key()][agg.ts_to_jstime()] = dict(lookup)
+                row[agg.ts_to_jstime()] = dict(lookup)
             except NotFoundException:
                 pass
 
-
-        if not self.aggregation_cache[agg.get_key()].get(agg.ts_to_jstime(), None):
+        if not row.get(agg.ts_to_jstime(), None):
             # a new bin is being started, so blow away previous 
             # timestamped key for this row and start again so as to 
-            # not be leaking memory.
-            self.aggregation_cache[agg.get_key()] = dict()
-            # and update with the new aggregation bin values.  do not
-            # return a value so update_stat_aggregations will do the 
-            # initial insert().
-            self.aggregation_cache[agg.get_key()][agg.ts_to_jstime()] = \
-                {'min': agg.val, 'max': agg.val, 'min_ts': raw_data.ts_to_jstime(), 'max_ts': raw_data.ts_to_jstime()}
+            # not be leaking memory. and update with the new aggregation
+            # bin values.  do not return a value so 
+            # update_stat_aggregations will do the initial insert().
+            self.aggregation_cache[agg.get_key()] = {agg.ts_to_jstime(): 
+                {'min': agg.val, 'max': agg.val, 'min_ts': raw_data.ts_to_jstime(), 'max_ts': raw_data.ts_to_jstime()}}
         else:
-            ret = self.aggregation_cache[agg.get_key()].get(agg.ts_to_jstime())
+            ret = row.get(agg.ts_to_jstime())
+            if not cached:
+                # seeded from the stat aggregations
+                self.aggregation_cache[agg.get_key()] = row
 
         return ret
 
@@ -478,8 +808,13 @@ class CASSANDRA_DB(object):
         """Helper function to update agg cache when a new min or max happens."""
         assert minmax in ['min', 'max']
 
-        self.aggregation_cache[agg.get_key()][agg.ts_to_jstime()]['{0}'.format(minmax)] = agg.val
-        self.aggregation_cache[agg.get_key()][agg.ts_to_jstime()]['{0}_ts'.format(minmax)] = raw_data.ts_to_jstime()
+        row = self.aggregation_cache.get(agg.get_key())
+        if row is None or agg.ts_to_jstime() not in row:
+            # evicted, will be seeded from the stat aggregations next time.
+            return
+
+        row[agg.ts_to_jstime()]['{0}'.format(minmax)] = agg.val
+        row[agg.ts_to_jstime()]['{0}_ts'.format(minmax)] = raw_data.ts_to_jstime()
 
         
     def update_stat_aggregation(self, raw_data, agg_ts, freq):
@@ -495,7 +830,7 @@ class CASSANDRA_DB(object):
         The args are a RawData object, the "compressed" aggregation timestamp
         and the frequency of the rollups in seconds.
         """
-        
+        self._snapshot_write()
         updated = False
         
         # Create the AggBin object.
@@ -508,7 +843,7 @@ class CASSANDRA_DB(object):
 
         ret = self.get_agg_from_cache(agg, raw_data)
         
-        if self.profiling: self.stats.stat_fetch((time.time() - t))
+        self.stats.stat_fetch((time.time() - t))
         
         t = time.time()
         
@@ -534,7 +869,7 @@ class CASSANDRA_DB(object):
         else:
             pass
         
-        if self.profiling: self.stats.stat_update((time.time() - t))
+        self.stats.stat_update((time.time() - t))
         
         return updated
         
@@ -546,18 +881,7 @@ class CASSANDRA_DB(object):
         list of row keys (ie: more than one if the query spans years) to
         be used as the first argument to a multiget cassandra query.
         """
-       
-        year_start = datetime.datetime.utcfromtimestamp(float(ts_min)/1000.0).year
-        year_finish = datetime.datetime.utcfromtimestamp(float(ts_max)/1000.0).year
-        
-        key_range = []
-        
-        if year_start != year_finish:
-            for year in range(year_start, year_finish+1):
-                key_range.append(get_rowkey(path, freq=freq, year=year))
-        else:
-            key_range.append(get_rowkey(path, freq=freq, year=year_start))
-        return key_range
+        return get_row_keys(path, freq, ts_min, ts_max)
 
     def check_for_valid_keys(self, path=None, freq=None, 
             ts_min=None, ts_max=None, col_fam='rate'):
@@ -570,180 +894,206 @@ class CASSANDRA_DB(object):
 
         keys = self._get_row_keys(path,freq,ts_min,ts_max)
 
+        cf = self.cf_map[col_fam]._column_family
         for key in keys:
+            t = time.time()
             try:
-                self.cf_map[col_fam]._column_family.get(key, column_count=1)
+                cf.get(key, column_count=1)
             except NotFoundException:
                 # Key was not found.
                 pass
             else:
                 # Key was found so mark boolean as good - revisit?
                 found = True
+            self.stats.observe('get', cf.column_family, time.time() - t)
 
         return found
         
-    def query_baserate_timerange(self, path=None, freq=None, 
-            ts_min=None, ts_max=None, cf='average', column_count=None):
+    def fan_out(self, fn, *iterables):
         """
-        Query interface method to retrieve the base rates (generally average 
-        but could be delta as well).
+        Like map(fn, *iterables) but the calls run concurrently on the 
+        executor, one connection pool slot each.  Results are returned 
+        in order and the first exception raised by a call is re-raised.
         """
-        cols = column_count
-        if cols is None:
-            ret_count = self.rates._column_family.multiget_count(
-                self._get_row_keys(path,freq,ts_min,ts_max), 
-                column_start=ts_min, column_finish=ts_max)
-            cols = 0
-            for i in list(ret_count.keys()):
-                cols += ret_count[i]
-            cols += 5
+        return list(self.executor.map(fn, *iterables))
 
-        ret = self.rates._column_family.multiget(
-                self._get_row_keys(path,freq,ts_min,ts_max), 
-                column_start=ts_min, column_finish=ts_max,
-                column_count=cols)
-        
+    def _get_page(self, cf, key, start, ts_max, count):
+        """
+        Read one page of a row slice.  A missing row or an empty slice
+        is an empty page.
+        """
+        t = time.time()
+        try:
+            return cf._column_family.get(key,
+                    column_start=start, column_finish=ts_max,
+                    column_count=count)
+        except NotFoundException:
+            return OrderedDict()
+        finally:
+            self.stats.observe('get_slice', cf._column_family.column_family,
+                    time.time() - t)
+
+    def _page_count(self, column_count):
+        if column_count is None:
+            return self._page_size
+        return min(self._page_size, column_count)
+
+    def _iter_row_slice(self, cf, key, ts_min, ts_max, column_count=None,
+            first_page=None):
+        """
+        Utility generator used by the query interface.
+
+        Walks a single row from ts_min to ts_max in pages of at most
+        _page_size columns, yielding (timestamp, value) tuples until the
+        slice is exhausted or column_count columns have been returned.
+        Each page starts just after the last column of the previous one
+        so nothing is read twice and only one page is held at a time.
+        If first_page is given it is a future for the first page, 
+        already submitted to the page executor.
+        """
+        start = ts_min
+        remaining = column_count
+
+        while True:
+            count = self._page_count(remaining)
+            if first_page is not None:
+                page = first_page.result()
+                first_page = None
+            else:
+                page = self._get_page(cf, key, start, ts_max, count)
+            if not page:
+                # Row does not exist or nothing left in the range.
+                return
+
+            ts = None
+            for ts, val in list(page.items()):
+                yield ts, val
+
+            if len(page) < count:
+                return
+            if remaining is not None:
+                remaining -= len(page)
+                if remaining <= 0:
+                    return
+            # Long comparator, so the next page starts 1ms later.
+            start = ts + 1
+
+    def _iter_columns(self, cf, path, freq, ts_min, ts_max, column_count=None):
+        """
+        Utility generator used by the query interface.
+
+        Walks every year row that the range spans with _iter_row_slice
+        and k-way merges them so (timestamp, value) tuples are yielded in
+        time order no matter what order the row keys come back in.
+        column_count, if given, is the total number of columns to return
+        across all of the rows.  When there is more than one row their 
+        first pages are read concurrently, so a multi-year range costs
+        about one round trip before the merge can start.
+        """
+        keys = self._get_row_keys(path, freq, ts_min, ts_max)
+        if len(keys) == 1:
+            firsts = [None]
+        else:
+            count = self._page_count(column_count)
+            firsts = [self.page_executor.submit(self._get_page, cf, key,
+                    ts_min, ts_max, count) for key in keys]
+        rows = [self._iter_row_slice(cf, key, ts_min, ts_max, column_count, first)
+                for key, first in zip(keys, firsts)]
+
+        if len(rows) == 1:
+            merged = rows[0]
+        else:
+            merged = heapq.merge(*rows, key=lambda col: col[0])
+
+        if column_count is not None:
+            merged = itertools.islice(merged, column_count)
+
+        for ts, val in merged:
+            yield ts, val
+
+    def iter_baserate_timerange(self, path=None, freq=None, 
+            ts_min=None, ts_max=None, cf='average', column_count=None):
+        """
+        Generator version of query_baserate_timerange - yields the base
+        rates one at a time in time order.
+        """
         if cf not in ['average', 'delta']:
             self.log.error('Not a valid option: %s - defaulting to average' % cf)
             cf = 'average'
         
-        # Divisors to return either the average or a delta.
-        if freq is None: freq = 1000
-        value_divisors = { 'average': int(freq/1000), 'delta': 1 }
-        
-        # Just return the results and format elsewhere.
-        results = []
+        # Divisors to return either the average or a delta.  Rows are 
+        # keyed on the freq that was passed in, only the divisor assumes 
+        # one second when it is missing.
+        value_divisors = { 'average': int((freq or 1000)/1000), 'delta': 1 }
         
-        for k,v in list(ret.items()):
-            for kk,vv in list(v.items()):
-                results.append({'ts': kk, 'val': float(vv[b'val']) / value_divisors[cf], 
-                                        'is_valid': vv[b'is_valid']})
-            
-        return results
+        for kk,vv in self._iter_columns(self.rates, path, freq,
+                ts_min, ts_max, column_count):
+            yield {'ts': kk, 'val': float(vv[b'val']) / value_divisors[cf], 
+                    'is_valid': vv[b'is_valid']}
 
-    def query_aggregation_timerange(self, path=None, freq=None, 
+    def iter_aggregation_timerange(self, path=None, freq=None, 
                 ts_min=None, ts_max=None, cf=None, column_count=None):
         """
-        Query interface method to retrieve the aggregation rollups - could
-        be average/min/max.  Different column families will be queried 
-        depending on what value "cf" is set to.
+        Generator version of query_aggregation_timerange - yields the 
+        aggregation rollups one at a time in time order.
         """
-                
         if cf not in AGG_TYPES:
             self.log.error('Not a valid option: %s - defaulting to average' % cf)
             cf = 'average'
         
         if cf == 'average' or cf == 'raw':
-            cols = column_count
-            if cols is None:
-                ret_count = self.aggs._column_family.multiget_count(
-                        self._get_row_keys(path,freq,ts_min,ts_max),
-                        column_start=ts_min, column_finish=ts_max)
-                cols = 0
-                for i in list(ret_count.keys()):
-                    cols += ret_count[i]
-                cols += 5
-
-            # print cols
-            ret = self.aggs._column_family.multiget(
-                    self._get_row_keys(path,freq,ts_min,ts_max), 
-                    column_start=ts_min, column_finish=ts_max,
-                    column_count=cols)
-
-            # Just return the results and format elsewhere.
-            results = []
-            
-            for k,v in list(ret.items()):
-                for kk,vv in list(v.items()):
-                    ts = kk
-                    val = None
-                    base_freq = None
-                    count = None
-                    for kkk in list(vv.keys()):
-                        if kkk == b'val':
-                            val = vv[kkk]
-                        else:
-                            base_freq = kkk
-                            count = vv[kkk]
-                    ab = AggregationBin(**{'ts': ts, 'val': val,'base_freq': int(base_freq), 'count': count, 'cf': cf})
-                    if cf == 'average':
-                        datum = {'ts': ts, 'val': ab.average, 'cf': ab.cf}
+            for kk,vv in self._iter_columns(self.aggs, path, freq,
+                    ts_min, ts_max, column_count):
+                ts = kk
+                val = None
+                base_freq = None
+                count = None
+                for kkk in list(vv.keys()):
+                    if kkk == b'val':
+                        val = vv[kkk]
                     else:
-                        datum = {'ts': ts, 'val': ab.val, 'cf': ab.cf}
-                    results.append(datum)
+                        base_freq = kkk
+                        count = vv[kkk]
+                ab = AggregationBin(**{'ts': ts, 'val': val,'base_freq': int(base_freq), 'count': count, 'cf': cf})
+                if cf == 'average':
+                    yield {'ts': ts, 'val': ab.average, 'cf': ab.cf}
+                else:
+                    yield {'ts': ts, 'val': ab.val, 'cf': ab.cf}
         elif cf == 'min' or cf == 'max':
-            cols = column_count
-            if cols is None:
-                ret_count = self.stat_agg._column_family.multiget_count(
-                        self._get_row_keys(path,freq,ts_min,ts_max),
-                        column_start=ts_min, column_finish=ts_max)
-                cols = 0
-                for i in list(ret_count.keys()):
-                    cols += ret_count[i]
-                cols += 5
-
-            ret = self.stat_agg._column_family.multiget(
-                    self._get_row_keys(path,freq,ts_min,ts_max), 
-                    column_start=ts_min, column_finish=ts_max,
-                    column_count=cols)
-            
-            results = []
-
-            for k,v in list(ret.items()):
-                for kk,vv in list(v.items()):
-                    ts = kk
-                    if cf == 'min':
-                        datum = {'ts': ts, 'val': vv['min'], 'cf': cf, 'm_ts': vv.get('min_ts', None)}
-                        results.append(datum)
-                    else:
-                        datum = {'ts': ts, 'val': vv['max'], 'cf': cf, 'm_ts': vv.get('max_ts', None)}
-                        results.append(datum)
-        
-        return results
-            
-    def query_raw_data(self, path=None, freq=None,
+            for kk,vv in self._iter_columns(self.stat_agg, path, freq,
+                    ts_min, ts_max, column_count):
+                ts = kk
+                if cf == 'min':
+                    yield {'ts': ts, 'val': vv['min'], 'cf': cf, 'm_ts': vv.get('min_ts', None)}
+                else:
+                    yield {'ts': ts, 'val': vv['max'], 'cf': cf, 'm_ts': vv.get('max_ts', None)}
+
+    def iter_raw_data(self, path=None, freq=None,
                 ts_min=None, ts_max=None, column_count=None):
         """
-        Query interface to query the raw data.
+        Generator version of query_raw_data - yields the raw data one
+        at a time in time order.
         """
-        cols = column_count
-        if cols is None:
-            ret_count = self.raw_data._column_family.multiget_count(
-                    self._get_row_keys(path,freq,ts_min,ts_max),
-                    column_start=ts_min, column_finish=ts_max)
-            cols = 0
-            for i in list(ret_count.keys()):
-                cols += ret_count[i]
-            cols += 5
-
-        ret = self.raw_data._column_family.multiget(
-                self._get_row_keys(path,freq,ts_min,ts_max), 
-                column_start=ts_min, column_finish=ts_max,
-                column_count=cols)
-
-        # Just return the results and format elsewhere.
-        results = []
-
-        for k,v in list(ret.items()):
-            for kk,vv in list(v.items()):
-                results.append({'ts': kk, 'val': json.loads(vv)})
-        
-        return results
-
+        for kk,vv in self._iter_columns(self.raw_data, path, freq,
+                ts_min, ts_max, column_count):
+            yield {'ts': kk, 'val': decode_raw_value(vv)}
+            
     def query_raw_first(self, path=None, freq=None, year=None):
         """
         Query interface to query the raw data.
         """
         key = get_rowkey(path,freq,year)
+        t = time.time()
         ret = self.raw_data._column_family.get(
                 key,
                 column_start="",
                 column_count=1
                 )
+        self.stats.observe('get_slice', self.raw_cf, time.time() - t)
         # Just return the results and format elsewhere.
         results=[]
         for k,v in list(ret.items()):
-            results.append({'ts': k, 'val': json.loads(v)})
+            results.append({'ts': k, 'val': decode_raw_value(v)})
         return results
 
     def query_raw_last(self, path=None, freq=None, year=None):
@@ -751,28 +1101,333 @@ class CASSANDRA_DB(object):
         Query interface to query the raw data.
         """
         key = get_rowkey(path,freq,year)
+        t = time.time()
         ret = self.raw_data._column_family.get(
                 key,
                 column_finish="",
                 column_reversed=True,
                 column_count=1
                 )
+        self.stats.observe('get_slice', self.raw_cf, time.time() - t)
         # Just return the results and format elsewhere.
         results=[]
         for k,v in list(ret.items()):
-            results.append({'ts': k, 'val': json.loads(v)})
+            results.append({'ts': k, 'val': decode_raw_value(v)})
         return results
 
     def __del__(self):
         pass
 
+# Counter write coalescing
+
+class CounterCoalescer(object):
+    """
+    Wraps the batch mutator of a counter column family and sums the 
+    increments to the same (row key, column, subcolumn) before passing
+    them on, so a batch carrying several points for the same rate or
+    aggregation bin becomes one mutation per bin.  The summed increments 
+    are handed to the wrapped mutator once max_cells distinct columns are
+    pending or when send() or push() is called.
+    
+    Increments are only coalesced for plain inserts.  Inserts with extra 
+    arguments and removes first push anything pending so the order of 
+    operations on the column family is kept.
+    
+    Since the increments are written when they are pushed rather than 
+    when they are inserted, a MaximumRetryException from the push is 
+    logged and counted as an error_name error here.  pycassa keeps the
+    mutations of a failed send and retries them with the next one.
+    """
+    
+    def __init__(self, mutator, max_cells, log, stats, error_name):
+        self._mutator = mutator
+        self._column_family = mutator._column_family
+        self.max_cells = max_cells
+        self.log = log
+        self.stats = stats
+        self.error_name = error_name
+        self.increments = 0
+        self.mutations = 0
+        self._pending = OrderedDict()
+        self._lock = threading.RLock()
+        
+    def insert(self, key, columns, **kwargs):
+        if kwargs:
+            with self._lock:
+                self.push()
+                self._mutator.insert(key, columns, **kwargs)
+            return
+        
+        with self._lock:
+            for column, val in columns.items():
+                if isinstance(val, dict):
+                    for subcolumn, subval in val.items():
+                        self._add((key, column, subcolumn), subval)
+                else:
+                    self._add((key, column, None), val)
+            if len(self._pending) >= self.max_cells:
+                self.push()
+                
+    def _add(self, cell, val):
+        self.increments += 1
+        self._pending[cell] = self._pending.get(cell, 0) + val
+        
+    def remove(self, *args, **kwargs):
+        with self._lock:
+            self.push()
+            self._mutator.remove(*args, **kwargs)
+        
+    def push(self, mutator=None):
+        """
+        Hand the summed increments to the wrapped mutator without sending.
+        The AsyncBatchWriter passes its own batch for the column family as
+        mutator to push from the writer thread.
+        """
+        if mutator is None:
+            mutator = self._mutator
+        with self._lock:
+            if not self._pending:
+                return
+            rows = OrderedDict()
+            for (key, column, subcolumn), val in self._pending.items():
+                if subcolumn is None:
+                    rows.setdefault(key, OrderedDict())[column] = val
+                else:
+                    rows.setdefault(key, OrderedDict()).setdefault(column, OrderedDict())[subcolumn] = val
+            self.mutations += len(self._pending)
+            self._pending = OrderedDict()
+            for key, columns in rows.items():
+                try:
+                    mutator.insert(key, columns)
+                except MaximumRetryException:
+                    self.log.warn("%s failed. MaximumRetryException" % self.error_name)
+                    self.stats.error(self.error_name, self._column_family.column_family)
+        
+    def send(self):
+        with self._lock:
+            self.push()
+            self._mutator.send()
+
+# Asynchronous write pipeline
+
+class AsyncMutator(object):
+    """
+    Stands in for a pycassa batch mutator when async writes are enabled.
+    Inserts and removes are queued on the AsyncBatchWriter and send()
+    waits for everything queued so far to be written.  The underlying 
+    ColumnFamily is available as _column_family for reads, same as a
+    pycassa mutator.
+    """
+    
+    def __init__(self, writer, column_family):
+        self._writer = writer
+        self._column_family = column_family
+        
+    def insert(self, *args, **kwargs):
+        self._writer.put(self._column_family.column_family, 'insert', args, kwargs)
+        
+    def remove(self, *args, **kwargs):
+        self._writer.put(self._column_family.column_family, 'remove', args, kwargs)
+        
+    def send(self):
+        self._writer.flush()
+
+class AsyncBatchWriter(object):
+    """
+    Background thread that drains a bounded queue of mutations into
+    pycassa batch mutators.  A batch is sent when it reaches batch_size 
+    mutations or when flush_interval seconds have passed since the last
+    send, whichever comes first.  When max_pending mutations are waiting
+    in the queue, callers block until the writer catches up so memory 
+    use stays bounded if cassandra falls behind.
+    
+    Errors from the writer thread are logged and raised from the next
+    flush().  pycassa keeps the mutations of a failed send and retries 
+    them with the next one.
+    
+    The pending increments of CounterCoalescers registered with coalesce()
+    are pushed on each interval send as well, so counters written by a
+    quiet stream are not held back until the next flush().
+    """
+    
+    _FLUSH = 'flush'
+    _STOP = 'stop'
+    
+    def __init__(self, batch_size, flush_interval, max_pending, log):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.log = log
+        self.mutators = {}
+        self.coalescers = []
+        self._queue = queue.Queue(maxsize=max_pending)
+        # mutations queued but not yet applied, by column family
+        self._queued = {}
+        self._queued_lock = threading.Lock()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='cassandra-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def mutator(self, column_family):
+        """
+        Return an AsyncMutator that queues writes to the given pycassa 
+        ColumnFamily.
+        """
+        self.mutators[column_family.column_family] = column_family.batch(self.batch_size)
+        return AsyncMutator(self, column_family)
+        
+    def coalesce(self, coalescer):
+        """
+        Push the pending increments of a CounterCoalescer wrapping one of
+        the AsyncMutators with each interval send.
+        """
+        self.coalescers.append(coalescer)
+        
+    def put(self, cf_name, method, args, kwargs):
+        if not self._thread.is_alive():
+            raise ConnectionException('Cassandra writer thread is not running')
+        with self._queued_lock:
+            self._queued[cf_name] = self._queued.get(cf_name, 0) + 1
+        # blocks when the queue is full
+        self._queue.put((cf_name, method, args, kwargs))
+        
+    def flush(self):
+        """
+        Wait until everything queued before this call has been sent.
+        """
+        if not self._thread.is_alive():
+            raise ConnectionException('Cassandra writer thread is not running')
+        done = threading.Event()
+        self._queue.put((self._FLUSH, done, None, None))
+        done.wait()
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+        
+    def close(self):
+        """
+        Send anything that is queued and stop the writer thread.
+        """
+        if self._thread.is_alive():
+            self._queue.put((self._STOP, None, None, None))
+            self._thread.join()
+        
+    def _push_coalescers(self):
+        for coalescer in self.coalescers:
+            cf_name = coalescer._column_family.column_family
+            # A thread holding the lock is pushing already and may be
+            # blocked on the full queue, so don't wait for it.
+            if not coalescer._lock.acquire(False):
+                continue
+            try:
+                # The increments go straight into the batch, so only push
+                # when nothing is queued for the column family that they
+                # could overtake, like a remove.
+                with self._queued_lock:
+                    queued = self._queued.get(cf_name, 0)
+                if not queued:
+                    coalescer.push(self.mutators[cf_name])
+            finally:
+                coalescer._lock.release()
+        
+    def _send_all(self):
+        for cf_name, mutator in self.mutators.items():
+            try:
+                mutator.send()
+            except Exception as e:
+                self.log.error('Async write to %s failed: %s' % (cf_name, e))
+                self._error = e
+        
+    def _run(self):
+        last_send = time.time()
+        while True:
+            timeout = None
+            if self.flush_interval:
+                timeout = max(0, self.flush_interval - (time.time() - last_send))
+            try:
+                cf_name, method, args, kwargs = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._push_coalescers()
+                self._send_all()
+                last_send = time.time()
+                continue
+            
+            if cf_name == self._FLUSH:
+                self._send_all()
+                last_send = time.time()
+                method.set()
+            elif cf_name == self._STOP:
+                self._push_coalescers()
+                self._send_all()
+                return
+            else:
+                # the mutator sends on its own once batch_size is reached
+                try:
+                    getattr(self.mutators[cf_name], method)(*args, **kwargs)
+                except Exception as e:
+                    self.log.error('Async %s to %s failed: %s' % (method, cf_name, e))
+                    self._error = e
+                finally:
+                    with self._queued_lock:
+                        self._queued[cf_name] -= 1
+                # the queue may never run empty under a steady load
+                if self.flush_interval and \
+                        time.time() - last_send >= self.flush_interval:
+                    self._push_coalescers()
+                    self._send_all()
+                    last_send = time.time()
+
 # Stats/timing code for connection class
 
+def instrument_mutator(mutator, stats):
+    """
+    Record the size and send time of each batch sent by a pycassa batch 
+    mutator, including the sends it does on its own when its queue 
+    fills up.
+    """
+    cf = mutator._column_family.column_family
+    send = mutator.send
+    
+    def timed_send(*args, **kwargs):
+        size = len(mutator._buffer)
+        if not size:
+            return send(*args, **kwargs)
+        t = time.time()
+        try:
+            ret = send(*args, **kwargs)
+        except Exception:
+            stats.error('batch_send', cf)
+            raise
+        stats.batch_sent(cf, size, time.time() - t)
+        return ret
+    
+    mutator.send = timed_send
+    return mutator
+
+class PoolMetricsListener(object):
+    """
+    pycassa pool listener that counts failed connections (each of which 
+    the pool retries) and exhaustion of the pool in DatabaseMetrics.
+    """
+    
+    def __init__(self, stats):
+        self.stats = stats
+        
+    def connection_failed(self, dic):
+        self.stats.connection_failed()
+        
+    def pool_at_max(self, dic):
+        self.stats.pool_at_max()
+
+
 class DatabaseMetrics(object):
     """
     Code to handle calculating timing statistics for discrete database
-    calls in the CASSANDRA_DB module.  Generally only used in development 
-    to produce statistics when pushing runs of test data through it.
+    calls in the storage backends.  Every call is recorded in the latency
+    histograms of esmond.metrics, which are served by the /metrics
+    endpoint.  The per call totals printed by report() are only kept 
+    when profiling, generally in development when pushing runs of test 
+    data through it.
     """
     
     # List of attributes to generate/method names.
@@ -784,11 +1439,25 @@ class DatabaseMetrics(object):
         'stat_fetch', 
         'stat_update',
     ]
-    _all_metrics = _individual_metrics + ['total', 'all']
+    _all_metrics = _individual_metrics + ['total', 'caches', 'all']
     
-    def __init__(self, profiling=False):
+    # Column family each of the named calls reads or writes.
+    _metric_cf = {
+        'raw_insert': 'raw_data',
+        'baserate_update': 'base_rates',
+        'aggregation_update': 'rate_aggregations',
+        'meta_fetch': 'raw_data',
+        'stat_fetch': 'stat_aggregations',
+        'stat_update': 'stat_aggregations',
+    }
+    
+    def __init__(self, profiling=False, backend='cassandra'):
         
         self.profiling = profiling
+        self.backend = backend
+        # Caches are tracked whether profiling or not since they keep 
+        # their own counters.
+        self.caches = OrderedDict()
         
         if not self.profiling:
             return
@@ -800,12 +1469,59 @@ class DatabaseMetrics(object):
         
     def _increment(self, m, t):
         """
-        Actual logic called by named wrapper methods.  Increments
-        the time sums and counts for the various db calls.
+        Actual logic called by named wrapper methods.  Records the call
+        in the latency histogram and, when profiling, increments the 
+        time sums and counts for the various db calls.
         """
+        self.observe(m, self._metric_cf[m], t)
+        if not self.profiling:
+            return
         setattr(self, '%s_time' % m, getattr(self, '%s_time' % m) + t)
         setattr(self, '%s_count' % m, getattr(self, '%s_count' % m) + 1)
         
+    def observe(self, op, cf, t):
+        """
+        Record a call that took t seconds.
+        """
+        metrics.registry.observe('esmond_db_operation_seconds',
+            (('backend', self.backend), ('op', op), ('cf', cf)), t,
+            help='Time spent in storage backend calls.')
+        
+    def batch_sent(self, cf, size, t):
+        """
+        Record a batch of size mutations that took t seconds to send.
+        """
+        metrics.registry.observe('esmond_db_batch_size',
+            (('backend', self.backend), ('cf', cf)), size,
+            help='Mutations in each batch sent.', buckets=metrics.SIZE_BUCKETS)
+        self.observe('batch_send', cf, t)
+        
+    def error(self, op, cf):
+        """
+        Count a call that failed, after any retries.
+        """
+        metrics.registry.inc('esmond_db_errors_total',
+            (('backend', self.backend), ('op', op), ('cf', cf)),
+            help='Storage backend calls that failed after retrying.')
+        
+    def connection_failed(self):
+        """
+        Count a failed connection or request to a server, which is retried
+        on another connection.  The server is left out of the labels so
+        the metrics don't publish the addresses of the cluster.
+        """
+        metrics.registry.inc('esmond_db_connection_failures_total',
+            (('backend', self.backend),),
+            help='Failed connections or requests to a server, each is retried.')
+        
+    def pool_at_max(self):
+        """
+        Count the times the connection pool had no connection to hand out.
+        """
+        metrics.registry.inc('esmond_db_pool_at_max_total',
+            (('backend', self.backend),),
+            help='Times the connection pool was exhausted.')
+        
     # These are all wrapper methods that call _increment()
 
     def raw_insert(self, t):
@@ -826,6 +1542,21 @@ class DatabaseMetrics(object):
     def stat_update(self, t):
         self._increment('stat_update', t)
         
+    def add_cache(self, name, cache):
+        """
+        Register an LRUCache so its counters are included in reports
+        and exported by the /metrics endpoint.
+        """
+        self.caches[name] = cache
+        metrics.registry.add_cache(name, cache)
+        
+    def cache_stats(self):
+        """
+        Return a dict of cache name to the size and hit/miss/eviction
+        counters of that cache.
+        """
+        return dict((name, cache.stats()) for name, cache in self.caches.items())
+        
     def report(self, metric='all'):
         """
         Called at the end of a test harness or other loading dev script.  
@@ -867,6 +1598,10 @@ class DatabaseMetrics(object):
             if time:
                 s = 'Total: %s db transactions in %.3f (%.3f per sec)' \
                     % (count, time, (count/time))
+        elif metric == 'caches':
+            for name, cs in self.cache_stats().items():
+                print('Cache %s: %s entries %s bytes %s hits %s misses %s evictions' \
+                    % (name, cs['entries'], cs['bytes'], cs['hits'], cs['misses'], cs['evictions']))
         elif metric == 'all':
             for m in self._all_metrics:
                 if m == 'all':
@@ -880,6 +1615,13 @@ class DatabaseMetrics(object):
 # Data encapsulation objects - these objects wrap the various data
 # in an object and provide utility methods and properties to convert 
 # timestampes, calculate averages, etc.
+#
+# A container is created for every data point written so they use 
+# __slots__ to keep them small and cheap to allocate. The row key and 
+# millisecond timestamp are computed once and cached since the write path
+# asks for them several times per point. The caches are reset when the
+# path, freq or ts is assigned. Modifying the path list in place does not
+# reset them.
         
 class DataContainerBase(object):
     """
@@ -887,11 +1629,23 @@ class DataContainerBase(object):
     utility methods for subclasses.
     """
     
-    _doc_properties = []
+    __slots__ = ('_path', '_key')
+    
+    _doc_fields = ('path',)
     
     def __init__(self, path):
+        self._key = None
         self.path = path
         
+    @property
+    def path(self):
+        return self._path
+        
+    @path.setter
+    def path(self, value):
+        self._path = value
+        self._key = None
+        
     def _handle_date(self,d):
         """
         Return a datetime object given a JavaScript timestamp.
@@ -907,13 +1661,8 @@ class DataContainerBase(object):
         Return a dictionary of the attrs/props in the object.
         """
         doc = {}
-        for k,v in list(self.__dict__.items()):
-            if k.startswith('_'):
-                continue
-            doc[k] = v
-            
-        for p in self._doc_properties:
-            doc[p] = getattr(self, '%s' % p)
+        for k in self._doc_fields:
+            doc[k] = getattr(self, k)
         
         return doc
 
@@ -921,7 +1670,9 @@ class DataContainerBase(object):
         """
         Return a cassandra row key based on the contents of the object.
         """
-        return get_rowkey(self.path)
+        if self._key is None:
+            self._key = get_rowkey(self.path)
+        return self._key
         
     def ts_to_jstime(self, t='ts'):
         """
@@ -949,11 +1700,12 @@ class RawData(DataContainerBase):
     Can be instantiated from args when reading from persist queue, or via **kw
     when reading data back out of Cassandra.
     """
-    _doc_properties = ['ts']
+    __slots__ = ('_ts', '_jstime', 'val')
+    
+    _doc_fields = ('path', 'ts', 'val')
 
     def __init__(self, path=None, ts=None, val=None):
         DataContainerBase.__init__(self, path)
-        self._ts = None
         self.ts = ts
         self.val = val
 
@@ -965,7 +1717,20 @@ class RawData(DataContainerBase):
         one year's worth of data.  This is an implementation detail for using
         Cassandra effectively.
         """
-        return get_rowkey(self.path, year=self.ts.year)
+        if self._key is None:
+            self._key = get_rowkey(self.path, year=self.ts.year)
+        return self._key
+
+    def ts_to_jstime(self, t='ts'):
+        """
+        Same as DataContainerBase.ts_to_jstime() but caches the value 
+        for 'ts'.
+        """
+        if t != 'ts':
+            return DataContainerBase.ts_to_jstime(self, t)
+        if self._jstime is None:
+            self._jstime = calendar.timegm(self._ts.utctimetuple()) * 1000
+        return self._jstime
 
     @property
     def ts(self):
@@ -974,13 +1739,17 @@ class RawData(DataContainerBase):
     @ts.setter
     def ts(self, value):
         self._ts = self._handle_date(value)
+        self._jstime = None
+        self._key = None
 
 
 class RawRateData(RawData):
     """
     Container for raw data for rate based rows.
     """
-    _doc_properties = ['ts']
+    __slots__ = ('_freq', '_meta_key')
+    
+    _doc_fields = ('path', 'ts', 'val', 'freq')
 
     def __init__(self, path=None, ts=None, val=None, freq=None):
         RawData.__init__(self, path, ts, val)
@@ -994,6 +1763,24 @@ class RawRateData(RawData):
         return "<RawRateData/%d: ts=%s, val=%s, path=%s>" % \
             (id(self), self.ts, self.val, self.path)
 
+    @property
+    def path(self):
+        return self._path
+        
+    @path.setter
+    def path(self, value):
+        self._path = value
+        self._key = self._meta_key = None
+
+    @property
+    def freq(self):
+        return self._freq
+        
+    @freq.setter
+    def freq(self, value):
+        self._freq = value
+        self._key = self._meta_key = None
+
     def get_key(self):
         """
         Return a cassandra row key based on the contents of the object.
@@ -1001,14 +1788,18 @@ class RawRateData(RawData):
         For rate data we add the frequency to the row key before the year, see
         the RawData.get_key() documentation for details about the year.
         """
-        return get_rowkey(self.path, freq=self.freq, year=self.ts.year)
+        if self._key is None:
+            self._key = get_rowkey(self.path, freq=self.freq, year=self.ts.year)
+        return self._key
 
     def get_meta_key(self):
         """
         Get a "metadata row key" - metadata don't have timestamps/years.
         Other objects use this to look up entires in the metadata_cache.
         """
-        return get_rowkey(self.path, freq=self.freq)
+        if self._meta_key is None:
+            self._meta_key = get_rowkey(self.path, freq=self.freq)
+        return self._meta_key
         
     @property
     def min_last_update(self):
@@ -1024,11 +1815,12 @@ class Metadata(DataContainerBase):
     Container for metadata information.
     """
     
-    _doc_properties = ['min_ts', 'last_update']
+    __slots__ = ('_min_ts', '_last_update', 'last_val', 'freq')
+    
+    _doc_fields = ('path', 'last_val', 'freq', 'min_ts', 'last_update')
     
     def __init__(self, path=None, last_update=None, last_val=None, min_ts=None, freq=None):
         DataContainerBase.__init__(self, path)
-        self._min_ts = self._last_update = None
         self.last_update = last_update
         self.last_val = last_val
         self.min_ts = min_ts
@@ -1076,7 +1868,9 @@ class BaseRateBin(RawRateData):
     Container for base rates.  Has 'average' property to return the averages.
     """
     
-    _doc_properties = ['ts']
+    __slots__ = ('is_valid',)
+    
+    _doc_fields = ('path', 'ts', 'val', 'freq', 'is_valid')
     
     def __init__(self, path=None, ts=None, val=None, freq=None, is_valid=1):
         RawRateData.__init__(self, path, ts, val, freq)
@@ -1092,6 +1886,11 @@ class AggregationBin(BaseRateBin):
     Container for aggregation rollups.  Also has 'average' property to generage averages.
     """
     
+    __slots__ = ('count', 'min', 'max', 'base_freq', 'cf')
+    
+    _doc_fields = ('path', 'ts', 'val', 'freq', 'is_valid', 'count', 'min', 
+        'max', 'base_freq', 'cf')
+    
     def __init__(self, path=None, ts=None, val=None, freq=None, base_freq=None, count=None, 
             min=None, max=None, cf=None):
         BaseRateBin.__init__(self, path, ts, val, freq)
@@ -1106,30 +1905,86 @@ class AggregationBin(BaseRateBin):
     def average(self):
         return self.val / (self.count * (self.base_freq/1000.0))
 
+# Row key construction. The set of distinct (path, freq, year) row keys
+# is small and the same keys are built on every write and query, so they
+# are memoized in bounded caches. Cached keys are interned so every caller
+# shares one string per row.
+
+ROWKEY_CACHE_SIZE = 100000
+YEAR_CACHE_SIZE = 10000
+
 def escape_path(path):
+    return list(_escape_path(tuple(path)))
+
+@functools.lru_cache(maxsize=ROWKEY_CACHE_SIZE)
+def _escape_path(path):
     escaped = []
     for step in path:
         escaped.append(step.replace(KEY_DELIMITER, 
             "\\%s" % KEY_DELIMITER))
 
-    return escaped
+    return tuple(escaped)
 
 def get_rowkey(path, freq=None, year=None):
     """
     Given a path and some additional data build the Cassandra row key.
 
     The freq and year arguments are used for internal book keeping inside
-    Cassandra.
+    Cassandra. Keys are memoized, see build_rowkey() for the uncached
+    version.
     """
+    return _get_rowkey(tuple(path), freq, year)
 
+@functools.lru_cache(maxsize=ROWKEY_CACHE_SIZE)
+def _get_rowkey(path, freq, year):
+    return sys.intern(build_rowkey(path, freq, year))
 
+def build_rowkey(path, freq=None, year=None):
+    """
+    Build a Cassandra row key without using the memo cache.
+    """
     appends = []
     if freq:
         appends.append(str(freq))
     if year:
         appends.append(str(year))
 
-    return KEY_DELIMITER.join(escape_path(path) + appends)
+    return KEY_DELIMITER.join(list(_escape_path(tuple(path))) + appends)
+
+def get_row_keys(path, freq, ts_min, ts_max):
+    """
+    Return the row keys for path and freq covering the years from ts_min
+    to ts_max (JavaScript timestamps). Memoized on the years.
+    """
+    return list(_get_year_row_keys(tuple(path), freq, get_year(ts_min), get_year(ts_max)))
+
+@functools.lru_cache(maxsize=ROWKEY_CACHE_SIZE)
+def _get_year_row_keys(path, freq, year_start, year_finish):
+    key_range = []
+    
+    if year_start != year_finish:
+        for year in range(year_start, year_finish+1):
+            key_range.append(get_rowkey(path, freq=freq, year=year))
+    else:
+        key_range.append(get_rowkey(path, freq=freq, year=year_start))
+    return tuple(key_range)
+
+def get_year(ts):
+    """
+    Return the UTC year of a JavaScript timestamp. Memoized by day.
+    """
+    return _get_year(int(float(ts) // 86400000))
+
+@functools.lru_cache(maxsize=YEAR_CACHE_SIZE)
+def _get_year(day):
+    return datetime.datetime.utcfromtimestamp(day * 86400.0).year
+
+def clear_rowkey_caches():
+    """
+    Empty the row key and year memo caches.
+    """
+    for f in (_escape_path, _get_rowkey, _get_year_row_keys, _get_year):
+        f.cache_clear()
 
 def _split_rowkey(s, escape='\\'):
     """
@@ -1156,3 +2011,107 @@ def _split_rowkey(s, escape='\\'):
     out.append(s[last:])
 
     return out
+
+# Raw value encoding. Columns in the raw data column family were 
+# originally always JSON text. When raw_data_binary is turned on and the
+# column family validates values as BytesType they are written in a
+# versioned binary format instead:
+#
+#   \x00 <version> <kind> <payload>
+#
+# JSON text never starts with a NUL byte so the two can be mixed in the
+# same row and decode_raw_value() reads either. The kinds are:
+#
+#   H - histogram with string buckets and integer counts. The payload is
+#       the array typecode of the counts, the number of buckets as a
+#       little endian uint32, the counts as a packed little endian integer
+#       array and the bucket labels as NUL separated UTF-8.
+#   Z - zlib compressed JSON.
+#
+# Small values that aren't histograms are left as plain JSON text since
+# that is already the smallest form.
+
+RAW_ENCODING_MARKER = b'\x00'
+RAW_ENCODING_VERSION = 1
+RAW_HISTOGRAM = b'H'
+RAW_ZLIB_JSON = b'Z'
+RAW_COMPRESS_MIN_SIZE = 128
+_COUNT_TYPECODES = [(t, array.array(t).itemsize) for t in ('B', 'H', 'I', 'q')]
+
+def encode_raw_value(val):
+    """
+    Encode a raw data value in the binary format, or as JSON text if that
+    is smaller. Returns bytes.
+    """
+    text = json.dumps(val).encode('utf-8')
+    packed = _pack_histogram(val)
+    if packed is not None and len(packed) < len(text):
+        return packed
+
+    if len(text) >= RAW_COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(text)
+        if len(compressed) + 3 < len(text):
+            return RAW_ENCODING_MARKER + bytes([RAW_ENCODING_VERSION]) + RAW_ZLIB_JSON + compressed
+
+    return text
+
+def decode_raw_value(val):
+    """
+    Decode a raw data value written either as JSON text or in the binary
+    format.
+    """
+    if isinstance(val, str) or val[:1] != RAW_ENCODING_MARKER:
+        return json.loads(val)
+
+    if val[1] != RAW_ENCODING_VERSION:
+        raise ValueError("Unsupported raw value encoding version %d" % val[1])
+
+    kind = val[2:3]
+    if kind == RAW_HISTOGRAM:
+        return _unpack_histogram(val)
+    elif kind == RAW_ZLIB_JSON:
+        return json.loads(zlib.decompress(val[3:]))
+
+    raise ValueError("Unknown raw value encoding %r" % kind)
+
+def _pack_histogram(val):
+    """
+    Return val packed as a histogram or None if it isn't a non-empty dict 
+    of string buckets and integer counts.
+    """
+    if not isinstance(val, dict) or not val:
+        return None
+
+    for k, v in val.items():
+        if type(k) is not str or type(v) is not int or '\x00' in k:
+            return None
+
+    counts = list(val.values())
+    low, high = min(counts), max(counts)
+    if low < 0:
+        typecode = 'q'
+    else:
+        for typecode, size in _COUNT_TYPECODES:
+            if high < 2 ** (8 * size):
+                break
+    try:
+        packed = array.array(typecode, counts)
+    except OverflowError:
+        return None
+    if sys.byteorder != 'little':
+        packed.byteswap()
+
+    return b''.join([RAW_ENCODING_MARKER, bytes([RAW_ENCODING_VERSION]), 
+        RAW_HISTOGRAM, typecode.encode('ascii'), struct.pack('<I', len(counts)),
+        packed.tobytes(), '\x00'.join(val.keys()).encode('utf-8')])
+
+def _unpack_histogram(val):
+    typecode = chr(val[3])
+    (num_buckets,) = struct.unpack_from('<I', val, 4)
+    end = 8 + num_buckets * array.array(typecode).itemsize
+    counts = array.array(typecode, val[8:end])
+    if sys.byteorder != 'little':
+        counts.byteswap()
+    keys = val[end:].decode('utf-8').split('\x00')
+
+    return dict(zip(keys, counts.tolist()))
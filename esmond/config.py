@@ -5,6 +5,7 @@ from logging.handlers import SysLogHandler
 import configparser
 
 from esmond.error import ConfigError
+from esmond.storage import STORAGE_BACKENDS
 
 def get_config_path():
     if 'ESMOND_CONF' in os.environ:
@@ -48,16 +49,25 @@ class EsmondConfig(object):
         self.file = file
 
         self.agg_tsdb_root = None
+        self.aggregation_cache_max_bytes = 64*1024*1024
+        self.aggregation_cache_max_entries = 100000
         self.allowed_hosts = []
         self.api_anon_limit = None
         self.api_throttle_at = None
         self.api_throttle_timeframe = None
         self.api_throttle_expiration = None
+        self.cache_snapshot_file = None
+        self.cache_snapshot_interval = 300
+        self.cache_snapshot_max_age = 3600
+        self.cassandra_async_writes = False
         self.cassandra_keyspace = 'esmond'
         self.cassandra_pass = None
         self.cassandra_servers = []
         self.cassandra_user = None
         self.cassandra_replicas = 1
+        self.cassandra_write_batch_size = 200
+        self.cassandra_write_flush_interval = 1.0
+        self.cassandra_write_queue_size = 10000
         # Leave this here so testing code can explicitly set but remove
         # from config file parsing.
         self.db_clear_on_testing = False
@@ -69,22 +79,38 @@ class EsmondConfig(object):
         self.esdb_uri = None
         self.espersistd_uri = None
         self.espoll_persist_uri = None
+        self.histogram_cache_max_entries = 10000
+        self.histogram_flush_interval = 0
         self.htpasswd_file = None
+        self.metadata_cache_max_bytes = 256*1024*1024
+        self.metadata_cache_max_entries = 500000
+        self.metrics_allowed_ips = '127.0.0.1, ::1'
         self.mib_dirs = []
         self.mibs = []
         self.pid_dir = None
         self.poll_retries = 5
         self.poll_timeout = 2
         self.profile_persister = False
+        self.raw_data_binary = False
         self.reload_interval = 1*10
+        self.result_cache = None
+        self.result_cache_immutable_after = 86400
+        self.result_cache_immutable_ttl = 86400
+        self.result_cache_max_bytes = 64*1024*1024
+        self.result_cache_max_entries = 10000
+        self.result_cache_recent_ttl = 60
+        self.result_cache_shared_backend = 'django.core.cache.backends.memcached.MemcachedCache'
+        self.result_cache_shared_location = None
         self.rrd_path = None
         self.send_error_email = False
+        self.sqlite_storage_file = None
         self.sql_db_engine = ''
         self.sql_db_host = ''
         self.sql_db_name = ''
         self.sql_db_password = ''
         self.sql_db_port = ''
         self.sql_db_user = ''
+        self.storage_backend = 'cassandra'
         self.streaming_log_dir = None
         self.syslog_facility = None
         self.syslog_priority = None
@@ -109,14 +135,23 @@ class EsmondConfig(object):
         config_items = [x[0] for x in cfg.items("main")]
         for opt in (
                 'agg_tsdb_root',
+                'aggregation_cache_max_bytes',
+                'aggregation_cache_max_entries',
                 'allowed_hosts',
                 'api_anon_limit',
                 'api_throttle_at',
                 'api_throttle_timeframe',
                 'api_throttle_expiration',
+                'cache_snapshot_file',
+                'cache_snapshot_interval',
+                'cache_snapshot_max_age',
+                'cassandra_async_writes',
                 'cassandra_pass',
                 'cassandra_servers',
                 'cassandra_user',
+                'cassandra_write_batch_size',
+                'cassandra_write_flush_interval',
+                'cassandra_write_queue_size',
                 'db_profile_on_testing',
                 'db_uri',
                 'debug',
@@ -126,14 +161,28 @@ class EsmondConfig(object):
                 'esdb_uri',
                 'espersistd_uri',
                 'espoll_persist_uri',
+                'histogram_cache_max_entries',
+                'histogram_flush_interval',
                 'htpasswd_file',
+                'metadata_cache_max_bytes',
+                'metadata_cache_max_entries',
+                'metrics_allowed_ips',
                 'mib_dirs',
                 'mibs',
                 'pid_dir',
                 'poll_retries',
                 'poll_timeout',
                 'profile_persister',
+                'raw_data_binary',
                 'reload_interval',
+                'result_cache',
+                'result_cache_immutable_after',
+                'result_cache_immutable_ttl',
+                'result_cache_max_bytes',
+                'result_cache_max_entries',
+                'result_cache_recent_ttl',
+                'result_cache_shared_backend',
+                'result_cache_shared_location',
                 'rrd_path',
                 'sql_db_engine',
                 'sql_db_host',
@@ -141,6 +190,8 @@ class EsmondConfig(object):
                 'sql_db_password',
                 'sql_db_port',
                 'sql_db_user',
+                'sqlite_storage_file',
+                'storage_backend',
                 'streaming_log_dir',
                 'syslog_facility',
                 'syslog_priority',
@@ -149,15 +200,25 @@ class EsmondConfig(object):
                 'tsdb_root',
                 ):
             if opt in config_items:
-                setattr(self, opt, cfg.get("main", opt))
+                val = cfg.get("main", opt)
+                # a blank result cache option is the same as leaving it
+                # out, apart from the limits where blank means unbounded
+                if opt.startswith('result_cache') and '_max_' not in opt and not val.strip():
+                    continue
+                setattr(self, opt, val)
 
         boolean_options = (
+            'cassandra_async_writes',
             'db_profile_on_testing',
             'profile_persister',
+            'raw_data_binary',
             'debug',
+            'result_cache',
         )
 
         for key, val in cfg.items('main'):
+            if key == 'result_cache' and not val.strip():
+                continue
             if key in boolean_options:
                 setattr(self, key, cfg.getboolean('main', key))
         
@@ -182,6 +243,10 @@ class EsmondConfig(object):
         if self.allowed_hosts:
             self.allowed_hosts = list(map(str.strip, self.allowed_hosts.split(',')))
 
+        if self.metrics_allowed_ips is not None:
+            self.metrics_allowed_ips = [ip for ip in 
+                map(str.strip, self.metrics_allowed_ips.split(',')) if ip]
+
         if self.mib_dirs:
             self.mib_dirs = list(map(str.strip, self.mib_dirs.split(',')))
 
@@ -203,8 +268,34 @@ class EsmondConfig(object):
             self.api_throttle_timeframe = int(self.api_throttle_timeframe)
         if self.api_throttle_expiration:
             self.api_throttle_expiration = int(self.api_throttle_expiration)
-
-
+        if self.cassandra_write_batch_size:
+            self.cassandra_write_batch_size = int(self.cassandra_write_batch_size)
+        if self.cassandra_write_flush_interval:
+            self.cassandra_write_flush_interval = float(self.cassandra_write_flush_interval)
+        if self.cassandra_write_queue_size:
+            self.cassandra_write_queue_size = int(self.cassandra_write_queue_size)
+        if self.cache_snapshot_interval:
+            self.cache_snapshot_interval = int(self.cache_snapshot_interval)
+        if self.cache_snapshot_max_age:
+            self.cache_snapshot_max_age = int(self.cache_snapshot_max_age)
+        for opt in ('histogram_flush_interval',
+                    'result_cache_immutable_after',
+                    'result_cache_immutable_ttl',
+                    'result_cache_recent_ttl'):
+            setattr(self, opt, int(getattr(self, opt)))
+        # cache limits of 0 or blank mean unbounded
+        for opt in ('aggregation_cache_max_bytes',
+                    'aggregation_cache_max_entries',
+                    'histogram_cache_max_entries',
+                    'metadata_cache_max_bytes',
+                    'metadata_cache_max_entries',
+                    'result_cache_max_bytes',
+                    'result_cache_max_entries'):
+            val = getattr(self, opt)
+            setattr(self, opt, int(val) if val else None)
+
+        if self.storage_backend not in STORAGE_BACKENDS:
+            raise ConfigError("invalid config: unknown storage_backend %s" % self.storage_backend)
 
         if self.error_email_to is not None \
                 and self.error_email_subject is not None \
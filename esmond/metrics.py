@@ -0,0 +1,167 @@
+"""
+Process wide metrics rendered in the Prometheus text exposition format.
+
+Histograms and counters are kept in memory by the registry and are cheap
+enough to update on every database call.  Values that other objects
+already count, like the hit/miss counters of an LRUCache, are read when
+the metrics are rendered by collectors instead of being copied on every
+update.
+"""
+
+import bisect
+import threading
+from collections import OrderedDict
+
+# seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# mutations
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 500, 1000, 2500, 5000)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram(object):
+    """
+    Cumulative histogram with fixed bucket upper bounds.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            yield name + '_bucket', labels + (('le', _format_value(float(bound))),), cumulative
+        yield name + '_sum', labels, total
+        yield name + '_count', labels, count
+
+class Counter(object):
+    """
+    Monotonic counter.
+    """
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        with self.lock:
+            yield name, labels, self.value
+
+class MetricsRegistry(object):
+    """
+    Thread safe registry of named histograms and counters, each with any
+    number of label sets.  Labels are passed as a tuple of (name, value)
+    pairs.  Every series has its own lock, the registry lock is only
+    taken to add a series or to list them when rendering.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._series = {}
+        self._lock = threading.Lock()
+        self._collectors = OrderedDict()
+
+    def _get_series(self, name, kind, help, labels, factory):
+        series = self._series.get((name, labels))
+        if series is None:
+            with self._lock:
+                series = self._series.get((name, labels))
+                if series is None:
+                    metric = self._metrics.get(name)
+                    if metric is None:
+                        metric = self._metrics[name] = (kind, help, OrderedDict())
+                    series = metric[2][labels] = factory()
+                    self._series[(name, labels)] = series
+        return series
+
+    def observe(self, name, labels, value, help='', buckets=LATENCY_BUCKETS):
+        """
+        Add value to the histogram name with the given labels.
+        """
+        self._get_series(name, 'histogram', help, labels,
+            lambda: Histogram(buckets)).observe(value)
+
+    def inc(self, name, labels, amount=1, help=''):
+        """
+        Add amount to the counter name with the given labels.
+        """
+        self._get_series(name, 'counter', help, labels, Counter).inc(amount)
+
+    def add_collector(self, key, collector):
+        """
+        Register a function called when rendering that returns a list of
+        (name, kind, help, [(labels, value), ...]) for counters and gauges
+        kept elsewhere.  A collector registered with the same key is
+        replaced.
+        """
+        self._collectors[key] = collector
+
+    def add_cache(self, name, cache):
+        """
+        Export the size and hit/miss/eviction counters of an LRUCache.
+        """
+        def collect():
+            stats = cache.stats()
+            labels = (('cache', name),)
+            return [
+                ('esmond_cache_hits_total', 'counter', 'Cache lookups that found an entry.', [(labels, stats['hits'])]),
+                ('esmond_cache_misses_total', 'counter', 'Cache lookups that did not find an entry.', [(labels, stats['misses'])]),
+                ('esmond_cache_evictions_total', 'counter', 'Entries evicted to stay within the cache limits.', [(labels, stats['evictions'])]),
+                ('esmond_cache_entries', 'gauge', 'Entries in the cache.', [(labels, stats['entries'])]),
+                ('esmond_cache_bytes', 'gauge', 'Approximate bytes used by the cache.', [(labels, stats['bytes'])]),
+            ]
+        self.add_collector(('cache', name), collect)
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text format.
+        """
+        with self._lock:
+            metrics = [(name, kind, help, list(series.items()))
+                for name, (kind, help, series) in self._metrics.items()]
+        families = {}
+        for name, kind, help, series in metrics:
+            samples = []
+            for labels, metric in series:
+                samples.extend(metric.samples(name, labels))
+            families[name] = (kind, help, samples)
+        for collector in list(self._collectors.values()):
+            for name, kind, help, values in collector():
+                family = families.setdefault(name, (kind, help, []))
+                family[2].extend((name, labels, value) for labels, value in values)
+
+        lines = []
+        for name in sorted(families):
+            kind, help, samples = families[name]
+            if help:
+                lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for sample_name, labels, value in samples:
+                lines.append('%s%s %s' % (sample_name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
@@ -121,6 +121,19 @@ INSTALLED_APPS = (
     'rest_framework.authtoken',
 )
 
+# Shared tier of the timeseries result cache, see result_cache_* in
+# esmond.conf. The process local tier does not use the Django cache.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+if ESMOND_SETTINGS.result_cache_shared_location:
+    CACHES['esmond_results'] = {
+        'BACKEND': ESMOND_SETTINGS.result_cache_shared_backend,
+        'LOCATION': ESMOND_SETTINGS.result_cache_shared_location,
+    }
+
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
         'rest_framework.renderers.JSONRenderer',
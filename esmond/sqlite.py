@@ -0,0 +1,368 @@
+"""
+Embedded storage backend that keeps the time series in a local SQLite
+file.  Meant for small installations (like a single perfSONAR toolkit)
+that do not want to run a cassandra cluster, and as a fast local backend
+for development and benchmarks.
+
+Each cassandra column family is a table with a (row_key, ts) primary key,
+using the same row keys as CASSANDRA_DB, so the year a value falls in
+still decides which row it lives in.  Counter column families are
+updated by inserting a zero row if there is none and adding to it.  Only
+SQL that SQLite 3.7 understands is used since that is what the EL7 
+python is linked against.
+"""
+
+import ast
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from esmond.cassandra import (AGG_TYPES, SEEK_BACK_THRESHOLD, ConnectionException,
+        DatabaseMetrics, AggregationBin, Metadata, decode_raw_value, encode_raw_value,
+        get_rowkey, get_row_keys)
+from esmond.storage import StorageBackend
+from esmond.util import get_logger, LRUCache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS raw_data (
+    row_key TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    val BLOB,
+    expires INTEGER,
+    PRIMARY KEY (row_key, ts)
+);
+CREATE INDEX IF NOT EXISTS raw_data_expires ON raw_data (expires);
+CREATE TABLE IF NOT EXISTS base_rates (
+    row_key TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    val INTEGER NOT NULL,
+    is_valid INTEGER NOT NULL,
+    PRIMARY KEY (row_key, ts)
+);
+CREATE TABLE IF NOT EXISTS rate_aggregations (
+    row_key TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    val INTEGER NOT NULL,
+    base_freq INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (row_key, ts)
+);
+CREATE TABLE IF NOT EXISTS stat_aggregations (
+    row_key TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    min INTEGER,
+    max INTEGER,
+    min_ts INTEGER,
+    max_ts INTEGER,
+    PRIMARY KEY (row_key, ts)
+);
+"""
+
+class SQLITE_DB(StorageBackend):
+
+    _queue_size = 200
+    _page_size = 1000
+
+    def __init__(self, config, qname=None):
+        """
+        Opens (and creates if need be) the database in sqlite_storage_file.
+        Writes are grouped into transactions of up to _queue_size writes
+        that are committed when full or when flush() is called, so other
+        processes see the data once it is flushed.  The connection is
+        shared by all threads and serialized with a lock.
+        """
+        if qname:
+            self.log = get_logger("espersistd.%s.sqlite_db" % qname)
+        else:
+            self.log = logging.getLogger('esmond')
+
+        if not config.sqlite_storage_file:
+            raise ConnectionException("sqlite_storage_file must be set to use the sqlite storage backend")
+        self.path = config.sqlite_storage_file
+        if ast.literal_eval(os.environ.get('ESMOND_UNIT_TESTS', 'False')) and self.path != ':memory:':
+            print('*** Using test database')
+            self.path = os.path.join(os.path.dirname(self.path),
+                'test_{0}'.format(os.path.basename(self.path)))
+            if config.db_clear_on_testing and os.path.exists(self.path):
+                self.log.info('Removing %s' % self.path)
+                os.remove(self.path)
+
+        try:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False,
+                isolation_level=None)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(SCHEMA)
+        except sqlite3.Error as e:
+            raise ConnectionException("Couldn't open sqlite database %s - %s" % (self.path, e))
+        self.log.info('Opened %s' % self.path)
+
+        self._lock = threading.RLock()
+        self._pending = 0
+        self.raw_binary = config.raw_data_binary
+
+        self.profiling = False
+        if config.db_profile_on_testing and os.environ.get("ESMOND_TESTING", False):
+            self.profiling = True
+        self.stats = DatabaseMetrics(profiling=self.profiling, backend='sqlite')
+
+        self.metadata_cache = LRUCache(
+            max_entries=config.metadata_cache_max_entries,
+            max_bytes=config.metadata_cache_max_bytes)
+        self.stats.add_cache('metadata', self.metadata_cache)
+
+    def _write(self, sql, params):
+        with self._lock:
+            if not self.conn.in_transaction:
+                self.conn.execute('BEGIN')
+            self.conn.execute(sql, params)
+            self._pending += 1
+            if self._pending >= self._queue_size:
+                self._commit()
+
+    def _commit(self):
+        if self.conn.in_transaction:
+            self.conn.execute('COMMIT')
+        self._pending = 0
+
+    def flush(self):
+        """
+        Commit everything written so far and drop expired raw data.
+        """
+        with self._lock:
+            self._commit()
+            self.conn.execute('DELETE FROM raw_data WHERE expires <= ?',
+                (int(time.time() * 1000),))
+
+    def close(self):
+        self.log.debug('Close/dispose called')
+        with self._lock:
+            self._commit()
+            self.conn.close()
+
+    #
+    # Writes
+    #
+
+    def encode_raw_value(self, val):
+        if self.raw_binary:
+            return encode_raw_value(val)
+        return json.dumps(val)
+
+    def set_raw_data(self, raw_data, ttl=None):
+        t = time.time()
+        expires = None
+        if ttl:
+            expires = int((t + ttl) * 1000)
+        self._write('INSERT OR REPLACE INTO raw_data (row_key, ts, val, expires) VALUES (?, ?, ?, ?)',
+            (raw_data.get_key(), raw_data.ts_to_jstime(), self.encode_raw_value(raw_data.val), expires))
+        self.stats.raw_insert(time.time() - t)
+
+    def update_rate_bin(self, ratebin):
+        t = time.time()
+        key, ts = ratebin.get_key(), ratebin.ts_to_jstime()
+        with self._lock:
+            self._write('INSERT OR IGNORE INTO base_rates (row_key, ts, val, is_valid) VALUES (?, ?, 0, 0)',
+                (key, ts))
+            self._write('UPDATE base_rates SET val = val + ?, is_valid = is_valid + ? WHERE row_key = ? AND ts = ?',
+                (ratebin.val, ratebin.is_valid, key, ts))
+        self.stats.baserate_update((time.time() - t))
+
+    def update_aggregation_bin(self, agg):
+        t = time.time()
+        key, ts = agg.get_key(), agg.ts_to_jstime()
+        with self._lock:
+            self._write('INSERT OR IGNORE INTO rate_aggregations (row_key, ts, val, base_freq, count) VALUES (?, ?, 0, ?, 0)',
+                (key, ts, agg.base_freq))
+            self._write('UPDATE rate_aggregations SET val = val + ?, base_freq = ?, count = count + ? WHERE row_key = ? AND ts = ?',
+                (agg.val, agg.base_freq, agg.count, key, ts))
+        self.stats.aggregation_update((time.time() - t))
+
+    def update_rate_aggregation(self, raw_data, agg_ts, freq):
+        self.update_aggregation_bin(AggregationBin(
+            ts=agg_ts, freq=freq, val=raw_data.val, base_freq=raw_data.freq, count=1,
+            path=raw_data.path))
+
+    def update_stat_aggregation(self, raw_data, agg_ts, freq):
+        """
+        The current min/max are read back from the database, which is a
+        local index lookup so no cache is kept like CASSANDRA_DB does.
+        """
+        agg = AggregationBin(ts=agg_ts, freq=freq, val=raw_data.val,
+            base_freq=raw_data.freq, count=1, path=raw_data.path)
+        key, ts, val_ts = agg.get_key(), agg.ts_to_jstime(), raw_data.ts_to_jstime()
+
+        t = time.time()
+        with self._lock:
+            row = self.conn.execute('SELECT min, max FROM stat_aggregations WHERE row_key = ? AND ts = ?',
+                (key, ts)).fetchone()
+            self.stats.stat_fetch((time.time() - t))
+
+            t = time.time()
+            updated = True
+            if row is None:
+                self._write('INSERT INTO stat_aggregations (row_key, ts, min, max, min_ts, max_ts) VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, ts, agg.val, agg.val, val_ts, val_ts))
+            elif agg.val > row[1]:
+                self._write('UPDATE stat_aggregations SET max = ?, max_ts = ? WHERE row_key = ? AND ts = ?',
+                    (agg.val, val_ts, key, ts))
+            elif agg.val < row[0]:
+                self._write('UPDATE stat_aggregations SET min = ?, min_ts = ? WHERE row_key = ? AND ts = ?',
+                    (agg.val, val_ts, key, ts))
+            else:
+                updated = False
+        self.stats.stat_update((time.time() - t))
+        return updated
+
+    #
+    # Metadata
+    #
+
+    def set_metadata(self, k, meta_d):
+        self.metadata_cache[k] = meta_d.get_document()
+
+    def get_metadata(self, raw_data):
+        t = time.time()
+        meta_doc = self.metadata_cache.get(raw_data.get_meta_key())
+        if meta_doc is not None:
+            return Metadata(**meta_doc)
+
+        # look back through the raw data for the last processed value
+        ts_max = raw_data.ts_to_jstime() - 1
+        ts_min = ts_max - SEEK_BACK_THRESHOLD
+        last = list(self._select('raw_data', 'val', raw_data.path, raw_data.freq,
+                ts_min, ts_max, 1, reverse=True))
+        self.stats.meta_fetch((time.time() - t))
+
+        if last:
+            ts, val = last[0]
+            meta_d = Metadata(last_update=ts, last_val=decode_raw_value(val),
+                min_ts=ts, freq=raw_data.freq, path=raw_data.path)
+        else:
+            meta_d = Metadata(last_update=raw_data.ts, last_val=raw_data.val,
+                min_ts=raw_data.ts, freq=raw_data.freq, path=raw_data.path)
+        self.set_metadata(raw_data.get_meta_key(), meta_d)
+        return meta_d
+
+    def update_metadata(self, k, metadata):
+        meta_doc = self.metadata_cache.get(k)
+        if meta_doc is None:
+            self.set_metadata(k, metadata)
+            return
+        for i in ['last_val', 'min_ts', 'last_update']:
+            meta_doc[i] = getattr(metadata, i)
+
+    #
+    # Reads
+    #
+
+    def _select(self, table, columns, path, freq, ts_min, ts_max,
+            column_count=None, reverse=False):
+        """
+        Yields (ts, columns...) tuples for the rows the range spans in time
+        order, reading _page_size rows at a time.  The lock is only held
+        while a page is read so other threads can use the connection
+        while the results are consumed.
+        """
+        keys = get_row_keys(path, freq, ts_min, ts_max)
+        where = 'row_key IN (%s)' % ', '.join('?' * len(keys))
+        if table == 'raw_data':
+            where += ' AND (expires IS NULL OR expires > %d)' % int(time.time() * 1000)
+        if reverse:
+            sql = 'SELECT ts, %s FROM %s WHERE %s AND ts >= ? AND ts <= ? ORDER BY ts DESC LIMIT ?'
+        else:
+            sql = 'SELECT ts, %s FROM %s WHERE %s AND ts >= ? AND ts <= ? ORDER BY ts LIMIT ?'
+        sql = sql % (columns, table, where)
+
+        remaining = column_count
+        while True:
+            count = self._page_size
+            if remaining is not None:
+                count = min(count, remaining)
+            t = time.time()
+            with self._lock:
+                page = self.conn.execute(sql, keys + [ts_min, ts_max, count]).fetchall()
+            self.stats.observe('select', table, time.time() - t)
+            for row in page:
+                yield row
+            if len(page) < count:
+                return
+            if remaining is not None:
+                remaining -= len(page)
+                if remaining <= 0:
+                    return
+            if reverse:
+                ts_max = page[-1][0] - 1
+            else:
+                ts_min = page[-1][0] + 1
+
+    def iter_baserate_timerange(self, path=None, freq=None,
+            ts_min=None, ts_max=None, cf='average', column_count=None):
+        if cf not in ['average', 'delta']:
+            self.log.error('Not a valid option: %s - defaulting to average' % cf)
+            cf = 'average'
+
+        value_divisors = { 'average': int((freq or 1000)/1000), 'delta': 1 }
+
+        for ts, val, is_valid in self._select('base_rates', 'val, is_valid',
+                path, freq, ts_min, ts_max, column_count):
+            yield {'ts': ts, 'val': float(val) / value_divisors[cf], 'is_valid': is_valid}
+
+    def iter_aggregation_timerange(self, path=None, freq=None,
+            ts_min=None, ts_max=None, cf=None, column_count=None):
+        if cf not in AGG_TYPES:
+            self.log.error('Not a valid option: %s - defaulting to average' % cf)
+            cf = 'average'
+
+        if cf == 'average' or cf == 'raw':
+            for ts, val, base_freq, count in self._select('rate_aggregations',
+                    'val, base_freq, count', path, freq, ts_min, ts_max, column_count):
+                ab = AggregationBin(ts=ts, val=val, base_freq=base_freq, count=count, cf=cf)
+                if cf == 'average':
+                    yield {'ts': ts, 'val': ab.average, 'cf': ab.cf}
+                else:
+                    yield {'ts': ts, 'val': ab.val, 'cf': ab.cf}
+        else:
+            for ts, val, m_ts in self._select('stat_aggregations',
+                    '%s, %s_ts' % (cf, cf), path, freq, ts_min, ts_max, column_count):
+                yield {'ts': ts, 'val': val, 'cf': cf, 'm_ts': m_ts}
+
+    def iter_raw_data(self, path=None, freq=None,
+            ts_min=None, ts_max=None, column_count=None):
+        for ts, val in self._select('raw_data', 'val', path, freq,
+                ts_min, ts_max, column_count):
+            yield {'ts': ts, 'val': decode_raw_value(val)}
+
+    def _query_raw_edge(self, path, freq, year, order):
+        t = time.time()
+        with self._lock:
+            row = self.conn.execute('SELECT ts, val FROM raw_data WHERE row_key = ? '
+                'AND (expires IS NULL OR expires > ?) ORDER BY ts %s LIMIT 1' % order,
+                (get_rowkey(path, freq, year), int(time.time() * 1000))).fetchone()
+        self.stats.observe('select', 'raw_data', time.time() - t)
+        if row is None:
+            return []
+        return [{'ts': row[0], 'val': decode_raw_value(row[1])}]
+
+    def query_raw_first(self, path=None, freq=None, year=None):
+        return self._query_raw_edge(path, freq, year, 'ASC')
+
+    def query_raw_last(self, path=None, freq=None, year=None):
+        return self._query_raw_edge(path, freq, year, 'DESC')
+
+    def check_for_valid_keys(self, path=None, freq=None,
+            ts_min=None, ts_max=None, col_fam='rate'):
+        table = {
+            'raw': 'raw_data',
+            'rate': 'base_rates',
+            'aggs': 'rate_aggregations',
+            'stat': 'stat_aggregations'
+        }[col_fam]
+        keys = get_row_keys(path, freq, ts_min, ts_max)
+        with self._lock:
+            row = self.conn.execute('SELECT 1 FROM %s WHERE row_key IN (%s) LIMIT 1' %
+                (table, ', '.join('?' * len(keys))), keys).fetchone()
+        return row is not None
@@ -0,0 +1,173 @@
+"""
+Storage backends for the time series data.
+
+StorageBackend is the interface the persister, the REST api and the
+validators use to read and write time series.  CASSANDRA_DB (esmond.cassandra)
+is the production backend for large deployments, SQLITE_DB (esmond.sqlite)
+keeps everything in a local file for small installations and benchmarks.
+get_storage_backend picks one based on the storage_backend config option.
+"""
+
+STORAGE_BACKENDS = ('cassandra', 'sqlite')
+
+class StorageBackend(object):
+    """
+    Time series are stored like the cassandra column families: raw values,
+    base rate counters, rate aggregation counters and min/max stat
+    aggregations.  Each is addressed by a row key from get_rowkey (the
+    path, frequency and year) and a millisecond timestamp.  Backends
+    implement the write, metadata and iter_* methods, query_* methods
+    return the iter_* results as lists.
+
+    Writes may be batched, flush() sends everything written so far.
+    """
+    raw_cf = 'raw_data'
+    rate_cf = 'base_rates'
+    agg_cf = 'rate_aggregations'
+    stat_cf = 'stat_aggregations'
+
+    #
+    # Writes
+    #
+
+    def set_raw_data(self, raw_data, ttl=None):
+        """
+        Store a RawData value, expiring after ttl seconds if given.
+        """
+        raise NotImplementedError()
+
+    def update_rate_bin(self, ratebin):
+        """
+        Add the val and is_valid of a BaseRateBin to the counters of its bin.
+        """
+        raise NotImplementedError()
+
+    def update_aggregation_bin(self, agg):
+        """
+        Add the val and count of an AggregationBin to the counters of its bin.
+        """
+        raise NotImplementedError()
+
+    def update_rate_aggregation(self, raw_data, agg_ts, freq):
+        """
+        Add a RawData value to the freq second rate aggregation bin at agg_ts.
+        """
+        raise NotImplementedError()
+
+    def update_stat_aggregation(self, raw_data, agg_ts, freq):
+        """
+        Update the min/max of the freq second stat aggregation bin at agg_ts
+        with a RawData value.  Returns True if the bin was written.
+        """
+        raise NotImplementedError()
+
+    #
+    # Metadata (last value seen for each measurement)
+    #
+
+    def get_metadata(self, raw_data):
+        """
+        Returns the Metadata of the measurement of a RawData value, seeded
+        from the stored raw data or from raw_data itself if not known yet.
+        """
+        raise NotImplementedError()
+
+    def set_metadata(self, k, meta_d):
+        raise NotImplementedError()
+
+    def update_metadata(self, k, metadata):
+        raise NotImplementedError()
+
+    def prefetch_metadata(self, raw_data_list):
+        """
+        Seed the metadata for many measurements at once.  Returns the
+        number of meta keys that were seeded.
+        """
+        return 0
+
+    #
+    # Reads
+    #
+
+    def iter_baserate_timerange(self, path=None, freq=None,
+            ts_min=None, ts_max=None, cf='average', column_count=None):
+        """
+        Yields the base rates ({'ts', 'val', 'is_valid'}) in time order.
+        cf is 'average' or 'delta'.
+        """
+        raise NotImplementedError()
+
+    def iter_aggregation_timerange(self, path=None, freq=None,
+            ts_min=None, ts_max=None, cf=None, column_count=None):
+        """
+        Yields the aggregations ({'ts', 'val', 'cf'}) in time order.  cf
+        is one of AGG_TYPES.
+        """
+        raise NotImplementedError()
+
+    def iter_raw_data(self, path=None, freq=None,
+            ts_min=None, ts_max=None, column_count=None):
+        """
+        Yields the raw data ({'ts', 'val'}) in time order.
+        """
+        raise NotImplementedError()
+
+    def query_raw_first(self, path=None, freq=None, year=None):
+        raise NotImplementedError()
+
+    def query_raw_last(self, path=None, freq=None, year=None):
+        raise NotImplementedError()
+
+    def check_for_valid_keys(self, path=None, freq=None,
+            ts_min=None, ts_max=None, col_fam='rate'):
+        """
+        Returns True if any of the rows the range spans exist.
+        """
+        raise NotImplementedError()
+
+    def query_baserate_timerange(self, path=None, freq=None,
+            ts_min=None, ts_max=None, cf='average', column_count=None):
+        return list(self.iter_baserate_timerange(path=path, freq=freq,
+                ts_min=ts_min, ts_max=ts_max, cf=cf, column_count=column_count))
+
+    def query_aggregation_timerange(self, path=None, freq=None,
+            ts_min=None, ts_max=None, cf=None, column_count=None):
+        return list(self.iter_aggregation_timerange(path=path, freq=freq,
+                ts_min=ts_min, ts_max=ts_max, cf=cf, column_count=column_count))
+
+    def query_raw_data(self, path=None, freq=None,
+            ts_min=None, ts_max=None, column_count=None):
+        return list(self.iter_raw_data(path=path, freq=freq,
+                ts_min=ts_min, ts_max=ts_max, column_count=column_count))
+
+    def fan_out(self, fn, *iterables):
+        """
+        Like map(fn, *iterables), backends that can run reads concurrently
+        do so.  Results are returned in order.
+        """
+        return list(map(fn, *iterables))
+
+    #
+    # Housekeeping
+    #
+
+    def flush(self):
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+def get_storage_backend(config, qname=None, **kwargs):
+    """
+    Returns the storage backend selected by config.storage_backend.  The
+    backend modules are imported here so the pycassa/thrift dependencies
+    are only needed when cassandra is used.
+    """
+    if config.storage_backend == 'sqlite':
+        from esmond.sqlite import SQLITE_DB
+        return SQLITE_DB(config, qname=qname)
+    elif config.storage_backend == 'cassandra':
+        from esmond.cassandra import CASSANDRA_DB
+        return CASSANDRA_DB(config, qname=qname, **kwargs)
+    raise ValueError("Unknown storage_backend %s, must be one of %s" %
+            (config.storage_backend, ', '.join(STORAGE_BACKENDS)))
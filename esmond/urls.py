@@ -12,6 +12,7 @@ from esmond.api.perfsonar.api_v2 import (
     EventTypeDetailViewset,
     TimeSeriesViewset,
 )
+from esmond.api.views import metrics
 #
 # Perfsonar V2 router/etc
 
@@ -26,6 +27,8 @@ ps_router.register('archive', ArchiveViewset, base_name='archive')
 urlpatterns = [
     # Original urls - built in the original api.py files and attached here.
     url(r'^admin/', include(admin.site.urls)),
+    # Prometheus metrics of this process.
+    url(r'^metrics/?$', metrics),
     ## URL definitions for V2 Perfsonar API
     # main archive/metadata endpoint.
     url(r'{0}/'.format(PS_ROOT), include(ps_router.urls)),
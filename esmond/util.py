@@ -1,5 +1,9 @@
+import collections
 import ctypes
 import datetime
+import itertools
+import sys
+import threading
 import time
 import logging
 
@@ -50,3 +54,207 @@ def datetime_to_unixtime(dt):
 # that this datetime is effectively infinite.  it is set to be 2 days less than
 # datetime.datetime.max to prevent overflow due to timezone variances.
 max_datetime = make_aware(datetime.datetime.max - datetime.timedelta(2), utc)
+
+def deep_getsizeof(obj, sample=16):
+    """
+    Approximate the memory used by an object including the contents of
+    dicts, lists, tuples and sets. Only the first sample items of a 
+    container are measured and the rest are assumed to be of the same
+    average size, so the cost does not grow with long result lists.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        items = obj.items()
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        items = obj
+    else:
+        return size
+    measured = 0
+    for count, i in enumerate(itertools.islice(items, sample), 1):
+        if isinstance(obj, dict):
+            measured += deep_getsizeof(i[0], sample) + deep_getsizeof(i[1], sample)
+        else:
+            measured += deep_getsizeof(i, sample)
+    if measured:
+        size += measured * len(obj) // count
+    return size
+
+class LRUCache(object):
+    """
+    Thread safe dict-like cache bounded by number of entries and by an
+    approximate number of bytes. The least recently used entries are
+    evicted first once either limit is exceeded. If max_age is set, entries
+    older than max_age seconds are treated as missing. A limit of None
+    means unbounded. The size of an entry is measured when it is set, so 
+    values modified in place after that are not re-measured.
+
+    Hit, miss and eviction counts are kept for reporting.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, max_age=None, sizeof=deep_getsizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            return entry is not None and not self._expired(entry)
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _expired(self, entry):
+        return self.max_age is not None and time.time() - entry[0] >= self.max_age
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry[2]
+        return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            if self._expired(entry):
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time(), value, size)
+            self.bytes += size
+            while self._entries and (
+                    (self.max_entries is not None and len(self._entries) > self.max_entries) or
+                    (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key)[1]
+
+    def items(self):
+        """
+        Returns a list of (key, value) from least to most recently used
+        without updating the order or the counters.
+        """
+        with self._lock:
+            return [(k, e[1]) for k, e in self._entries.items() if not self._expired(e)]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Returns a dict of the current size and the counters
+        """
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+class SingleFlight(object):
+    """
+    Makes at most one call per key at a time. Callers asking for a key
+    that is already being fetched wait for that call and get its result,
+    or its exception, instead of making their own. Results are shared 
+    between the callers so they should not be modified in place.
+
+    Counts of calls made, callers that shared another caller's call and
+    the most callers waiting on one call are kept for reporting.
+    """
+
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.waiters = 0
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self.max_waiters = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Returns fn(*args, **kwargs), sharing the call with any other
+        caller of the same key while it runs.
+        """
+        with self._lock:
+            call = self._calls.get(key, None)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.calls += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+                self.max_waiters = max(self.max_waiters, call.waiters)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """
+        Returns a dict of the calls in flight and the counters
+        """
+        return {
+            'in_flight': len(self._calls),
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'max_waiters': self.max_waiters,
+        }
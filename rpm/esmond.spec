@@ -40,6 +40,7 @@ BuildRequires:  python3-virtualenv
 BuildRequires:  python36-astroid
 BuildRequires:  python36-dateutil
 BuildRequires:  python36-netaddr
+BuildRequires:  python36-numpy
 BuildRequires:  python36-pylint
 BuildRequires:  python36-pytz
 BuildRequires:  python36-sphinx
@@ -61,6 +62,7 @@ Requires:       python3-virtualenv
 Requires:       python36-astroid
 Requires:       python36-dateutil
 Requires:       python36-netaddr
+Requires:       python36-numpy
 Requires:       python36-pytz
 Requires:       mod_wsgi >= 4.6.5
 Requires:       policycoreutils-python
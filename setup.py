@@ -20,6 +20,7 @@ setup(
         'djangorestframework-filters~=0.10.2',
         'django-filter~=1.1',
         'python-memcached>=1.57',
+        'numpy',
         'psycopg2>=2.7.7',
         'requests',
         'thrift==0.13.0'
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the __slots__ based data containers in esmond.cassandra against
+the original __dict__ based versions. Simulates ingesting a number of
+points the way CASSANDRA_DB does: one RawRateData, BaseRateBin and
+AggregationBin per point, asking each for its row key and millisecond
+timestamp as many times as the write path does. Reports CPU time and the
+memory held by the containers for each implementation.
+"""
+
+import argparse
+import calendar
+import datetime
+import gc
+import time
+import tracemalloc
+
+from esmond.cassandra import get_rowkey, RawRateData, BaseRateBin, AggregationBin
+
+class LegacyDataContainerBase(object):
+    """
+    Original DataContainerBase without slots or cached values
+    """
+    _doc_properties = []
+
+    def __init__(self, path):
+        self.path = path
+
+    def _handle_date(self,d):
+        if type(d) == datetime.datetime:
+            return d
+        else:
+            return datetime.datetime.utcfromtimestamp(float(d)/1000.0)
+
+    def get_document(self):
+        doc = {}
+        for k,v in list(self.__dict__.items()):
+            if k.startswith('_'):
+                continue
+            doc[k] = v
+
+        for p in self._doc_properties:
+            doc[p] = getattr(self, '%s' % p)
+
+        return doc
+
+    def ts_to_jstime(self, t='ts'):
+        ts = getattr(self, t)
+        return calendar.timegm(ts.utctimetuple()) * 1000
+
+class LegacyRawRateData(LegacyDataContainerBase):
+    _doc_properties = ['ts']
+
+    def __init__(self, path=None, ts=None, val=None, freq=None):
+        LegacyDataContainerBase.__init__(self, path)
+        self._ts = None
+        self.ts = ts
+        self.val = val
+        self.freq = freq
+
+    def get_key(self):
+        return get_rowkey(self.path, freq=self.freq, year=self.ts.year)
+
+    def get_meta_key(self):
+        return get_rowkey(self.path, freq=self.freq)
+
+    @property
+    def ts(self):
+        return self._ts
+
+    @ts.setter
+    def ts(self, value):
+        self._ts = self._handle_date(value)
+
+class LegacyBaseRateBin(LegacyRawRateData):
+    def __init__(self, path=None, ts=None, val=None, freq=None, is_valid=1):
+        LegacyRawRateData.__init__(self, path, ts, val, freq)
+        self.is_valid = is_valid
+
+class LegacyAggregationBin(LegacyBaseRateBin):
+    def __init__(self, path=None, ts=None, val=None, freq=None, base_freq=None, count=None,
+            min=None, max=None, cf=None):
+        LegacyBaseRateBin.__init__(self, path, ts, val, freq)
+        self.count = count
+        self.min = min
+        self.max = max
+        self.base_freq = base_freq
+        self.cf = cf
+
+def ingest(points, raw_cls, base_cls, agg_cls, keep):
+    """
+    Creates the containers for each point and calls the key and timestamp
+    methods as often as the write path does. If keep is set the containers
+    are returned so their memory can be measured.
+    """
+    kept = []
+    for path, ts, val in points:
+        raw = raw_cls(path=path, ts=ts, val=val, freq=30000)
+        #set_raw_data, get_metadata, update_metadata
+        raw.get_key()
+        raw.ts_to_jstime()
+        for i in range(3):
+            raw.get_meta_key()
+        ratebin = base_cls(path=path, ts=ts, val=val, freq=30000)
+        ratebin.get_key()
+        ratebin.ts_to_jstime()
+        agg = agg_cls(path=path, ts=ts, val=val, freq=3600000, base_freq=30000, count=1, cf='average')
+        #update_stat_agg and the aggregation cache
+        for i in range(4):
+            agg.get_key()
+            agg.ts_to_jstime()
+            raw.ts_to_jstime()
+        if keep:
+            kept.append((raw, ratebin, agg))
+    return kept
+
+def measure(points, classes):
+    gc.collect()
+    start = time.process_time()
+    ingest(points, *classes, keep=False)
+    cpu = time.process_time() - start
+
+    gc.collect()
+    tracemalloc.start()
+    kept = ingest(points, *classes, keep=True)
+    mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+
+    return cpu, mem
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cassandra data containers")
+    parser.add_argument('-n', '--points', metavar='POINTS', nargs=1,
+            dest='points', default=[1000000], type=int,
+            help='Number of points to ingest. Defaults to 1000000')
+    parser.add_argument('-p', '--paths', metavar='PATHS', nargs=1,
+            dest='paths', default=[1000], type=int,
+            help='Number of distinct paths the points are spread over. Defaults to 1000')
+    args = parser.parse_args()
+
+    num_points = args.points[0]
+    paths = [['ps', 'metadata%d' % i, 'throughput'] for i in range(args.paths[0])]
+    start_ts = 1500000000
+    #the API creates one datetime per point and passes it to each container
+    points = [(paths[i % len(paths)], datetime.datetime.utcfromtimestamp(start_ts + (i // len(paths)) * 30), i)
+                for i in range(num_points)]
+
+    legacy_cpu, legacy_mem = measure(points, (LegacyRawRateData, LegacyBaseRateBin, LegacyAggregationBin))
+    slots_cpu, slots_mem = measure(points, (RawRateData, BaseRateBin, AggregationBin))
+
+    print("%10s %12s %12s %16s" % ("", "cpu (s)", "memory (MB)", "bytes per point"))
+    print("%10s %12.2f %12.1f %16d" % ("legacy", legacy_cpu, legacy_mem/1048576.0, legacy_mem//num_points))
+    print("%10s %12.2f %12.1f %16d" % ("slots", slots_cpu, slots_mem/1048576.0, slots_mem//num_points))
+    print("%10s %11.1fx %11.1fx" % ("savings", legacy_cpu/slots_cpu, float(legacy_mem)/slots_mem))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the numpy histogram statistics used by HistogramValidator against
+the original pure python implementation. Also verifies both give identical
+results for each generated histogram.
+"""
+
+import argparse
+import django
+import math
+import random
+import timeit
+
+'''
+Percentile: Original pure python percentile calculation using the NIST
+algorithm (http://www.itl.nist.gov/div898/handbook/prc/section2/prc252.htm)
+'''
+class Percentile(object):
+
+    def __init__(self, percentile, sample_size):
+        self.value = None
+        self.is_calculated = False
+        self.percentile = percentile
+        self.sample_size = sample_size
+        self.n = (self.percentile/100.0)*(sample_size + 1)
+        self.k = math.floor(self.n)
+        self.d = self.n - self.k
+
+        if percentile == 50:
+            self.key = "median"
+        else:
+            self.key = "percentile-%d" % percentile
+
+    def findvalue(self, count, hist_value):
+        if self.value is not None:
+            self.value += (self.d * (hist_value - self.value))
+            self.is_calculated = True
+        elif self.k == 0:
+            self.value = hist_value
+            self.is_calculated = True
+        elif count >= self.sample_size and self.k >= self.sample_size:
+            self.value = hist_value
+            self.is_calculated = True
+        elif (self.k + self.d) < count:
+            self.value = hist_value
+            self.is_calculated = True
+        else:
+            self.value = hist_value
+
+def legacy_statistics(agg_hist, quantiles):
+    '''
+    Original HistogramValidator.statistics calculation
+    '''
+    #pass one: mode, mean and sample size
+    stats = {}
+    mean_num = 0
+    sample_size = 0
+    for k in agg_hist:
+        #only can do statistics for histograms with numeric buckets
+        try:
+            float(k)
+        except ValueError:
+            return {}
+
+        # update calculation values
+        if 'mode' not in stats or agg_hist[k] > agg_hist[stats['mode'][0]]:
+           stats['mode'] = [ k ]
+        elif agg_hist[k] == agg_hist[stats['mode'][0]]:
+            stats['mode'].append(k)
+        mean_num += (float(k) * agg_hist[k])
+        sample_size += agg_hist[k]
+    stats['mean'] = (mean_num/(1.0*sample_size))
+
+    #sort items. make sure sort as numbers not strings
+    sorted_hist = sorted(iter(agg_hist.items()), key=lambda k: float(k[0]))
+
+    #make mode floats.
+    stats['mode'] = [float(x) for x in stats['mode']]
+    #get min and max
+    stats['minimum'] = float(sorted_hist[0][0])
+    stats['maximum'] = float(sorted_hist[len(sorted_hist)-1][0])
+
+    #pass two: get quantiles, variance, and std deviation
+    stddev = 0
+    percentiles = [Percentile(q, sample_size) for q in quantiles]
+    percentile = percentiles.pop(0)
+    curr_count = 0
+    for hist_item in sorted_hist:
+        #stddev/variance
+        stddev += (math.pow(float(hist_item[0]) - stats['mean'], 2)*hist_item[1])
+        #quantiles
+        curr_count += hist_item[1]
+        while percentile is not None and curr_count >= percentile.k:
+            percentile.findvalue(curr_count, float(hist_item[0]))
+            #some percentiles require next item in list, so may have to wait until next iteration
+            if percentile.is_calculated:
+                #calculated so add to dict
+                stats[percentile.key] = percentile.value
+            else:
+                #unable to calculate this pass, so break loop
+                break
+
+            #get next percentile
+            if len(percentiles) > 0:
+                percentile = percentiles.pop(0)
+            else:
+                percentile = None
+
+    #set standard deviation
+    stats['variance'] = stddev/sample_size
+    stats['standard-deviation'] = math.sqrt(stats['variance'])
+
+    return stats
+
+class StatsObj(object):
+    summary_window = 0
+    freq = None
+
+def numpy_statistics(validator, agg_hist):
+    '''
+    Runs HistogramValidator.statistics and returns the result
+    '''
+    obj = StatsObj()
+    obj.value = agg_hist
+    validator.statistics(None, obj, {})
+    return obj.value
+
+def generate_histogram(buckets, max_count, resolution):
+    '''
+    Builds a histogram with the given number of buckets in the style of an
+    owamp delay histogram
+    '''
+    hist = {}
+    while len(hist) < buckets:
+        key = "%.2f" % (random.randint(0, buckets * 10) * resolution)
+        hist[key] = random.randint(1, max_count)
+    return hist
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark histogram statistics calculations")
+    parser.add_argument('-b', '--buckets', metavar='BUCKETS', nargs='+',
+            dest='buckets', default=[10, 100, 1000, 10000], type=int,
+            help='Number of buckets in generated histograms. Defaults to 10 100 1000 10000')
+    parser.add_argument('-n', '--histograms', metavar='HISTOGRAMS', nargs=1,
+            dest='histograms', default=[20], type=int,
+            help='Number of histograms to generate for each bucket count. Defaults to 20')
+    parser.add_argument('-r', '--repeat', metavar='REPEAT', nargs=1,
+            dest='repeat', default=[5], type=int,
+            help='Number of times to calculate statistics for each histogram. Defaults to 5')
+    parser.add_argument('-c', '--max-count', metavar='MAX_COUNT', nargs=1,
+            dest='max_count', default=[1000], type=int,
+            help='Maximum count of a single bucket. Defaults to 1000')
+    parser.add_argument('-q', '--quantiles', metavar='QUANTILES', nargs='+',
+            dest='quantiles', default=[25, 50, 75, 95], type=int,
+            help='Percentiles to calculate. Defaults to 25 50 75 95')
+    parser.add_argument('-s', '--seed', metavar='SEED', nargs=1,
+            dest='seed', default=[0], type=int,
+            help='Random seed used to generate histograms. Defaults to 0')
+    args = parser.parse_args()
+
+    #init django
+    django.setup()
+
+    from esmond.api.perfsonar.validators import HistogramValidator
+
+    random.seed(args.seed[0])
+    quantiles = sorted(args.quantiles)
+    validator = HistogramValidator()
+    validator.quantiles = quantiles
+    print("%10s %14s %14s %10s %10s" % ("buckets", "legacy (ms)", "numpy (ms)", "speedup", "identical"))
+    for buckets in args.buckets:
+        hists = [generate_histogram(buckets, args.max_count[0], 0.01) for i in range(args.histograms[0])]
+        identical = all(legacy_statistics(dict(h), quantiles) == numpy_statistics(validator, dict(h)) for h in hists)
+        legacy_time = timeit.timeit(lambda: [legacy_statistics(h, quantiles) for h in hists], number=args.repeat[0])
+        numpy_time = timeit.timeit(lambda: [numpy_statistics(validator, h) for h in hists], number=args.repeat[0])
+        calls = args.repeat[0] * len(hists)
+        print("%10d %14.3f %14.3f %9.1fx %10s" % (buckets, 1000 * legacy_time/calls,
+                1000 * numpy_time/calls, legacy_time/numpy_time, identical))
+
+if __name__ == "__main__":
+    main()
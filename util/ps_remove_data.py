@@ -132,8 +132,8 @@ def row_prefix(event_type):
     return ['ps', event_type.replace('-', '_') ]
         
 def query_data( db, metadata_key, event_type, summary_type, freq, begin_time, end_time):
-    """Grabs cassandra data"""
-    results = []
+    """Grabs cassandra data. Results are a generator so a chunk is never held in memory"""
+    results = iter([])
     datapath = row_prefix(event_type)
     datapath.append(metadata_key)
     if(summary_type != 'base'):
@@ -149,15 +149,15 @@ def query_data( db, metadata_key, event_type, summary_type, freq, begin_time, en
     cf = None
     if col_fam == db.agg_cf:
         cf = db.aggs
-        results = db.query_aggregation_timerange(path=datapath, freq=freq,
+        results = db.iter_aggregation_timerange(path=datapath, freq=freq,
                cf='average', ts_min=begin_time*1000, ts_max=end_time*1000)
     elif col_fam == db.rate_cf:
         cf = db.rates
-        results = db.query_baserate_timerange(path=datapath, freq=freq,
+        results = db.iter_baserate_timerange(path=datapath, freq=freq,
                 cf='delta', ts_min=begin_time*1000, ts_max=end_time*1000)
     elif col_fam == db.raw_cf:
         cf = db.raw_data
-        results = db.query_raw_data(path=datapath, freq=freq,
+        results = db.iter_raw_data(path=datapath, freq=freq,
                ts_min=begin_time*1000, ts_max=end_time*1000)
     else:
         raise RuntimeError("Requested data does not map to a known column-family")
@@ -297,29 +297,37 @@ def main():
                 break
             
             #adjust begin_time
+            query_begin_time = begin_time
+            query_end_time = end_time
             end_time = begin_time
             begin_time = begin_time - args.time_chunk[0]
             
+            #delete data as it streams back from the query
+            found = 0
+            try:
+                for expired_col in expired_data:
+                    year = datetime.utcfromtimestamp(float(expired_col['ts'])/1000.0).year 
+                    row_key = get_rowkey(datapath, et.summary_window, year)   
+                    found += 1
+                    try:
+                        cf.remove(row_key, [expired_col['ts']])
+                    except Exception as e:
+                        sys.stderr.write("Error deleting {0}: {1}\n".format(row_key, e))
+            except Exception as e:
+                print("Query error for metadata_key=%s, event_type=%s, summary_type=%s, summary_window=%s, begin_time=%s, end_time=%s, error=%s" % (md_key, et.event_type, et.summary_type, et.summary_window, query_begin_time, query_end_time, e))
+                break
+            
             #check if we got any data
-            if len(expired_data) == 0:
+            if found == 0:
                 misses += 1
                 continue
-            
-            #delete data    
-            for expired_col in expired_data:
-                year = datetime.utcfromtimestamp(float(expired_col['ts'])/1000.0).year 
-                row_key = get_rowkey(datapath, et.summary_window, year)   
-                try:
-                    cf.remove(row_key, [expired_col['ts']])
-                except Exception as e:
-                    sys.stderr.write("Error deleting {0}: {1}\n".format(row_key, e))
                     
-            print("Sending request to delete %d rows for metadata_key=%s, event_type=%s, summary_type=%s, summary_window=%s" % (len(expired_data), md_key, et.event_type, et.summary_type, et.summary_window))
+            print("Sending request to delete %d rows for metadata_key=%s, event_type=%s, summary_type=%s, summary_window=%s" % (found, md_key, et.event_type, et.summary_type, et.summary_window))
             try:
                 cf.send()
             except Exception as e:
                 sys.stderr.write("Error sending delete: {0}".format(e))
-            print("Deleted %d rows for metadata_key=%s, event_type=%s, summary_type=%s, summary_window=%s" % (len(expired_data), md_key, et.event_type, et.summary_type, et.summary_window))
+            print("Deleted %d rows for metadata_key=%s, event_type=%s, summary_type=%s, summary_window=%s" % (found, md_key, et.event_type, et.summary_type, et.summary_window))
         
     #Clean out metadata from relational database
     for md_key in metadata_counts:
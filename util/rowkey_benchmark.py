@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the memoized row key functions in esmond.cassandra against the
+original versions that rebuilt every key. Reports keys per second for
+single row keys (the write path) and for the per-year key ranges used by
+queries.
+"""
+
+import argparse
+import datetime
+import random
+import timeit
+
+from esmond.cassandra import KEY_DELIMITER, clear_rowkey_caches, get_rowkey, get_row_keys
+
+def legacy_escape_path(path):
+    escaped = []
+    for step in path:
+        escaped.append(step.replace(KEY_DELIMITER,
+            "\\%s" % KEY_DELIMITER))
+
+    return escaped
+
+def legacy_get_rowkey(path, freq=None, year=None):
+    appends = []
+    if freq:
+        appends.append(str(freq))
+    if year:
+        appends.append(str(year))
+
+    return KEY_DELIMITER.join(legacy_escape_path(path) + appends)
+
+def legacy_get_row_keys(path, freq, ts_min, ts_max):
+    year_start = datetime.datetime.utcfromtimestamp(float(ts_min)/1000.0).year
+    year_finish = datetime.datetime.utcfromtimestamp(float(ts_max)/1000.0).year
+
+    key_range = []
+
+    if year_start != year_finish:
+        for year in range(year_start, year_finish+1):
+            key_range.append(legacy_get_rowkey(path, freq=freq, year=year))
+    else:
+        key_range.append(legacy_get_rowkey(path, freq=freq, year=year_start))
+    return key_range
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark row key construction")
+    parser.add_argument('-n', '--keys', metavar='KEYS', nargs=1,
+            dest='keys', default=[1000000], type=int,
+            help='Number of keys to build. Defaults to 1000000')
+    parser.add_argument('-p', '--paths', metavar='PATHS', nargs=1,
+            dest='paths', default=[1000], type=int,
+            help='Number of distinct paths. Defaults to 1000')
+    parser.add_argument('-s', '--seed', metavar='SEED', nargs=1,
+            dest='seed', default=[0], type=int,
+            help='Random seed. Defaults to 0')
+    args = parser.parse_args()
+
+    random.seed(args.seed[0])
+    num_keys = args.keys[0]
+    paths = [['ps', 'metadata%d' % i, 'histogram-owdelay', 'histograms:%d' % (i % 3)] for i in range(args.paths[0])]
+    freqs = [0, 300, 3600, 86400]
+    now = 1500000000000
+    #writes: a path and freq with a timestamp in the last day
+    writes = [(random.choice(paths), random.choice(freqs), now - random.randint(0, 86400000)) for i in range(num_keys)]
+    #queries: a path and freq over a range of up to a year
+    queries = [(p, f, ts - random.randint(0, 365*86400000), ts) for p, f, ts in writes]
+
+    def legacy_writes():
+        for p, f, ts in writes:
+            legacy_get_rowkey(p, f, datetime.datetime.utcfromtimestamp(ts/1000.0).year)
+
+    def memo_writes():
+        for p, f, ts in writes:
+            get_rowkey(p, f, datetime.datetime.utcfromtimestamp(ts/1000.0).year)
+
+    def legacy_queries():
+        for q in queries:
+            legacy_get_row_keys(*q)
+
+    def memo_queries():
+        for q in queries:
+            get_row_keys(*q)
+
+    print("%10s %16s %16s %10s" % ("", "legacy (keys/s)", "memo (keys/s)", "speedup"))
+    for name, legacy, memo in (("writes", legacy_writes, memo_writes), ("queries", legacy_queries, memo_queries)):
+        clear_rowkey_caches()
+        identical = all(legacy_get_row_keys(*q) == get_row_keys(*q) for q in queries[:10000])
+        legacy_time = timeit.timeit(legacy, number=1)
+        memo_time = timeit.timeit(memo, number=1)
+        print("%10s %16d %16d %9.1fx%s" % (name, num_keys/legacy_time, num_keys/memo_time,
+                legacy_time/memo_time, "" if identical else " (MISMATCH)"))
+
+if __name__ == "__main__":
+    main()